@@ -0,0 +1,186 @@
+import datetime
+import multiprocessing
+from decimal import Decimal, ROUND_HALF_EVEN
+
+from django.db import connections
+from django.db.models import Case, F, Q, Sum, Value, When
+from django.utils import timezone
+
+from .models import (
+    Account,
+    AccountBalanceShard,
+    AccrualRun,
+    AmountAdd,
+    Entry,
+    EntryType,
+    Money,
+    OutboxMessage,
+    ServiceAgreement,
+    conversion_service,
+    memory_postings,
+    post_to_memory_ledger,
+)
+from .archive import in_account_currency
+from .memledger import running_engine
+from .sharding import shard_atomic
+
+CENTS = Decimal('0.01')
+ENTRY_ACCRUED = 'entry.accrued'
+
+
+def day_bounds(run_date):
+    start = timezone.make_aware(datetime.datetime.combine(run_date, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+class AccrualEngine:
+    """Juros e tarifas diárias de todas as contas de cada acordo de serviço.
+
+    ServiceAgreement.rate é a taxa anual em percentual; os juros do dia são
+    saldo * rate / 100 / days_in_year, aplicados aos saldos positivos. As tarifas
+    vêm das regras AmountAdd do acordo cujo event_type é `fee_event_type`:
+    saldo * multiplier + fixedFee, lançadas como débito no entry_type da regra.
+
+    Os saldos vêm de uma única consulta agregada por acordo, os valores são
+    calculados em memória com Decimal e as entradas gravadas com bulk_create.
+    Cada acordo é gravado numa transação e marcado em AccrualRun, então uma
+    execução interrompida pode ser retomada e os acordos podem rodar em paralelo.
+    """
+
+    def __init__(self, run_date, interest_entry_type, fee_event_type='FEE', days_in_year=365, batch_size=1000):
+        self.run_date = run_date
+        self.interest_entry_type = interest_entry_type
+        self.fee_event_type = fee_event_type
+        self.days_in_year = days_in_year
+        self.batch_size = batch_size
+
+    def balances(self, agreement_id, end):
+        # {account_id: saldo na moeda da conta} até o fim do dia, numa consulta; entradas em outra
+        # moeda convertidas na data de cada uma, como Account.balance()
+        accounts = {
+            row['id']: {
+                'currency_id': row['currency_id'], 'currency': row['currency__code'],
+                'memory_ledger': row['memory_ledger'], 'balance': Decimal('0.00'),
+            }
+            for row in Account.objects.filter(customer__service_agreement=agreement_id).values('id', 'currency_id', 'currency__code', 'memory_ledger').distinct()
+        }
+        rows = (
+            Entry.objects.filter(account__in=list(accounts), date__lt=end)
+            .values(
+                'account', 'amount__currency__code',
+                converted_at=Case(When(amount__currency=F('account__currency'), then=Value(None)), default=F('date')),
+            )
+            .annotate(total=Sum('amount__amount'))
+        )
+        for row in rows:
+            account = accounts[row['account']]
+            account['balance'] += in_account_currency(row['total'], row['amount__currency__code'], account['currency'], row['converted_at'])
+        for account_id, account in accounts.items():
+            # Postagens do razão em memória ainda não gravadas nas tabelas
+            engine = running_engine(account['memory_ledger']) if account['memory_ledger'] else None
+            if engine is not None:
+                account['balance'] += engine.pending_total(account_id, before=end)
+        return accounts
+
+    def fee_rules(self, agreement_id, when):
+        return list(
+            AmountAdd.objects.filter(service_agreement=agreement_id, event_type__name=self.fee_event_type, start_date__lte=when)
+            .filter(Q(end_date__gte=when) | Q(end_date__isnull=True))
+            .select_related('entry_type', 'fixedFee__currency')
+        )
+
+    def compute(self, agreement, accounts, rules, when):
+        # Retorna [(account_id, currency_id, entry_type, amount)] sem tocar no banco
+        daily_rate = Decimal(agreement.rate) / Decimal(100) / Decimal(self.days_in_year)
+        postings = []
+        for account_id, account in accounts.items():
+            balance = account['balance']
+            if balance > 0 and daily_rate:
+                interest = (balance * daily_rate).quantize(CENTS, rounding=ROUND_HALF_EVEN)
+                if interest:
+                    postings.append((account_id, account['currency_id'], self.interest_entry_type, interest))
+            for rule in rules:
+                fixed = rule.fixedFee.amount
+                if rule.fixedFee.currency_id != account['currency_id']:
+                    fixed = conversion_service().convert(fixed, rule.fixedFee.currency.code, account['currency'], when)
+                fee = (max(balance, Decimal('0.00')) * rule.multiplier + fixed).quantize(CENTS, rounding=ROUND_HALF_EVEN)
+                if fee:
+                    postings.append((account_id, account['currency_id'], rule.entry_type, -fee))
+        return postings
+
+    def post(self, postings, when):
+        for start in range(0, len(postings), self.batch_size):
+            chunk = postings[start:start + self.batch_size]
+            monies = Money.objects.bulk_create([Money(amount=amount, currency_id=currency_id) for _, currency_id, _, amount in chunk])
+            entries = Entry.objects.bulk_create([
+                Entry(account_id=account_id, entry_type=entry_type, amount=money, date=when, valid_date=when)
+                for (account_id, _, entry_type, _), money in zip(chunk, monies)
+            ])
+            OutboxMessage.objects.bulk_create([
+                OutboxMessage(topic=ENTRY_ACCRUED, entry_id=entry.id, payload={
+                    'entry_id': entry.id,
+                    'account_id': account_id,
+                    'entry_type': entry_type.name,
+                    'amount': str(amount),
+                    'currency_id': currency_id,
+                    'date': when.isoformat(),
+                })
+                for entry, (account_id, currency_id, entry_type, amount) in zip(entries, chunk)
+            ])
+            deltas = {}
+            for account_id, _, _, amount in chunk:
+                deltas[account_id] = deltas.get(account_id, Decimal('0.00')) + amount
+            AccountBalanceShard.apply_many(deltas)
+
+    def accrue_agreement(self, agreement_id):
+        agreement = ServiceAgreement.objects.get(id=agreement_id)
+        _, end = day_bounds(self.run_date)
+        when = end - datetime.timedelta(microseconds=1)
+        with memory_postings(), shard_atomic():
+            run, created = AccrualRun.objects.select_for_update().get_or_create(service_agreement=agreement, run_date=self.run_date)
+            if run.status == AccrualRun.DONE:
+                return run
+            accounts = self.balances(agreement_id, end)
+            postings = self.compute(agreement, accounts, self.fee_rules(agreement_id, when), when)
+            # Contas do razão em memória recebem juros e tarifas pelo motor (accounts/memledger.py)
+            self.post([p for p in postings if not accounts[p[0]]['memory_ledger']], when)
+            for account_id, currency_id, entry_type, amount in postings:
+                owner = accounts[account_id]['memory_ledger']
+                if owner:
+                    account = Account(id=account_id, currency_id=currency_id, memory_ledger=owner)
+                    # Tarifas são cobradas mesmo sem saldo, como nas contas sem o motor
+                    post_to_memory_ledger(account, entry_type, Money(amount=amount, currency_id=currency_id), when, None, allow_overdraft=True)
+            run.status = AccrualRun.DONE
+            run.accounts = len(accounts)
+            run.interest_total = sum((p[3] for p in postings if p[2] == self.interest_entry_type), Decimal('0.00'))
+            run.fee_total = sum((-p[3] for p in postings if p[2] != self.interest_entry_type), Decimal('0.00'))
+            run.finished_at = timezone.now()
+            run.save()
+        return run
+
+    def run(self, agreement_ids=None, workers=1):
+        if agreement_ids is None:
+            agreement_ids = list(ServiceAgreement.objects.values_list('id', flat=True))
+        done = set(AccrualRun.objects.filter(run_date=self.run_date, status=AccrualRun.DONE, service_agreement__in=agreement_ids).values_list('service_agreement', flat=True))
+        pending = [agreement_id for agreement_id in agreement_ids if agreement_id not in done]
+        if workers <= 1 or len(pending) <= 1:
+            return [self.accrue_agreement(agreement_id) for agreement_id in pending]
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            run_ids = pool.map(_accrue_in_worker, [(self, agreement_id) for agreement_id in pending])
+        return list(AccrualRun.objects.filter(id__in=run_ids))
+
+
+def _accrue_in_worker(args):
+    engine, agreement_id = args
+    try:
+        return engine.accrue_agreement(agreement_id).id
+    finally:
+        connections.close_all()
+
+
+def get_interest_entry_type(name='INTEREST'):
+    try:
+        return EntryType.objects.get(name=name)
+    except EntryType.DoesNotExist:
+        raise ValueError(f"Entry type '{name}' not found; create it before running accruals")
@@ -1,19 +1,68 @@
 # myapp/admin.py
 
-from django.contrib import admin
-from .models import Currency, Money, PostingRule, Account, AccountType, EntryType, Entry, AccountingEvent, EventType, Customer, ServiceAgreement, DepositoAE, DepositoPR
+from django.contrib import admin, messages
+from .models import Currency, Money, PostingRule, Account, AccountType, EntryType, Entry, AccountingEvent, EventType, Customer, ServiceAgreement, DepositoAE, DepositoPR, ExchangeRate
+from .paginators import EstimatedCountPaginator
+
+# Tamanho dos lotes usados pelas ações de processamento/estorno
+ACTION_BATCH_SIZE = 500
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    # Changelist para tabelas grandes: contagem estimada e sem o segundo COUNT(*) do total
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+
+def _run_batched(modeladmin, request, queryset, operation, label):
+    done = 0
+    errors = []
+    for event in queryset.select_related('customer__service_agreement', 'event_type').iterator(chunk_size=ACTION_BATCH_SIZE):
+        try:
+            operation(event.specific())
+            done += 1
+        except ValueError as e:
+            errors.append(f"#{event.id}: {e}")
+    modeladmin.message_user(request, f"{done} events {label}.", messages.SUCCESS)
+    if errors:
+        modeladmin.message_user(request, f"{len(errors)} failed: " + '; '.join(errors[:20]), messages.ERROR)
+
 
 @admin.register(AccountingEvent)
-class AccountingEventAdmin(admin.ModelAdmin):
-    list_display = ('event_type', 'customer')
+class AccountingEventAdmin(LargeTableAdmin):
+    list_display = ('id', 'event_type', 'customer', 'when_occurred', 'is_processed')
+    list_select_related = ('event_type', 'customer')
+    list_filter = ('is_processed', 'event_type')
+    date_hierarchy = 'when_occurred'
+    raw_id_fields = ('customer', 'adjusted_event', 'resulting_entries')
+    autocomplete_fields = ('event_type',)
+    actions = ('process_events', 'reverse_events')
+
+    @admin.action(description='Process selected events')
+    def process_events(self, request, queryset):
+        _run_batched(self, request, queryset.filter(is_processed=False), lambda event: event.process(), 'processed')
+
+    @admin.action(description='Reverse selected events')
+    def reverse_events(self, request, queryset):
+        _run_batched(self, request, queryset.filter(is_processed=True), lambda event: event.reverse(), 'reversed')
 
 @admin.register(Currency)
 class CurrencyAdmin(admin.ModelAdmin):
     list_display = ('code', 'name')
+    search_fields = ('code', 'name')
 
 @admin.register(Money)
-class MoneyAdmin(admin.ModelAdmin):
+class MoneyAdmin(LargeTableAdmin):
     list_display = ('amount', 'currency')
+    list_select_related = ('currency',)
+    autocomplete_fields = ('currency',)
+
+@admin.register(ExchangeRate)
+class ExchangeRateAdmin(admin.ModelAdmin):
+    list_display = ('from_currency', 'to_currency', 'rate', 'effective_date')
+    list_select_related = ('from_currency', 'to_currency')
+    autocomplete_fields = ('from_currency', 'to_currency')
 '''
 @admin.register(PostingRule)
 class PostingRuleAdmin(admin.ModelAdmin):
@@ -22,26 +71,40 @@ class PostingRuleAdmin(admin.ModelAdmin):
 @admin.register(Account)
 class AccountAdmin(admin.ModelAdmin):
     list_display = ('name', 'account_type', 'currency')
+    list_select_related = ('account_type', 'currency')
+    search_fields = ('name',)
+    autocomplete_fields = ('account_type', 'currency')
 
 @admin.register(AccountType)
 class AccountTypeAdmin(admin.ModelAdmin):
     list_display = ('name',)
+    search_fields = ('name',)
 
 @admin.register(EntryType)
 class EntryTypeAdmin(admin.ModelAdmin):
     list_display = ('name',)
+    search_fields = ('name',)
 
 @admin.register(Entry)
-class AccountAdmin(admin.ModelAdmin):
+class EntryAdmin(LargeTableAdmin):
     list_display = ('account', 'entry_type', 'amount', 'date')
+    # amount.__str__ usa a moeda, então ela também entra no JOIN
+    list_select_related = ('account', 'entry_type', 'amount__currency')
+    date_hierarchy = 'date'
+    raw_id_fields = ('amount',)
+    autocomplete_fields = ('account', 'entry_type')
 
 @admin.register(EventType)
 class EventTypeAdmin(admin.ModelAdmin):
     list_display = ('name',)
+    search_fields = ('name',)
 
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
     list_display = ('name', 'service_agreement',)
+    list_select_related = ('service_agreement',)
+    search_fields = ('name',)
+    raw_id_fields = ('accounts',)
 
 @admin.register(ServiceAgreement)
 class ServiceAgreementAdmin(admin.ModelAdmin):
@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'accounts'
+
+    def ready(self):
+        from .sharding import replicate_on_delete, replicate_on_save
+        post_save.connect(replicate_on_save, dispatch_uid='accounts.sharding.replicate_on_save')
+        post_delete.connect(replicate_on_delete, dispatch_uid='accounts.sharding.replicate_on_delete')
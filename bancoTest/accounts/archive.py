@@ -0,0 +1,109 @@
+from decimal import Decimal
+
+from .models import Account, AccountArchive, AccountingEvent, ArchivedEntry, Entry, EntryType, Money, conversion_service
+from .sharding import shard_atomic
+
+OPENING_BALANCE = 'OPENING_BALANCE'
+
+
+def opening_entry_type(account):
+    entry_type, _ = EntryType.objects.get_or_create(name=OPENING_BALANCE, defaults={'account_type': account.account_type})
+    return entry_type
+
+
+def in_account_currency(amount, code, account_code, date):
+    # Valor de uma entrada arquivada na moeda da conta, na taxa da data da entrada
+    if code == account_code:
+        return amount
+    return conversion_service().convert(amount, code, account_code, date)
+
+
+def archive_account(account, cutoff, batch_size=1000):
+    """Move as entradas da conta anteriores a `cutoff` para ArchivedEntry.
+
+    No lugar delas fica uma única entrada de saldo de abertura datada em `cutoff`,
+    de modo que Account.balance() sem data continua somando só accounts_entry.
+    Retorna o número de entradas arquivadas.
+    """
+    with shard_atomic():
+        archive = AccountArchive.objects.select_for_update().filter(account=account).first()
+        if archive is not None and archive.archived_until >= cutoff:
+            return 0
+
+        entries = (
+            account.entries.filter(date__lt=cutoff, is_opening_balance=False)
+            .order_by('date', 'id')
+            .values_list('id', 'entry_type_id', 'amount__amount', 'amount__currency_id', 'amount__currency__code', 'date', 'valid_date', 'recorded_at')
+        )
+        through = AccountingEvent.resulting_entries.through
+
+        opening = Decimal('0.00')
+        if archive is not None and archive.opening_entry_id:
+            opening = archive.opening_entry.amount.amount
+
+        archived_ids = []
+        rows = list(entries)
+        for start in range(0, len(rows), batch_size):
+            chunk = rows[start:start + batch_size]
+            ids = [row[0] for row in chunk]
+            event_ids = {}
+            for entry_id, event_id in through.objects.filter(entry_id__in=ids).values_list('entry_id', 'accountingevent_id'):
+                event_ids.setdefault(entry_id, []).append(event_id)
+            batch = []
+            for entry_id, entry_type_id, amount, currency_id, code, date, valid_date, recorded_at in chunk:
+                batch.append(ArchivedEntry(
+                    original_id=entry_id,
+                    account=account,
+                    entry_type_id=entry_type_id,
+                    amount=amount,
+                    currency_id=currency_id,
+                    date=date,
+                    period=date.strftime('%Y-%m'),
+                    valid_date=valid_date,
+                    recorded_at=recorded_at,
+                ))
+                opening += in_account_currency(amount, code, account.currency.code, date)
+            ArchivedEntry.objects.bulk_create(batch)
+            # O vínculo evento -> entrada passa para ArchivedEntry.events antes de a entrada sair,
+            # para que AccountingEvent.reverse() ainda encontre as pernas arquivadas
+            ArchivedEntry.events.through.objects.bulk_create([
+                ArchivedEntry.events.through(archivedentry_id=archived.id, accountingevent_id=event_id)
+                for archived in batch for event_id in event_ids.get(archived.original_id, [])
+            ])
+            Entry.objects.filter(id__in=ids).delete()
+            archived_ids += ids
+
+        if not archived_ids and archive is not None:
+            archive.archived_until = cutoff
+            archive.save(update_fields=['archived_until'])
+            return 0
+
+        old_opening = archive.opening_entry if archive is not None else None
+        opening_entry = Entry.objects.create(
+            account=account,
+            entry_type=opening_entry_type(account),
+            amount=Money.objects.create(amount=opening, currency=account.currency),
+            date=cutoff,
+            is_opening_balance=True,
+        )
+        if archive is None:
+            AccountArchive.objects.create(account=account, archived_until=cutoff, opening_entry=opening_entry)
+        else:
+            archive.archived_until = cutoff
+            archive.opening_entry = opening_entry
+            archive.save(update_fields=['archived_until', 'opening_entry'])
+        if old_opening is not None:
+            old_opening.delete()
+        return len(archived_ids)
+
+
+def archive_entries(cutoff, accounts=None, batch_size=1000):
+    # Arquiva todas as contas com entradas anteriores ao corte; retorna {account_id: arquivadas}
+    candidates = Entry.objects.filter(date__lt=cutoff, is_opening_balance=False)
+    if accounts is not None:
+        candidates = candidates.filter(account__in=accounts)
+    account_ids = candidates.values_list('account', flat=True).distinct()
+    results = {}
+    for account in Account.objects.filter(id__in=list(account_ids)).select_related('currency'):
+        results[account.id] = archive_account(account, cutoff, batch_size=batch_size)
+    return results
@@ -0,0 +1,89 @@
+from bisect import bisect_right
+from decimal import Decimal, ROUND_HALF_EVEN
+
+from django.utils import timezone
+
+from .models import ExchangeRate
+
+CENTS = Decimal('0.01')
+
+
+class ConversionService:
+    """Tabela de câmbio em memória, indexada por par de moedas e data de vigência.
+
+    Todas as taxas são carregadas numa única consulta; cada conversão é apenas
+    uma busca binária na lista ordenada de datas do par.
+    """
+
+    def __init__(self, rates=None):
+        self._dates = {}
+        self._rates = {}
+        if rates is None:
+            rates = ExchangeRate.objects.order_by('effective_date').values_list(
+                'from_currency__code', 'to_currency__code', 'effective_date', 'rate'
+            )
+        self.load(rates)
+
+    def load(self, rates):
+        pairs = {}
+        for from_code, to_code, effective_date, rate in rates:
+            pairs.setdefault((from_code, to_code), []).append((effective_date, Decimal(rate)))
+        for pair, items in pairs.items():
+            items.sort(key=lambda item: item[0])
+            self._dates[pair] = [item[0] for item in items]
+            self._rates[pair] = [item[1] for item in items]
+
+    def _lookup(self, pair, date):
+        dates = self._dates.get(pair)
+        if not dates:
+            return None
+        index = bisect_right(dates, date) - 1
+        if index < 0:
+            return None
+        return self._rates[pair][index]
+
+    def rate(self, from_code, to_code, date=None):
+        if from_code == to_code:
+            return Decimal('1')
+        if date is None:
+            date = timezone.now()
+        rate = self._lookup((from_code, to_code), date)
+        if rate is not None:
+            return rate
+        inverse = self._lookup((to_code, from_code), date)
+        if inverse:
+            return Decimal('1') / inverse
+        raise ValueError(f"No exchange rate for {from_code}/{to_code} at {date}")
+
+    def convert(self, amount, from_code, to_code, date=None):
+        if from_code == to_code:
+            return amount
+        converted = Decimal(amount) * self.rate(from_code, to_code, date)
+        return converted.quantize(CENTS, rounding=ROUND_HALF_EVEN)
+
+    def convert_many(self, items, to_code, date=None):
+        # items: iterável de (amount, currency_code) ou (amount, currency_code, date)
+        results = []
+        for item in items:
+            amount, from_code = item[0], item[1]
+            when = item[2] if len(item) > 2 else date
+            results.append(self.convert(amount, from_code, to_code, when))
+        return results
+
+    def total(self, items, to_code, date=None):
+        return sum(self.convert_many(items, to_code, date), Decimal('0.00'))
+
+
+_service = None
+
+
+def get_conversion_service():
+    global _service
+    if _service is None:
+        _service = ConversionService()
+    return _service
+
+
+def invalidate_rates():
+    global _service
+    _service = None
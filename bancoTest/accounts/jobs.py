@@ -0,0 +1,159 @@
+import os
+import random
+import socket
+import time
+import uuid
+
+from django.db import connections
+from django.db.models import Count, Min, Q
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .models import AccountingEvent, EventJob
+from .sharding import current_shard, shard_atomic
+
+# Enviado quando um job sai da fila: succeeded=True (DONE) ou False (DEAD). O app transaction usa
+# para encerrar a Transaction da qual o evento veio (ver transaction/apps.py).
+job_finished = Signal()
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class EventQueue:
+    """Fila de eventos contábeis persistida em EventJob.
+
+    Cada worker reivindica um lote de jobs prontos (QUEUED com available_at vencido,
+    ou RUNNING com lease expirado). Em bancos com SKIP LOCKED o lote é travado com
+    SELECT ... FOR UPDATE SKIP LOCKED; no SQLite a reivindicação é um UPDATE
+    condicional que grava um lease_token único, seguido da leitura pelo token.
+    Falhas são reenfileiradas com backoff exponencial até max_attempts, depois
+    vão para DEAD (dead letter).
+    """
+
+    def __init__(self, worker_id=None, lease_seconds=60, max_attempts=5, backoff_seconds=2.0, max_backoff_seconds=3600):
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.first_job_at = None
+
+    def enqueue(self, events):
+        jobs = [EventJob(event_id=e.id if isinstance(e, AccountingEvent) else e) for e in events]
+        return EventJob.objects.bulk_create(jobs, ignore_conflicts=True)
+
+    def enqueue_unprocessed(self):
+        # Enfileira todos os eventos não processados que ainda não têm job
+        ids = list(AccountingEvent.objects.filter(is_processed=False, job__isnull=True).values_list('id', flat=True))
+        self.enqueue(ids)
+        return len(ids)
+
+    def _ready(self, now):
+        return Q(status=EventJob.QUEUED, available_at__lte=now) | Q(status=EventJob.RUNNING, leased_until__lt=now)
+
+    def claim(self, batch_size=100):
+        now = timezone.now()
+        token = uuid.uuid4().hex
+        lease = {
+            'status': EventJob.RUNNING,
+            'leased_until': now + timezone.timedelta(seconds=self.lease_seconds),
+            'lease_token': token,
+            'worker': self.worker_id,
+        }
+        if connections[current_shard()].features.has_select_for_update_skip_locked:
+            with shard_atomic():
+                ids = list(
+                    EventJob.objects.select_for_update(skip_locked=True)
+                    .filter(self._ready(now))
+                    .order_by('available_at')
+                    .values_list('id', flat=True)[:batch_size]
+                )
+                EventJob.objects.filter(id__in=ids).update(**lease)
+        else:
+            candidates = list(
+                EventJob.objects.filter(self._ready(now)).order_by('available_at').values_list('id', flat=True)[:batch_size]
+            )
+            # A condição é reavaliada no UPDATE: se outro worker levou o job antes, ele é ignorado
+            EventJob.objects.filter(self._ready(now), id__in=candidates).update(**lease)
+        return list(EventJob.objects.filter(lease_token=token).select_related('event').order_by('available_at'))
+
+    def complete(self, job):
+        updated = EventJob.objects.filter(id=job.id, lease_token=job.lease_token).update(
+            status=EventJob.DONE, finished_at=timezone.now(), leased_until=None, attempts=job.attempts + 1
+        )
+        if updated:
+            job_finished.send(sender=EventQueue, event=job.event, succeeded=True, error=None)
+
+    def fail(self, job, error):
+        attempts = job.attempts + 1
+        fields = {'attempts': attempts, 'last_error': str(error), 'leased_until': None}
+        dead = attempts >= self.max_attempts
+        if dead:
+            fields.update(status=EventJob.DEAD, finished_at=timezone.now())
+        else:
+            delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (attempts - 1))
+            delay *= random.uniform(0.5, 1.0)
+            fields.update(status=EventJob.QUEUED, available_at=timezone.now() + timezone.timedelta(seconds=delay))
+        updated = EventJob.objects.filter(id=job.id, lease_token=job.lease_token).update(**fields)
+        if dead and updated:
+            job_finished.send(sender=EventQueue, event=job.event, succeeded=False, error=str(error))
+
+    def run_job(self, job):
+        event = job.event.specific()
+        try:
+            event.process()
+        except ValueError as e:
+            if event.is_processed:
+                # Já processado por outro caminho: nada a refazer
+                self.complete(job)
+                return True
+            self.fail(job, e)
+            return False
+        except Exception as e:
+            self.fail(job, repr(e))
+            return False
+        self.complete(job)
+        return True
+
+    def work(self, batch_size=100, max_batches=None, follow=False, poll_interval=1.0, max_jobs=None):
+        # max_jobs limita os jobs desta chamada (reciclagem de workers); first_job_at marca o primeiro concluído
+        processed = failed = batches = 0
+        while max_batches is None or batches < max_batches:
+            if max_jobs is not None:
+                if processed + failed >= max_jobs:
+                    break
+                batch_size = min(batch_size, max_jobs - processed - failed)
+            jobs = self.claim(batch_size)
+            batches += 1
+            if not jobs:
+                if not follow:
+                    break
+                time.sleep(poll_interval)
+                continue
+            for job in jobs:
+                if self.run_job(job):
+                    processed += 1
+                else:
+                    failed += 1
+                if self.first_job_at is None:
+                    self.first_job_at = time.time()
+        return processed, failed
+
+
+def queue_metrics():
+    now = timezone.now()
+    counts = dict(EventJob.objects.values_list('status').annotate(n=Count('id')))
+    oldest = EventJob.objects.filter(status=EventJob.QUEUED, available_at__lte=now).aggregate(
+        oldest=Min('event__when_noticed'), ready_since=Min('available_at')
+    )
+    return {
+        'depth': counts.get(EventJob.QUEUED, 0),
+        'running': counts.get(EventJob.RUNNING, 0),
+        'done': counts.get(EventJob.DONE, 0),
+        'dead': counts.get(EventJob.DEAD, 0),
+        'ready': EventJob.objects.filter(status=EventJob.QUEUED, available_at__lte=now).count(),
+        'lag_seconds': (now - oldest['oldest']).total_seconds() if oldest['oldest'] else 0.0,
+        'wait_seconds': (now - oldest['ready_since']).total_seconds() if oldest['ready_since'] else 0.0,
+    }
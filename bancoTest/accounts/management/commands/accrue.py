@@ -0,0 +1,36 @@
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from bancoTest.profiling import ProfiledCommand
+from accounts.accrual import AccrualEngine, get_interest_entry_type
+from accounts.sharding import each_shard
+
+
+class Command(ProfiledCommand):
+    help = 'Post daily interest and fees for every account under each service agreement'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Run date (YYYY-MM-DD); defaults to yesterday')
+        parser.add_argument('--agreement', type=int, action='append', dest='agreements', help='Restrict to these agreement ids')
+        parser.add_argument('--interest-entry-type', default='INTEREST')
+        parser.add_argument('--fee-event-type', default='FEE', help='Event type of the AmountAdd rules used as daily fees')
+        parser.add_argument('--workers', type=int, default=1, help='Agreements processed in parallel')
+        parser.add_argument('--days-in-year', type=int, default=365)
+
+    def handle(self, *args, **options):
+        run_date = parse_date(options['date']) if options['date'] else timezone.localdate() - timezone.timedelta(days=1)
+        if run_date is None:
+            raise CommandError(f"Invalid date: {options['date']}")
+        try:
+            entry_type = get_interest_entry_type(options['interest_entry_type'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        runs = []
+        for alias in each_shard():
+            engine = AccrualEngine(run_date, entry_type, fee_event_type=options['fee_event_type'], days_in_year=options['days_in_year'])
+            for run in engine.run(options['agreements'], workers=options['workers']):
+                self.stdout.write(f"[{alias}] Agreement {run.service_agreement_id}: {run.accounts} accounts, interest {run.interest_total}, fees {run.fee_total}")
+                runs.append(run)
+        self.stdout.write(f"{len(runs)} agreements accrued for {run_date}")
@@ -0,0 +1,32 @@
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from bancoTest.profiling import ProfiledCommand
+from accounts.archive import archive_entries
+from accounts.sharding import each_shard
+
+
+class Command(ProfiledCommand):
+    help = 'Move entries older than a cutoff to the archive tier, leaving an opening-balance entry per account'
+
+    def add_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument('--before', help='Cutoff datetime (ISO 8601); entries strictly before it are archived')
+        group.add_argument('--older-than-days', type=int)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['before']:
+            cutoff = parse_datetime(options['before'])
+            if cutoff is None:
+                raise CommandError(f"Invalid datetime: {options['before']}")
+            if timezone.is_naive(cutoff):
+                cutoff = timezone.make_aware(cutoff)
+        else:
+            cutoff = timezone.now() - timezone.timedelta(days=options['older_than_days'])
+
+        results = [archive_entries(cutoff, batch_size=options['batch_size']) for _ in each_shard()]
+        archived = sum(n for result in results for n in result.values())
+        accounts = sum(len(result) for result in results)
+        self.stdout.write(f"Archived {archived} entries from {accounts} accounts before {cutoff.isoformat()}")
@@ -0,0 +1,58 @@
+import multiprocessing
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+from django.utils import timezone
+
+from accounts.models import AccountBalanceShard, AccountDayDigest
+from bancoTest.bench import benchmark_database, seed_bank
+
+
+def _writer(account_id, shards, postings, offset):
+    # Cada posting é uma transação curta que atualiza as linhas que uma postagem toca na conta:
+    # um fragmento do saldo e uma linha do digest do dia
+    retries = 0
+    try:
+        for index in range(postings):
+            row = (account_id, offset + index, timezone.now(), Decimal('1.00'), 1, 1)
+            while True:
+                try:
+                    with transaction.atomic():
+                        AccountBalanceShard.add(account_id, shards, Decimal('1.00'))
+                        AccountDayDigest.record([row], shards={account_id: shards})
+                    break
+                except OperationalError:
+                    retries += 1
+                    time.sleep(0.001)
+    finally:
+        connections.close_all()
+    return retries
+
+
+class Command(BaseCommand):
+    help = 'Contention benchmark: concurrent postings to one hot account with and without balance sharding'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--postings', type=int, default=500, help='Postings per writer')
+        parser.add_argument('--shards', type=int, default=16)
+
+    def handle(self, *args, **options):
+        writers, postings = options['writers'], options['postings']
+        with benchmark_database(on_disk=True):
+            ((_, account),) = seed_bank(customers=1)
+            for shards in (1, options['shards']):
+                account.make_hot(shards=shards)
+                connections.close_all()
+                start = time.perf_counter()
+                with multiprocessing.get_context('fork').Pool(writers) as pool:
+                    retries = sum(pool.starmap(_writer, [(account.id, shards, postings, i * postings) for i in range(writers)]))
+                elapsed = time.perf_counter() - start
+                total = writers * postings
+                balance = account.compact_shards()
+                self.stdout.write(
+                    f"shards={shards:3d}: {total} postings by {writers} writers in {elapsed:.3f}s "
+                    f"({total / elapsed:,.0f}/s, {retries} lock retries), balance {balance}"
+                )
@@ -0,0 +1,115 @@
+import contextlib
+import multiprocessing
+import os
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from bancoTest.bench import benchmark_database, seed_bank
+
+# Este módulo é importado pelos processos "spawn" antes do django.setup(): nada de modelos no topo
+
+
+def _quiet():
+    # process() imprime o rastreio da regra; silencia para não medir o terminal
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+
+def _drain(max_jobs=None):
+    from accounts.jobs import EventQueue
+    queue = EventQueue()
+    with _quiet():
+        processed, failed = queue.work(batch_size=10, max_jobs=max_jobs)
+    return processed, failed, queue.first_job_at
+
+
+def _cold_worker(db_name, spawned_at, results):
+    # Equivale a um `manage.py process_events` novo: interpretador, setup e caches frios
+    import django
+    django.setup()
+    from accounts.jobs import EventQueue  # noqa: F401 (importado como o comando importaria)
+    connections['default'].settings_dict['NAME'] = db_name
+    ready_at = time.time()
+    try:
+        processed, failed, first_job_at = _drain()
+    finally:
+        connections.close_all()
+    results.put((spawned_at, ready_at, first_job_at, processed, failed))
+
+
+def _enqueue(pairs, events):
+    from accounts.jobs import EventQueue
+    from accounts.models import EventType, Money
+    from django.utils import timezone
+    from transaction.models import DepositEvent
+
+    event_type = EventType.objects.get(name='DEPOSIT')
+    now = timezone.now()
+    created = []
+    for i in range(events):
+        customer, account = pairs[i % len(pairs)]
+        money = Money.objects.create(amount='1.00', currency_id=account.currency_id)
+        created.append(DepositEvent.objects.create(
+            event_type=event_type, when_occurred=now, when_noticed=now, customer=customer, account=account, amount=money
+        ))
+    EventQueue().enqueue(created)
+
+
+def _summary(values):
+    if not values:
+        return '-'
+    return f"avg {statistics.mean(values):7.1f} ms, max {max(values):7.1f} ms"
+
+
+class Command(BaseCommand):
+    help = 'Worker startup benchmark: fresh interpreters vs prefork children with warmed caches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--events', type=int, default=400)
+        parser.add_argument('--max-jobs-per-child', type=int, help='Recycle prefork children after this many jobs')
+
+    def handle(self, *args, **options):
+        from bancoTest.prefork import PreforkRunner
+
+        workers, events = options['workers'], options['events']
+        with benchmark_database(on_disk=True):
+            pairs = seed_bank(customers=workers * 2)
+            db_name = connection.settings_dict['NAME']
+
+            _enqueue(pairs, events)
+            connections.close_all()
+            context = multiprocessing.get_context('spawn')
+            results = context.SimpleQueue()
+            start = time.perf_counter()
+            processes = [context.Process(target=_cold_worker, args=(db_name, time.time(), results)) for _ in range(workers)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            cold_elapsed = time.perf_counter() - start
+            rows = [results.get() for _ in range(workers) if not results.empty()]
+            cold = {
+                'processed': sum(row[3] for row in rows),
+                'child_start_ms': [(row[1] - row[0]) * 1000 for row in rows],
+                'first_event_ms': [(row[2] - row[0]) * 1000 for row in rows if row[2] is not None],
+            }
+
+            _enqueue(pairs, events)
+            start = time.perf_counter()
+            warm = PreforkRunner(lambda index, max_jobs: _drain(max_jobs), workers=workers,
+                                 max_jobs=options['max_jobs_per_child']).run()
+            warm_elapsed = time.perf_counter() - start
+
+        for name, report, elapsed in (('fresh', cold, cold_elapsed), ('prefork', warm, warm_elapsed)):
+            self.stdout.write(
+                f"{name:<8} {report['processed']:5d} events in {elapsed:6.2f}s ({report['processed'] / elapsed:7.1f}/s)  "
+                f"start {_summary(report['child_start_ms'])}  first event {_summary(report['first_event_ms'])}"
+            )
+        self.stdout.write(
+            f"prefork parent: warm-up {warm['warm']['seconds'] * 1000:.1f} ms "
+            f"({warm['warm']['posting_rules']} rules, {warm['warm']['rate_pairs']} rate pairs), "
+            f"{warm['children']} children, {warm['crashed']} crashed"
+        )
@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from accounts.models import Account, EventType, Money
+from accounts.sharding import replicate_reference_data, use_shard
+from bancoTest.bench import benchmark_database, seed_bank
+from transaction.models import DepositEvent
+
+
+def _add_databases(directory, aliases):
+    new = {alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory, f'{alias}.sqlite3')} for alias in aliases}
+    connections.settings = connections.configure_settings({**connections.settings, **new})
+    for alias in aliases:
+        call_command('migrate', database=alias, verbosity=0)
+
+
+def _writer(aliases, accounts, postings):
+    # accounts: [(alias, account_id)]; cada posting é um depósito processado pelo caminho normal
+    with override_settings(LEDGER_SHARDS=aliases):
+        retries = 0
+        try:
+            for i in range(postings):
+                alias, account_id = accounts[i % len(accounts)]
+                with use_shard(alias):
+                    account = Account.objects.get(id=account_id)
+                    deposit_type = EventType.objects.get(name='DEPOSIT')
+                    while True:
+                        try:
+                            now = timezone.now()
+                            DepositEvent.objects.create(
+                                event_type=deposit_type,
+                                when_occurred=now,
+                                when_noticed=now,
+                                customer=account.customer_set.get(),
+                                account=account,
+                                amount=Money.objects.create(amount=Decimal('1.00'), currency_id=account.currency_id),
+                            ).process()
+                            break
+                        except OperationalError:
+                            retries += 1
+                            time.sleep(0.001)
+        finally:
+            connections.close_all()
+        return retries
+
+
+class Command(BaseCommand):
+    help = 'Write scaling benchmark: postings on one SQLite shard vs. spread over N shard files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', type=int, default=4)
+        parser.add_argument('--postings', type=int, default=300, help='Postings per writer (one writer per shard)')
+        parser.add_argument('--customers', type=int, default=16)
+
+    def handle(self, *args, **options):
+        shards, postings = options['shards'], options['postings']
+        directory = tempfile.mkdtemp(prefix='bench-shards-')
+        try:
+            self.run_benchmark(directory, shards, postings, options['customers'])
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def run_benchmark(self, directory, shards, postings, customers):
+        with benchmark_database(on_disk=True):
+            baseline = None
+            for label, count in [('1 shard', 1), (f'{shards} shards', shards)]:
+                aliases = [f'bench{count}_{i}' for i in range(count)]
+                _add_databases(directory, aliases)
+                with override_settings(LEDGER_SHARDS=aliases):
+                    replicate_reference_data(aliases)
+                    seeded = [(account._state.db, account.id) for _, account in seed_bank(customers=customers)]
+                # Um writer por shard do cenário particionado; no de 1 shard todos disputam o mesmo arquivo
+                groups = [[a for a in seeded if a[0] == alias] for alias in aliases] if count > 1 else [
+                    seeded[i::shards] for i in range(shards)
+                ]
+                connections.close_all()
+                start = time.perf_counter()
+                with multiprocessing.get_context('fork').Pool(shards) as pool:
+                    retries = sum(pool.starmap(_writer, [(aliases, group, postings) for group in groups]))
+                elapsed = time.perf_counter() - start
+                total = shards * postings
+                baseline = baseline or elapsed
+                self.stdout.write(
+                    f"{label:>10}: {total} postings by {shards} writers in {elapsed:.3f}s "
+                    f"({total / elapsed:,.0f}/s, {retries} lock retries, speedup {baseline / elapsed:.2f}x)"
+                )
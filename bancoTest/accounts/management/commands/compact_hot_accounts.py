@@ -0,0 +1,14 @@
+from bancoTest.profiling import ProfiledCommand
+from accounts.models import Account
+
+
+class Command(ProfiledCommand):
+    help = 'Fold the balance shards of hot accounts into a single shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resync', action='store_true', help='Recompute the total from the entries')
+
+    def handle(self, *args, **options):
+        for account in Account.objects.filter(is_hot=True).select_related('currency'):
+            total = account.compact_shards(resync=options['resync'])
+            self.stdout.write(f"{account}: {total} {account.currency.code}")
@@ -0,0 +1,27 @@
+from django.core.management.base import CommandError
+
+from bancoTest.profiling import ProfiledCommand
+from accounts.outbox import OutboxDispatcher, get_sink
+from accounts.sharding import use_shard
+
+
+class Command(ProfiledCommand):
+    help = 'Stream outbox messages (posted and reversed entries) to a sink in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', required=True, help='Consumer name; its offset is stored in OutboxConsumer')
+        parser.add_argument('--sink', required=True, help='file:<path>, unix:<socket path> or queue:<name>')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--follow', action='store_true', help='Keep polling for new messages')
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--shard', default=None, help='Ledger shard alias whose outbox is dispatched (see LEDGER_SHARDS)')
+
+    def handle(self, *args, **options):
+        try:
+            sink = get_sink(options['sink'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        with use_shard(options['shard']):
+            dispatcher = OutboxDispatcher(options['consumer'], sink, batch_size=options['batch_size'])
+            sent = dispatcher.run(follow=options['follow'], poll_interval=options['poll_interval'])
+        self.stdout.write(f"Dispatched {sent} messages to {options['sink']}")
@@ -0,0 +1,27 @@
+import os
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from bancoTest.profiling import ProfiledCommand
+from bancoTest.snapshot import export_snapshot
+
+
+class Command(ProfiledCommand):
+    help = 'Write a columnar binary snapshot of the accounts and transaction tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        header = export_snapshot(options['path'], using=options['database'], chunk_size=options['chunk_size'])
+        elapsed = time.perf_counter() - start
+        rows = sum(table['rows'] for table in header['tables'])
+        size = os.path.getsize(options['path'])
+        self.stdout.write(
+            f"Exported {rows} rows from {len(header['tables'])} tables to {options['path']} "
+            f"({size / 1024:,.0f} KiB) in {elapsed:.2f}s"
+        )
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from bancoTest.profiling import ProfiledCommand
+from bancoTest.snapshot import import_snapshot
+
+
+class Command(ProfiledCommand):
+    help = 'Restore a snapshot written by export_snapshot (memory-mapped, loaded in chunks)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--replace', action='store_true', help='Delete the current contents of the tables first')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            loaded = import_snapshot(options['path'], using=options['database'],
+                                     chunk_size=options['chunk_size'], replace=options['replace'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        elapsed = time.perf_counter() - start
+        rows = sum(loaded.values())
+        self.stdout.write(f"Imported {rows} rows into {len(loaded)} tables in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s)")
@@ -0,0 +1,34 @@
+import json
+
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from bancoTest.profiling import ProfiledCommand
+from accounts.reports import LedgerReport, period_key
+
+
+class Command(ProfiledCommand):
+    help = 'Trial balance or general-ledger summary by account type, entry type, currency and month'
+
+    def add_arguments(self, parser):
+        parser.add_argument('report', choices=['trial-balance', 'gl'])
+        parser.add_argument('--from', dest='first', help='First month (YYYY-MM) of the GL; defaults to --to')
+        parser.add_argument('--to', dest='last', help='Last month (YYYY-MM); defaults to the current month')
+        parser.add_argument('--workers', type=int, default=1, help='Processes computing month partitions')
+        parser.add_argument('--refresh', action='store_true', help='Recompute closed months instead of using the cache')
+
+    def handle(self, *args, **options):
+        last = options['last'] or period_key(timezone.now())
+        first = options['first'] or last
+        for period in (first, last):
+            if (len(period) != 7 or period[4] != '-' or not (period[:4] + period[5:]).isdigit()
+                    or not 1 <= int(period[5:]) <= 12):
+                raise CommandError(f"Invalid month '{period}', expected YYYY-MM")
+        if first > last:
+            raise CommandError(f"--from {first} is after --to {last}")
+        report = LedgerReport(workers=options['workers'], refresh=options['refresh'])
+        if options['report'] == 'gl':
+            result = report.general_ledger(first, last)
+        else:
+            result = report.trial_balance(last)
+        self.stdout.write(json.dumps(result, indent=2, default=str))
@@ -0,0 +1,69 @@
+import json
+
+from bancoTest.prefork import PreforkRunner
+from bancoTest.profiling import ProfiledCommand
+from accounts.jobs import EventQueue, default_worker_id, queue_metrics
+from accounts.sharding import each_shard, is_sharded, shard_aliases, use_shard
+
+
+def _metrics():
+    if not is_sharded():
+        return queue_metrics()
+    return {alias: queue_metrics() for alias in each_shard()}
+
+
+def _work(options, index, max_jobs=None):
+    # Com o razão particionado cada worker atende a fila de um shard
+    aliases = shard_aliases()
+    with use_shard(aliases[index % len(aliases)]):
+        return _work_shard(options, index, max_jobs)
+
+
+def _work_shard(options, index, max_jobs=None):
+    queue = EventQueue(
+        worker_id=f"{default_worker_id()}#{index}",
+        lease_seconds=options['lease_seconds'],
+        max_attempts=options['max_attempts'],
+        backoff_seconds=options['backoff_seconds'],
+    )
+    processed, failed = queue.work(
+        batch_size=options['batch_size'], follow=options['follow'], poll_interval=options['poll_interval'], max_jobs=max_jobs
+    )
+    return processed, failed, queue.first_job_at
+
+
+class Command(ProfiledCommand):
+    help = 'Process queued AccountingEvents with one or more worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--lease-seconds', type=int, default=60)
+        parser.add_argument('--max-attempts', type=int, default=5)
+        parser.add_argument('--backoff-seconds', type=float, default=2.0)
+        parser.add_argument('--follow', action='store_true', help='Keep polling for new jobs')
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--enqueue-unprocessed', action='store_true', help='Create jobs for unprocessed events first')
+        parser.add_argument('--stats', action='store_true', help='Only print queue depth and lag metrics')
+        parser.add_argument('--max-jobs-per-child', type=int, help='Recycle a worker process after this many jobs')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(_metrics(), indent=2))
+            return
+        if options['enqueue_unprocessed']:
+            enqueued = sum(EventQueue().enqueue_unprocessed() for _ in each_shard())
+            self.stdout.write(f"Enqueued {enqueued} events")
+
+        workers = max(options['workers'], len(shard_aliases()))
+        if workers <= 1 and not options['max_jobs_per_child']:
+            processed, failed, _ = _work(options, 0)
+        else:
+            # Filhos criados com fork a partir de um pai com os caches de referência carregados
+            runner = PreforkRunner(lambda index, max_jobs: _work(options, index, max_jobs),
+                                   workers=workers, max_jobs=options['max_jobs_per_child'])
+            report = runner.run()
+            processed, failed = report['processed'], report['failed']
+            self.stdout.write(json.dumps(report))
+        self.stdout.write(f"Processed {processed} events, {failed} failures")
+        self.stdout.write(json.dumps(_metrics()))
@@ -0,0 +1,34 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from bancoTest.profiling import ProfiledCommand
+from accounts.models import AccountDayDigest
+from accounts.reconcile import reconcile
+
+
+class Command(ProfiledCommand):
+    help = 'Check ledger integrity and diff account digests between the primary and a replica or backup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default', help='Primary database alias')
+        parser.add_argument('--against', help='Replica/backup database alias to diff against')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--partition-size', type=int, default=500, help='Accounts per digest partition')
+        parser.add_argument('--rebuild-digests', action='store_true',
+                            help='Recompute the stored per-day digests from the entries first (e.g. after restoring a backup)')
+
+    def handle(self, *args, **options):
+        for alias in filter(None, [options['database'], options['against']]):
+            if alias not in settings.DATABASES:
+                raise CommandError(f"Unknown database alias '{alias}'")
+        if options['rebuild_digests']:
+            for alias in filter(None, [options['database'], options['against']]):
+                days = AccountDayDigest.rebuild(using=alias)
+                self.stderr.write(f"Rebuilt {days} account-day digests on '{alias}'")
+        report = reconcile(options['database'], options['against'], workers=options['workers'], partition_size=options['partition_size'])
+        self.stdout.write(json.dumps(report, indent=2, default=str))
+        problems = sum(len(v) for v in report.values())
+        if problems:
+            raise CommandError(f"Reconciliation found {problems} problems")
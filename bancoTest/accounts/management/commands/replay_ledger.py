@@ -0,0 +1,41 @@
+import json
+
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from bancoTest.profiling import ProfiledCommand
+from accounts.replay import ReplayEngine
+from accounts.sharding import each_shard
+
+
+def _parse(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise CommandError(f"Invalid datetime: {value}")
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+class Command(ProfiledCommand):
+    help = 'Rebuild the entries of processed events in a time range from the event history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', required=True, help='Events with when_occurred >= start (ISO 8601)')
+        parser.add_argument('--end', required=True, help='Events with when_occurred < end (ISO 8601)')
+        parser.add_argument('--customer', type=int, action='append', dest='customers')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--dry-run', action='store_true', help='Only build the shadow entries and the diff report')
+
+    def handle(self, *args, **options):
+        for alias in each_shard():
+            engine = ReplayEngine(
+                _parse(options['start']),
+                _parse(options['end']),
+                customer_ids=options['customers'],
+                workers=options['workers'],
+                batch_size=options['batch_size'],
+            )
+            rebuild = engine.run(swap=not options['dry_run'])
+            self.stdout.write(json.dumps(rebuild.report, indent=2))
+            self.stdout.write(f"[{alias}] Rebuild {rebuild.id}: {rebuild.status}")
@@ -0,0 +1,21 @@
+import json
+
+from django.core.management.base import CommandError
+
+from bancoTest.profiling import ProfiledCommand
+from accounts.sharding import is_sharded, replicate_reference_data
+from transaction.transfers import recover_transfers
+
+
+class Command(ProfiledCommand):
+    help = 'Copy reference data to the ledger shards and finish interrupted cross-shard transfers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', action='append', dest='shards', help='Only these shard aliases')
+        parser.add_argument('--older-than', type=int, default=60, help='Seconds before a PREPARED transfer is resolved')
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError('LEDGER_SHARDS is empty; the ledger is not sharded')
+        self.stdout.write(f"Replicated {replicate_reference_data(options['shards'])} reference rows")
+        self.stdout.write(json.dumps(recover_transfers(options['older_than'])))
@@ -0,0 +1,534 @@
+# Razão em memória para postagens de baixa latência.
+#
+# O motor é dono das contas com Account.memory_ledger igual ao seu nome: os saldos delas ficam
+# num array de centavos (um slot por conta) carregado das Entry na partida, e as postagens de
+# eventos nessas contas (PostingRule.make_entry, estornos) são desviadas para ele. Um lease em
+# LedgerJournal garante um único motor por journal entre processos; depois de uma queda, o
+# próximo motor só parte quando o lease expira. Cada postagem é validada (saldo conferido sob o
+# lock do motor), anexada a um journal local com fsync e aplicada em memória antes de retornar;
+# um writer em segundo plano grava as postagens pendentes em lote nas tabelas
+# Money/Entry/OutboxMessage e avança LedgerJournal.last_seq na mesma transação.
+#
+# As postagens de eventos (post_money) são feitas dentro da transação do evento, antes de ele
+# ser marcado como processado, e ficam abertas até a transação confirmar (on_commit). Se ela
+# for desfeita, memory_postings() cancela as postagens do bloco; o writer só grava o prefixo
+# confirmado do journal. Uma postagem aberta há mais de confirm_timeout segundos (transação
+# externa desfeita sem exceção no bloco) é resolvida pelo banco: fica se o evento consta como
+# processado, sai caso contrário. Na partida, as linhas do journal com seq > last_seq são
+# reaplicadas com a mesma regra (recuperação de falha).
+#
+# Formato do journal, uma postagem por linha (event_id vazio nas postagens sem evento; valid_date
+# é o when_occurred do evento, que vira Entry.valid_date):
+#   seq<TAB>date ISO<TAB>entry_type_id<TAB>conta:centavos[,conta:centavos...]<TAB>event_id<TAB>valid_date ISO
+import atexit
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from array import array
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.db import connections, transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import (
+    Account,
+    AccountBalanceShard,
+    AccountingEvent,
+    Entry,
+    LedgerJournal,
+    Money,
+    OutboxMessage,
+    conversion_service,
+)
+from .sharding import current_shard, shard_atomic, use_shard
+
+logger = logging.getLogger(__name__)
+
+CENTS = Decimal('0.01')
+
+
+def to_cents(amount):
+    return int(Decimal(amount).quantize(CENTS) * 100)
+
+
+def from_cents(cents):
+    return (Decimal(cents) / 100).quantize(CENTS)
+
+
+class LedgerEngine:
+    def __init__(self, journal_path, name='default', flush_interval=0.5, batch_size=1000, fsync=True,
+                 lease_seconds=30, max_backoff=30.0, confirm_timeout=60.0):
+        self.journal_path = journal_path
+        self.name = name
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.lease_seconds = lease_seconds
+        self.max_backoff = max_backoff
+        self.confirm_timeout = confirm_timeout
+        self.token = uuid.uuid4().hex
+        self.using = current_shard()
+        self._lock = threading.Lock()
+        self._index = {}
+        self._balances = array('q')
+        self._currencies = []
+        self._pending = []
+        # seq -> instante (monotonic) das postagens cuja transação ainda não confirmou
+        self._open = {}
+        self._flush_lock = threading.Lock()
+        # account_id -> contador de mudanças de saldo no motor (postagens e cancelamentos)
+        self._versions = {}
+        self._changes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.seq = 0
+        self.recovered = 0
+        self.load()
+
+    # Partida e recuperação
+
+    def load(self):
+        with use_shard(self.using):
+            self.acquire()
+            self._load_accounts(Account.objects.filter(memory_ledger=self.name))
+            checkpoint = LedgerJournal.objects.get(name=self.name)
+        self.seq = checkpoint.last_seq
+        self.recover(checkpoint.last_seq)
+        self._journal = open(self.journal_path, 'ab')
+
+    def _load_accounts(self, accounts):
+        # Roda no shard do motor; `accounts` é um queryset de contas ainda sem slot
+        for account_id, currency_id, code in accounts.values_list('id', 'currency_id', 'currency__code'):
+            self._index[account_id] = len(self._balances)
+            self._balances.append(0)
+            self._currencies.append((currency_id, code))
+        # Entradas na moeda da conta somadas no banco; as demais convertidas uma a uma
+        entries = Entry.objects.filter(account__in=accounts)
+        same = (
+            entries.filter(amount__currency=F('account__currency'))
+            .values('account').annotate(total=Sum('amount__amount')).values_list('account', 'total')
+        )
+        for account_id, total in same:
+            self._balances[self._index[account_id]] += to_cents(total)
+        foreign = entries.exclude(amount__currency=F('account__currency')).values_list(
+            'account', 'amount__amount', 'amount__currency__code', 'date'
+        )
+        for account_id, amount, code, date in foreign:
+            slot = self._index[account_id]
+            converted = conversion_service().convert(amount, code, self._currencies[slot][1], date)
+            self._balances[slot] += to_cents(converted)
+
+    # Lease do journal
+
+    def _lease(self):
+        return {'lease_token': self.token, 'leased_until': timezone.now() + timezone.timedelta(seconds=self.lease_seconds)}
+
+    def acquire(self):
+        LedgerJournal.objects.get_or_create(name=self.name)
+        free = Q(lease_token__isnull=True) | Q(leased_until__lt=timezone.now()) | Q(lease_token=self.token)
+        if not LedgerJournal.objects.filter(free, name=self.name).update(**self._lease()):
+            raise ValueError(f'Ledger journal {self.name} is held by another engine')
+
+    def renew(self):
+        with use_shard(self.using):
+            if not LedgerJournal.objects.filter(name=self.name, lease_token=self.token).update(**self._lease()):
+                raise ValueError(f'Ledger journal {self.name} lease was lost')
+
+    def release(self):
+        with use_shard(self.using):
+            LedgerJournal.objects.filter(name=self.name, lease_token=self.token).update(lease_token=None, leased_until=None)
+
+    def recover(self, last_seq):
+        if not os.path.exists(self.journal_path):
+            return
+        postings = []
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                posting = self._parse(line)
+                if posting is None:
+                    # Linha incompleta: a escrita não chegou ao fsync, a postagem nunca foi confirmada
+                    break
+                self.seq = max(self.seq, posting[0])
+                if posting[0] > last_seq:
+                    postings.append(posting)
+        with use_shard(self.using):
+            committed = self._committed(postings)
+        for posting in postings:
+            if posting[0] not in committed:
+                # A transação do evento foi desfeita (ou não chegou a confirmar) antes da queda
+                continue
+            for account_id, cents in posting[3]:
+                self._balances[self._slot(account_id)] += cents
+            self._pending.append(posting)
+            self.recovered += 1
+        # Reescreve o journal sem a cauda incompleta e sem o que já está nas tabelas
+        self._rewrite(self._pending)
+
+    def _parse(self, line):
+        if not line.endswith(b'\n'):
+            return None
+        try:
+            # Linhas gravadas antes de event_id/valid_date existirem têm menos campos
+            seq, when, entry_type_id, legs, event_id, valid_date = (line.decode().rstrip('\n').split('\t') + ['', ''])[:6]
+            legs = [tuple(int(part) for part in leg.split(':')) for leg in legs.split(',')]
+            when = parse_datetime(when)
+            valid_date = parse_datetime(valid_date) if valid_date else when
+            return int(seq), when, int(entry_type_id), legs, int(event_id) if event_id else None, valid_date
+        except ValueError:
+            return None
+
+    def _format(self, posting):
+        seq, when, entry_type_id, legs, event_id, valid_date = posting
+        legs = ','.join(f'{a}:{c}' for a, c in legs)
+        return f"{seq}\t{when.isoformat()}\t{entry_type_id}\t{legs}\t{event_id or ''}\t{valid_date.isoformat()}\n".encode()
+
+    def _rewrite(self, postings):
+        tmp = f"{self.journal_path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(self._format(p) for p in postings))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path)
+
+    def _slot(self, account_id):
+        slot = self._index.get(account_id)
+        if slot is None:
+            # Conta passada ao motor depois da partida
+            with use_shard(self.using):
+                self._load_accounts(Account.objects.filter(id=account_id, memory_ledger=self.name))
+            slot = self._index.get(account_id)
+            if slot is None:
+                raise ValueError(f'Account {account_id} is not owned by ledger {self.name}')
+        return slot
+
+    # Postagens
+
+    def balance(self, account_id):
+        with self._lock:
+            return from_cents(self._balances[self._slot(account_id)])
+
+    def post(self, entry_type, legs, when=None, allow_overdraft=False, event=None, confirmed=True, valid_date=None):
+        """Aplica legs [(account_id, valor na moeda da conta)] atomicamente; devolve o seq.
+
+        As entradas gravadas pelo flush ficam ligadas a `event` (resulting_entries e outbox),
+        com date=when e valid_date (padrão: when). Com confirmed=False a postagem só é gravada
+        depois de confirm(seq).
+        """
+        when = when or timezone.now()
+        valid_date = valid_date or when
+        entry_type_id = getattr(entry_type, 'id', entry_type)
+        legs = [(account_id, to_cents(amount)) for account_id, amount in legs]
+        with self._lock:
+            slots = [self._slot(account_id) for account_id, _ in legs]
+            if not allow_overdraft:
+                totals = {}
+                for slot, (_, cents) in zip(slots, legs):
+                    totals[slot] = totals.get(slot, self._balances[slot]) + cents
+                for slot, (account_id, cents) in zip(slots, legs):
+                    if cents < 0 and totals[slot] < 0:
+                        raise ValueError(f'Insufficient funds in account {account_id}')
+            self.seq += 1
+            posting = (self.seq, when, entry_type_id, legs, getattr(event, 'id', event), valid_date)
+            self._journal.write(self._format(posting))
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            for slot, (_, cents) in zip(slots, legs):
+                self._balances[slot] += cents
+            self._touch(account_id for account_id, _ in legs)
+            self._pending.append(posting)
+            if not confirmed:
+                self._open[self.seq] = time.monotonic()
+            return self.seq
+
+    def post_money(self, account, entry_type, money, when, event=None, allow_overdraft=False, valid_date=None):
+        """Perna de uma regra de postagem (Money em qualquer moeda) numa conta do motor; devolve o seq.
+
+        A postagem vai para o journal e para o saldo em memória já aqui, dentro da transação do
+        evento, com o saldo conferido sob o lock do motor (duas retiradas concorrentes não
+        passam ambas). Ela só é gravada nas tabelas depois que a transação confirma; se for
+        desfeita dentro de memory_postings(), a postagem é cancelada.
+        """
+        if account.memory_ledger != self.name:
+            raise ValueError(f'Account {account.id} is not owned by ledger {self.name}')
+        with self._lock:
+            self._slot(account.id)
+        amount = money.amount
+        if money.currency_id != account.currency_id:
+            amount = conversion_service().convert(amount, money.currency.code, account.currency.code, when)
+        seq = self.post(entry_type, [(account.id, amount)], when, allow_overdraft, event=event, confirmed=False, valid_date=valid_date)
+        scopes = getattr(_scopes, 'stack', None)
+        if scopes:
+            scopes[-1].append(seq)
+        transaction.on_commit(functools.partial(self.confirm, seq), using=current_shard())
+        return seq
+
+    def _touch(self, account_ids):
+        # Chamado com o lock
+        self._changes += 1
+        for account_id in account_ids:
+            self._versions[account_id] = self._changes
+
+    def account_version(self, account_id):
+        """Versão do saldo em memória da conta; muda a cada postagem ou cancelamento que a toca.
+
+        Leva o token do motor, para não repetir versões de um motor anterior depois de reiniciar.
+        """
+        with self._lock:
+            return f"{self.token[:8]}.{self._versions.get(account_id, 0)}"
+
+    def pending_total(self, account_id, before=None):
+        # Soma (na moeda da conta) das postagens da conta ainda não gravadas, com date < before
+        with self._lock:
+            cents = sum(
+                leg_cents for posting in self._pending if before is None or posting[1] < before
+                for leg_account, leg_cents in posting[3] if leg_account == account_id
+            )
+        return from_cents(cents)
+
+    def pending_legs(self, event_id):
+        # [(account_id, entry_type_id, valor, valid_date)] do evento ainda não gravadas nas tabelas
+        with self._lock:
+            return [
+                (account_id, posting[2], from_cents(cents), posting[5])
+                for posting in self._pending if posting[4] == event_id
+                for account_id, cents in posting[3]
+            ]
+
+    def confirm(self, seq):
+        with self._lock:
+            self._open.pop(seq, None)
+
+    def cancel(self, seqs):
+        """Desfaz postagens ainda não confirmadas (a transação delas foi desfeita)."""
+        with self._lock:
+            seqs = {seq for seq in seqs if seq in self._open}
+            if not seqs:
+                return 0
+            for posting in self._pending:
+                if posting[0] in seqs:
+                    for account_id, cents in posting[3]:
+                        self._balances[self._index[account_id]] -= cents
+                    self._touch(account_id for account_id, _ in posting[3])
+            self._pending = [posting for posting in self._pending if posting[0] not in seqs]
+            for seq in seqs:
+                del self._open[seq]
+            self._reopen()
+        return len(seqs)
+
+    def _committed(self, postings):
+        # seqs cuja transação confirmou segundo o banco: postagens sem evento e as de eventos processados
+        event_ids = {posting[4] for posting in postings if posting[4] is not None}
+        processed = set(AccountingEvent.objects.filter(id__in=event_ids, is_processed=True).values_list('id', flat=True))
+        return {posting[0] for posting in postings if posting[4] is None or posting[4] in processed}
+
+    def resolve_open(self):
+        """Confirma ou cancela pelo banco as postagens abertas há mais de confirm_timeout segundos."""
+        deadline = time.monotonic() - self.confirm_timeout
+        with self._lock:
+            stale = [posting for posting in self._pending if self._open.get(posting[0], deadline + 1) <= deadline]
+        if not stale:
+            return 0
+        with use_shard(self.using):
+            committed = self._committed(stale)
+        for seq in committed:
+            self.confirm(seq)
+        cancelled = [posting[0] for posting in stale if posting[0] not in committed]
+        if cancelled:
+            logger.warning('Memory ledger %s: cancelling postings %s whose transaction did not commit', self.name, cancelled)
+            self.cancel(cancelled)
+        return len(stale)
+
+    def deposit(self, account_id, amount, entry_type, when=None):
+        return self.post(entry_type, [(account_id, amount)], when)
+
+    def withdraw(self, account_id, amount, entry_type, when=None, allow_overdraft=False):
+        return self.post(entry_type, [(account_id, -Decimal(amount))], when, allow_overdraft)
+
+    def transfer(self, from_account_id, to_account_id, amount, entry_type, when=None, allow_overdraft=False):
+        # amount na moeda da conta de origem; a perna de destino é convertida
+        when = when or timezone.now()
+        from_code = self._currencies[self._slot(from_account_id)][1]
+        to_code = self._currencies[self._slot(to_account_id)][1]
+        credit = conversion_service().convert(Decimal(amount), from_code, to_code, when)
+        return self.post(entry_type, [(from_account_id, -Decimal(amount)), (to_account_id, credit)], when, allow_overdraft)
+
+    # Gravação em lote
+
+    def flush(self):
+        """Grava o prefixo confirmado das postagens pendentes nas tabelas; devolve quantas foram gravadas."""
+        with self._flush_lock:
+            self.resolve_open()
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            batch = []
+            for posting in self._pending[:self.batch_size]:
+                if posting[0] in self._open:
+                    break
+                batch.append(posting)
+        if not batch:
+            return 0
+        with use_shard(self.using), shard_atomic():
+            rows = [(posting, account_id, cents) for posting in batch for account_id, cents in posting[3]]
+            amounts = Money.objects.bulk_create([
+                Money(amount=from_cents(cents), currency_id=self._currencies[self._index[account_id]][0])
+                for _, account_id, cents in rows
+            ])
+            entries = Entry.objects.bulk_create([
+                Entry(account_id=account_id, entry_type_id=posting[2], amount=money, date=posting[1], valid_date=posting[5])
+                for (posting, account_id, _), money in zip(rows, amounts)
+            ])
+            through = AccountingEvent.resulting_entries.through
+            through.objects.bulk_create([
+                through(accountingevent_id=posting[4], entry_id=entry.id)
+                for (posting, _, _), entry in zip(rows, entries) if posting[4] is not None
+            ])
+            deltas = {}
+            for _, account_id, cents in rows:
+                deltas[account_id] = deltas.get(account_id, Decimal('0.00')) + from_cents(cents)
+            AccountBalanceShard.apply_many(deltas)
+            OutboxMessage.objects.bulk_create([
+                OutboxMessage(topic=OutboxMessage.ENTRY_POSTED, event_id=posting[4], entry_id=entry.id, payload={
+                    'entry_id': entry.id,
+                    'event_id': posting[4],
+                    'account_id': account_id,
+                    'entry_type_id': posting[2],
+                    'amount': str(money.amount),
+                    'currency': self._currencies[self._index[account_id]][1],
+                    'date': posting[1].isoformat(),
+                    'valid_date': posting[5].isoformat(),
+                    'journal_seq': posting[0],
+                })
+                for (posting, account_id, _), money, entry in zip(rows, amounts, entries)
+            ])
+            # Só o dono do lease avança o journal; sem ele a transação inteira é desfeita
+            if not LedgerJournal.objects.filter(name=self.name, lease_token=self.token).update(last_seq=batch[-1][0]):
+                raise ValueError(f'Ledger journal {self.name} lease was lost')
+        with self._lock:
+            # O que já está nas tabelas sai do journal
+            flushed = {posting[0] for posting in batch}
+            self._pending = [posting for posting in self._pending if posting[0] not in flushed]
+            self._reopen()
+        return len(batch)
+
+    def _reopen(self):
+        # Reescreve o journal só com as postagens pendentes (chamado com o lock)
+        self._journal.close()
+        self._rewrite(self._pending)
+        self._journal = open(self.journal_path, 'ab')
+
+    def _run(self):
+        delay = self.flush_interval
+        try:
+            while not self._stop.wait(delay):
+                try:
+                    self.renew()
+                    while self.flush() == self.batch_size:
+                        pass
+                    delay = self.flush_interval
+                except Exception:
+                    # As postagens continuam no journal: o writer registra a falha e tenta de
+                    # novo com espera crescente, em vez de morrer e parar de gravar
+                    delay = min(delay * 2, self.max_backoff)
+                    logger.exception('Memory ledger %s flush failed; retrying in %.1fs', self.name, delay)
+                    connections.close_all()
+            while self.flush():
+                pass
+        finally:
+            connections.close_all()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'memledger-{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        else:
+            while self.flush():
+                pass
+        self._journal.close()
+        self.release()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_scopes = threading.local()
+
+
+@contextmanager
+def memory_postings():
+    """Cancela no motor as postagens de post_money feitas no bloco se ele terminar com exceção.
+
+    Envolve a transação que faz as postagens (AccountingEvent.process, reverse, accrual): a
+    exceção significa que ela foi desfeita. Sem exceção, as postagens passam ao bloco externo.
+    """
+    stack = getattr(_scopes, 'stack', None)
+    if stack is None:
+        stack = _scopes.stack = []
+    seqs = []
+    stack.append(seqs)
+    try:
+        yield seqs
+    except BaseException:
+        stack.pop()
+        if seqs and _engine is not None:
+            _engine.cancel(seqs)
+        raise
+    stack.pop()
+    if stack:
+        stack[-1].extend(seqs)
+
+
+@contextmanager
+def unflushed_postings(event):
+    """Pernas do evento que ainda estão só no motor deste processo, com o flush parado no bloco.
+
+    Dentro do bloco as entradas já gravadas (resulting_entries) e as pendentes não se
+    sobrepõem, então AccountingEvent.reverse() estorna cada perna uma única vez.
+    """
+    engine = _engine
+    if engine is None:
+        yield []
+        return
+    with engine._flush_lock:
+        yield engine.pending_legs(event.id)
+
+
+def running_engine(name):
+    """Motor deste processo se ele for o dono do journal `name`; None caso contrário."""
+    engine = _engine
+    if engine is not None and engine.name == name:
+        return engine
+    return None
+
+
+def get_engine():
+    """Motor do processo, criado na primeira chamada se settings.MEMORY_LEDGER_JOURNAL estiver definido.
+
+    Levanta ValueError se o journal estiver com outro processo: as contas do motor só
+    aceitam postagens no processo dono do lease.
+    """
+    global _engine
+    from django.conf import settings
+    if _engine is None:
+        journal = getattr(settings, 'MEMORY_LEDGER_JOURNAL', None)
+        if not journal:
+            raise ValueError('MEMORY_LEDGER_JOURNAL is not configured')
+        with _engine_lock:
+            if _engine is None:
+                engine = LedgerEngine(journal, flush_interval=getattr(settings, 'MEMORY_LEDGER_FLUSH_INTERVAL', 0.5))
+                engine.start()
+                atexit.register(engine.stop)
+                _engine = engine
+    return _engine
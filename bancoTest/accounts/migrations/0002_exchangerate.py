@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rate', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('effective_date', models.DateTimeField()),
+                ('from_currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='rates_from', to='accounts.currency')),
+                ('to_currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='rates_to', to='accounts.currency')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['from_currency', 'to_currency', 'effective_date'], name='accounts_ex_from_cu_055cd8_idx')],
+                'unique_together': {('from_currency', 'to_currency', 'effective_date')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountingevent',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='is_opening_balance',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='AccountArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('archived_until', models.DateTimeField()),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, related_name='archive', to='accounts.account')),
+                ('opening_entry', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='accounts.entry')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.BigIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('date', models.DateTimeField()),
+                ('period', models.CharField(max_length=7)),
+                ('event_ids', models.JSONField(default=list)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='archived_entries', to='accounts.account')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.currency')),
+                ('entry_type', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.entrytype')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['account', 'date'], name='accounts_ar_account_6d6fdf_idx'), models.Index(fields=['period'], name='accounts_ar_period_988f31_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_archive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accountingevent',
+            name='when_occurred',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['date'], name='accounts_en_date_30a132_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['account', 'date'], name='accounts_en_account_e6e75f_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:01
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('DEAD', 'Dead letter')], default='QUEUED', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('leased_until', models.DateTimeField(blank=True, null=True)),
+                ('lease_token', models.CharField(blank=True, max_length=32, null=True)),
+                ('worker', models.CharField(blank=True, max_length=100)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('event', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='job', to='accounts.accountingevent')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'available_at'], name='accounts_ev_status_0d941c_idx'), models.Index(fields=['status', 'leased_until'], name='accounts_ev_status_73f9f9_idx'), models.Index(fields=['lease_token'], name='accounts_ev_lease_t_376143_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:03
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_eventjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccrualRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_date', models.DateField()),
+                ('status', models.CharField(default='RUNNING', max_length=10)),
+                ('accounts', models.PositiveIntegerField(default=0)),
+                ('interest_total', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18)),
+                ('fee_total', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('service_agreement', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='accrual_runs', to='accounts.serviceagreement')),
+            ],
+            options={
+                'unique_together': {('service_agreement', 'run_date')},
+            },
+        ),
+    ]
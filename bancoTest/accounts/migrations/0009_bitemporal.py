@@ -0,0 +1,86 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:07
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_bitemporal_dates(apps, schema_editor):
+    # Linhas existentes: o único tempo conhecido é `date` (when_noticed)
+    Entry = apps.get_model('accounts', 'Entry')
+    ArchivedEntry = apps.get_model('accounts', 'ArchivedEntry')
+    Entry.objects.update(valid_date=F('date'), recorded_at=F('date'))
+    ArchivedEntry.objects.update(valid_date=F('date'), recorded_at=F('date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_accrualrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('valid_at', models.DateTimeField()),
+                ('known_at', models.DateTimeField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=18)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedentry',
+            name='recorded_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedentry',
+            name='valid_date',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='entry',
+            name='recorded_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='entry',
+            name='valid_date',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='archivedentry',
+            index=models.Index(fields=['account', 'valid_date', 'recorded_at'], name='accounts_ar_account_0045ec_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['account', 'valid_date', 'recorded_at'], name='accounts_en_account_fdd59c_idx'),
+        ),
+        migrations.AddField(
+            model_name='balancecheckpoint',
+            name='account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='accounts.account'),
+        ),
+        migrations.AddIndex(
+            model_name='balancecheckpoint',
+            index=models.Index(fields=['account', 'valid_at', 'known_at'], name='accounts_ba_account_af6e43_idx'),
+        ),
+        migrations.RunPython(fill_bitemporal_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='archivedentry',
+            name='recorded_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AlterField(
+            model_name='archivedentry',
+            name='valid_date',
+            field=models.DateTimeField(),
+        ),
+        migrations.AlterField(
+            model_name='entry',
+            name='valid_date',
+            field=models.DateTimeField(),
+        ),
+    ]
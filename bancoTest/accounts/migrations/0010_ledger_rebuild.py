@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_bitemporal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerRebuild',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('customer_ids', models.JSONField(blank=True, default=list)),
+                ('status', models.CharField(default='SHADOWED', max_length=10)),
+                ('report', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('swapped_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ShadowEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('date', models.DateTimeField()),
+                ('valid_date', models.DateTimeField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounts.account')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.currency')),
+                ('entry_type', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.entrytype')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounts.accountingevent')),
+                ('rebuild', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='accounts.ledgerrebuild')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['rebuild', 'account'], name='accounts_sh_rebuild_9e366b_idx')],
+            },
+        ),
+    ]
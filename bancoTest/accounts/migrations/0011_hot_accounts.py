@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:10
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_ledger_rebuild'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='balance_shards',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='is_hot',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='AccountBalanceShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_shard_rows', to='accounts.account')),
+            ],
+            options={
+                'unique_together': {('account', 'shard')},
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_hot_accounts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardMap',
+            fields=[
+                ('customer_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('shard', models.CharField(db_index=True, max_length=50)),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_ledgerjournal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerPeriodSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(max_length=7, unique=True)),
+                ('rows', models.JSONField(default=list)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:50
+
+from django.db import migrations, models
+
+
+def copy_event_ids(apps, schema_editor):
+    ArchivedEntry = apps.get_model('accounts', 'ArchivedEntry')
+    alias = schema_editor.connection.alias
+    links = [
+        ArchivedEntry.events.through(archivedentry_id=archived_id, accountingevent_id=event_id)
+        for archived_id, event_ids in ArchivedEntry.objects.using(alias).values_list('id', 'event_ids')
+        for event_id in event_ids or []
+    ]
+    ArchivedEntry.events.through.objects.using(alias).bulk_create(links)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_ledgerperiodsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedentry',
+            name='events',
+            field=models.ManyToManyField(blank=True, related_name='archived_entries', to='accounts.accountingevent'),
+        ),
+        migrations.RunPython(copy_event_ids, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='archivedentry',
+            name='event_ids',
+        ),
+    ]
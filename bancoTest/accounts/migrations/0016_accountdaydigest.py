@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_digests(apps, schema_editor):
+    # Usa só o cálculo (puro) do modelo atual; as consultas são do modelo histórico
+    from accounts.models import AccountDayDigest as Digest
+    alias = schema_editor.connection.alias
+    Entry = apps.get_model('accounts', 'Entry')
+    AccountDayDigest = apps.get_model('accounts', 'AccountDayDigest')
+    deltas = Digest.deltas(Entry.objects.using(alias).values_list(*Digest.ENTRY_FIELDS).iterator())
+    AccountDayDigest.objects.using(alias).bulk_create([
+        AccountDayDigest(account_id=account_id, day=day, low=low, high=high, entries=count)
+        for (account_id, day), (low, high, count) in deltas.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_archivedentry_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountDayDigest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('low', models.BigIntegerField(default=0)),
+                ('high', models.BigIntegerField(default=0)),
+                ('entries', models.IntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='day_digests', to='accounts.account')),
+            ],
+            options={
+                'unique_together': {('account', 'day')},
+            },
+        ),
+        migrations.RunPython(build_digests, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_accountdaydigest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='memory_ledger',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='ledgerjournal',
+            name='lease_token',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='ledgerjournal',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0017_memory_ledger_owner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ledgerperiodsummary',
+            name='watermark',
+            field=models.CharField(default='', max_length=64),
+        ),
+    ]
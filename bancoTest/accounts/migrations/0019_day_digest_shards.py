@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0018_period_summary_watermark'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='accountdaydigest',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='accountdaydigest',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='accountdaydigest',
+            unique_together={('account', 'day', 'shard')},
+        ),
+    ]
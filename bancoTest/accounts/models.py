@@ -1,6 +1,34 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, Q, Sum, Value, When
 from django.utils import timezone
+from django.utils.functional import cached_property
 from decimal import Decimal
+import datetime
+import hashlib
+import itertools
+import random
+
+from bancoTest.profiling import profiled
+from .plans import ACCOUNT, CalculationPlan
+from .sharding import DIRECTORY, is_sharded, on_instance_shard, shard_aliases, shard_atomic
+
+
+def post_to_memory_ledger(account, entry_type, amount, date, event, allow_overdraft=False, valid_date=None):
+    # Postagem numa conta cujo saldo pertence ao razão em memória (Account.memory_ledger)
+    from .memledger import get_engine
+    return get_engine().post_money(account, entry_type, amount, date, event, allow_overdraft=allow_overdraft, valid_date=valid_date)
+
+
+def memory_postings():
+    # Bloco cujas postagens no razão em memória são canceladas se ele for desfeito
+    from .memledger import memory_postings
+    return memory_postings()
+
+
+def conversion_service():
+    # Importação tardia: o serviço de conversão depende deste módulo
+    from .conversion import get_conversion_service
+    return get_conversion_service()
 
 
 class Currency(models.Model):
@@ -50,6 +78,39 @@ class Money(models.Model):
             raise TypeError("The other value must be a Money instance")
         return self.amount == other.amount
 
+    def convert_to(self, currency, date=None):
+        # Conversão usando a tabela de câmbio em cache (sem consulta por taxa)
+        if self.currency_id == currency.id:
+            return self
+        amount = conversion_service().convert(self.amount, self.currency.code, currency.code, date)
+        return Money.objects.create(amount=amount, currency=currency)
+
+class ExchangeRate(models.Model):
+    from_currency = models.ForeignKey(Currency, related_name='rates_from', on_delete=models.PROTECT)
+    to_currency = models.ForeignKey(Currency, related_name='rates_to', on_delete=models.PROTECT)
+    rate = models.DecimalField(max_digits=18, decimal_places=8)
+    effective_date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('from_currency', 'to_currency', 'effective_date')
+        indexes = [
+            models.Index(fields=['from_currency', 'to_currency', 'effective_date']),
+        ]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from .conversion import invalidate_rates
+        invalidate_rates()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        from .conversion import invalidate_rates
+        invalidate_rates()
+        return result
+
+    def __str__(self):
+        return f"{self.from_currency.code}/{self.to_currency.code} {self.rate} @ {self.effective_date}"
+
 class EventType(models.Model):
     name = models.CharField(max_length=50, unique=True)
 
@@ -66,35 +127,314 @@ class Account(models.Model):
     name = models.CharField(max_length=100)
     account_type = models.ForeignKey(AccountType, on_delete=models.PROTECT)
     currency = models.ForeignKey(Currency, on_delete=models.PROTECT)
+    # Contas "quentes" (tarifas, compensação) mantêm o saldo corrente dividido em
+    # AccountBalanceShard para que postagens concorrentes não disputem a mesma linha
+    is_hot = models.BooleanField(default=False)
+    balance_shards = models.PositiveSmallIntegerField(default=1)
+    # Nome do LedgerJournal cujo razão em memória é dono do saldo (accounts/memledger.py);
+    # as postagens de eventos nessas contas passam pelo motor. Vazio: postagem direta.
+    memory_ledger = models.CharField(max_length=100, blank=True, default='')
+
+    @on_instance_shard
+    def balance(self, date=None, valid_at=None, known_at=None):
+        if valid_at is not None or known_at is not None:
+            return self.bitemporal_balance(valid_at, known_at)
+        if self.memory_ledger and not date:
+            # No processo dono do journal o saldo em memória inclui o que ainda não foi gravado
+            from .memledger import running_engine
+            engine = running_engine(self.memory_ledger)
+            if engine is not None:
+                return engine.balance(self.id)
+        if self.is_hot and not date:
+            return AccountBalanceShard.total(self)
+        if date:
+            archived_until = self.archived_until()
+            if archived_until is not None and date < archived_until:
+                # A data pedida está no arquivo: soma as entradas arquivadas e as eventuais
+                # entradas retroativas lançadas depois do arquivamento
+                rows = self.archived_entries.filter(date__lte=date).values_list('amount', 'currency_id', 'currency__code', 'date')
+                late = self.entries.filter(date__lte=date, is_opening_balance=False).values_list(
+                    'amount__amount', 'amount__currency_id', 'amount__currency__code', 'date'
+                )
+                return self._sum_rows(rows) + self._sum_rows(late)
 
-    def balance(self, date=None):
         entries = self.entries.all()
 
         if date:
             entries = entries.filter(date__lte=date)
 
+        rows = entries.values_list('amount__amount', 'amount__currency_id', 'amount__currency__code', 'date')
+        return self._sum_rows(rows)
+
+    @on_instance_shard
+    def bitemporal_balance(self, valid_at=None, known_at=None):
+        # "Qual era o saldo em valid_at, segundo o que se sabia em known_at?"
+        # Parte do checkpoint mais recente dentro do quadrante (valid_at, known_at) e soma
+        # apenas as entradas fora do quadrante do checkpoint.
+        now = timezone.now()
+        valid_at = valid_at or now
+        known_at = known_at or now
+        checkpoint = (
+            self.checkpoints.filter(valid_at__lte=valid_at, known_at__lte=known_at)
+            .order_by('-known_at', '-valid_at')
+            .first()
+        )
+        region = Q(valid_date__lte=valid_at, recorded_at__lte=known_at)
         total = Decimal('0.00')
+        if checkpoint is not None:
+            region &= ~Q(valid_date__lte=checkpoint.valid_at, recorded_at__lte=checkpoint.known_at)
+            total = checkpoint.amount
 
-        for entry in entries:
-            total += entry.amount.amount
+        rows = self.entries.filter(region, is_opening_balance=False).values_list(
+            'amount__amount', 'amount__currency_id', 'amount__currency__code', 'valid_date'
+        )
+        total += self._sum_rows(rows)
+        if self.archived_until() is not None:
+            archived = self.archived_entries.filter(region).values_list('amount', 'currency_id', 'currency__code', 'valid_date')
+            total += self._sum_rows(archived)
+        return total
+
+    @on_instance_shard
+    def checkpoint(self, valid_at, known_at=None):
+        # Grava o saldo bitemporal; known_at não pode estar no futuro, senão entradas
+        # gravadas depois cairiam dentro do quadrante do checkpoint
+        known_at = min(known_at or timezone.now(), timezone.now())
+        amount = self.bitemporal_balance(valid_at, known_at)
+        return BalanceCheckpoint.objects.create(account=self, valid_at=valid_at, known_at=known_at, amount=amount)
+
+    def _sum_rows(self, rows):
+        total = Decimal('0.00')
+        for amount, currency_id, code, entry_date in rows:
+            if currency_id != self.currency_id:
+                # Entradas em outra moeda são convertidas para a moeda da conta
+                amount = conversion_service().convert(amount, code, self.currency.code, entry_date)
+            total += amount
         return total
 
+    def archived_until(self):
+        return AccountArchive.objects.filter(account=self).values_list('archived_until', flat=True).first()
+
+    @on_instance_shard
+    def statement(self, start=None, end=None, offset=0, limit=None):
+        # Extrato em ordem cronológica. As entradas arquivadas só são consultadas
+        # quando o período pedido começa antes do corte do arquivo; nesse caso a
+        # entrada de saldo de abertura é omitida, pois o detalhe arquivado a substitui.
+        archived_until = self.archived_until()
+        live = self.entries.all()
+        archived = None
+        if archived_until is not None and (start is None or start < archived_until):
+            archived = self.archived_entries.all()
+            live = live.filter(is_opening_balance=False)
+            if start:
+                archived = archived.filter(date__gte=start)
+            if end:
+                archived = archived.filter(date__lte=end)
+        if start:
+            live = live.filter(date__gte=start)
+        if end:
+            live = live.filter(date__lte=end)
+
+        live = live.order_by('date', 'id').values_list('id', 'date', 'entry_type__name', 'amount__amount', 'amount__currency__code')
+        rows = []
+        if archived is not None:
+            archived = archived.order_by('date', 'id').values_list('original_id', 'date', 'entry_type__name', 'amount', 'currency__code')
+            archived_count = archived.count() if limit is not None or offset else None
+            stop = offset + limit if limit is not None else None
+            rows += [(row, True) for row in archived[offset:stop]]
+            if archived_count is not None:
+                offset = max(0, offset - archived_count)
+                if limit is not None:
+                    limit = max(0, limit - len(rows))
+        if limit != 0:
+            stop = offset + limit if limit is not None else None
+            rows += [(row, False) for row in live[offset:stop]]
+        return [
+            {'id': entry_id, 'date': date, 'entry_type': entry_type, 'amount': amount, 'currency': currency, 'archived': is_archived}
+            for (entry_id, date, entry_type, amount, currency), is_archived in rows
+        ]
+
     def add_entry(self, entry):
         entry.account = self
         entry.save()
 
+    def apply_posting(self, money, date=None):
+        # Atualiza o saldo fragmentado das contas quentes; não faz nada nas demais.
+        # `date` é a date da entrada, a mesma data em que balance() converte as outras moedas
+        if not self.is_hot:
+            return
+        amount = money.amount
+        if money.currency_id != self.currency_id:
+            amount = conversion_service().convert(amount, money.currency.code, self.currency.code, date)
+        AccountBalanceShard.add(self.id, self.balance_shards, amount)
+
+    @on_instance_shard
+    def make_hot(self, shards=16):
+        with shard_atomic():
+            account = Account.objects.select_for_update().get(id=self.id)
+            account.is_hot = False
+            total = account.balance()
+            AccountBalanceShard.objects.filter(account=account).delete()
+            AccountBalanceShard.objects.bulk_create([
+                AccountBalanceShard(account=account, shard=i, amount=total if i == 0 else Decimal('0.00'))
+                for i in range(shards)
+            ])
+            Account.objects.filter(id=self.id).update(is_hot=True, balance_shards=shards)
+        self.is_hot, self.balance_shards = True, shards
+
+    @on_instance_shard
+    def compact_shards(self, resync=False):
+        # Junta os fragmentos no fragmento 0; com resync o total é recalculado das entradas
+        with shard_atomic():
+            shards = list(AccountBalanceShard.objects.select_for_update().filter(account=self).order_by('shard'))
+            if resync:
+                self.is_hot = False
+                total = self.balance()
+                self.is_hot = True
+            else:
+                total = sum((shard.amount for shard in shards), Decimal('0.00'))
+            AccountBalanceShard.objects.filter(account=self).update(amount=Decimal('0.00'))
+            AccountBalanceShard.objects.filter(account=self, shard=0).update(amount=total)
+        return total
+
     def __str__(self):
         return self.name
 
+class AccountBalanceShard(models.Model):
+    account = models.ForeignKey(Account, related_name='balance_shard_rows', on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    amount = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        unique_together = ('account', 'shard')
+
+    @classmethod
+    def add(cls, account_id, shards, amount):
+        shard = random.randrange(shards) if shards > 1 else 0
+        cls.objects.filter(account_id=account_id, shard=shard).update(amount=F('amount') + amount)
+
+    @classmethod
+    def apply_many(cls, deltas):
+        # deltas: {account_id: valor na moeda da conta}; só as contas quentes são atualizadas
+        hot = Account.objects.filter(id__in=list(deltas), is_hot=True).values_list('id', 'balance_shards')
+        for account_id, shards in hot:
+            if deltas[account_id]:
+                cls.add(account_id, shards, deltas[account_id])
+
+    @classmethod
+    def total(cls, account):
+        return cls.objects.filter(account=account).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+
+class ShardMap(models.Model):
+    # Diretório cliente -> shard, só no banco 'default' (ver accounts/sharding.py).
+    # O id desta linha é o id do cliente, único entre todos os shards.
+    customer_id = models.BigAutoField(primary_key=True)
+    shard = models.CharField(max_length=50, db_index=True)
+
+    @classmethod
+    def allocate(cls):
+        aliases = shard_aliases()
+        with transaction.atomic(using=DIRECTORY):
+            row = cls.objects.create(shard='')
+            row.shard = aliases[row.customer_id % len(aliases)]
+            row.save(update_fields=['shard'])
+        return row.customer_id, row.shard
+
+    def __str__(self):
+        return f"Customer {self.customer_id} @ {self.shard}"
+
+class LedgerJournal(models.Model):
+    # Último seq do journal do razão em memória já gravado nas tabelas (ver accounts/memledger.py).
+    # O lease garante um único motor por journal entre processos.
+    name = models.CharField(max_length=100, unique=True)
+    last_seq = models.BigIntegerField(default=0)
+    lease_token = models.CharField(max_length=32, null=True, blank=True)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.last_seq}"
+
 class Customer(models.Model):
     name = models.CharField(max_length=100)
     accounts = models.ManyToManyField(Account)
     service_agreement = models.ForeignKey('ServiceAgreement', related_name='customer', on_delete=models.PROTECT, null=True)
+
+    def save(self, *args, **kwargs):
+        # Com o razão particionado, um cliente novo recebe o id e o shard do ShardMap
+        if self.pk is None and is_sharded():
+            self.id, kwargs['using'] = ShardMap.allocate()
+        super().save(*args, **kwargs)
     
     def add_entry(self, entry):
         account = self.accounts.get(account_type=entry.entry_type.account_type)
         account.add_entry(entry)
 
+    def positions(self, currency=None, date=None):
+        return Customer.positions_for([self], currency=currency, date=date)[self.id]
+
+    @classmethod
+    def positions_for(cls, customers, currency=None, date=None):
+        # Saldos por conta e por tipo de conta de vários clientes numa única consulta agregada.
+        # Se `currency` for informada, os valores são consolidados nessa moeda.
+        customer_ids = [c.id if isinstance(c, Customer) else c for c in customers]
+        entry_filter = Q(entries__date__lte=date) if date else None
+        # Uma consulta por shard envolvido (uma só sem particionamento)
+        by_shard = {None: customer_ids}
+        if is_sharded():
+            shards = dict(ShardMap.objects.filter(customer_id__in=customer_ids).values_list('customer_id', 'shard'))
+            by_shard = {}
+            for customer_id in customer_ids:
+                by_shard.setdefault(shards.get(customer_id), []).append(customer_id)
+        # Entradas em outra moeda são agrupadas também pela data, para serem convertidas na taxa
+        # da data de cada entrada, como em Account.balance
+        converted_at = Case(When(entries__amount__currency=F('currency'), then=Value(None)), default=F('entries__date'))
+        rows = itertools.chain.from_iterable(
+            Account.objects.using(alias).filter(customer__in=ids)
+            .annotate(converted_at=converted_at)
+            .values('customer', 'id', 'name', 'account_type__name', 'currency__code', 'entries__amount__currency__code', 'converted_at')
+            .annotate(total=Sum('entries__amount__amount', filter=entry_filter))
+            .order_by('customer', 'id')
+            for alias, ids in by_shard.items()
+        )
+
+        target = currency.code if isinstance(currency, Currency) else currency
+        positions = {customer_id: {'accounts': [], 'account_types': {}, 'currency': target, 'total': None} for customer_id in customer_ids}
+        accounts = {}
+        for row in rows:
+            key = (row['customer'], row['id'])
+            account = accounts.get(key)
+            if account is None:
+                account = accounts[key] = {
+                    'id': row['id'],
+                    'name': row['name'],
+                    'account_type': row['account_type__name'],
+                    'currency': row['currency__code'],
+                    'balance': Decimal('0.00'),
+                }
+                positions[row['customer']]['accounts'].append(account)
+            amount = row['total']
+            if amount is None:
+                continue
+            entry_currency = row['entries__amount__currency__code']
+            if entry_currency != account['currency']:
+                amount = conversion_service().convert(amount, entry_currency, account['currency'], row['converted_at'])
+            account['balance'] += amount
+
+        for position in positions.values():
+            if target:
+                position['total'] = Decimal('0.00')
+            for account in position['accounts']:
+                balance, code = account['balance'], account['currency']
+                if target:
+                    if code != target:
+                        balance = conversion_service().convert(balance, code, target, date)
+                    code = target
+                    account['consolidated_balance'] = balance
+                    position['total'] += balance
+                by_currency = position['account_types'].setdefault(account['account_type'], {})
+                by_currency[code] = by_currency.get(code, Decimal('0.00')) + balance
+        return positions
+
     def __str__(self):
         return self.name
     
@@ -105,33 +445,310 @@ class EntryType(models.Model):
     def __str__(self):
         return self.name
 
+class EntryQuerySet(models.QuerySet):
+    # Mantém AccountDayDigest em dia também nos caminhos em lote (bulk_create e delete)
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        AccountDayDigest.record([entry.digest_row() for entry in objs], using=self.db)
+        return objs
+
+    def delete(self):
+        rows = list(self.values_list(*AccountDayDigest.ENTRY_FIELDS))
+        result = super().delete()
+        AccountDayDigest.record(rows, sign=-1, using=self.db)
+        return result
+
 class Entry(models.Model):
     account = models.ForeignKey(Account, related_name='entries', on_delete=models.PROTECT)
     entry_type = models.ForeignKey(EntryType, on_delete=models.PROTECT)
     amount = models.ForeignKey(Money, on_delete=models.PROTECT)
     date = models.DateTimeField()
+    is_opening_balance = models.BooleanField(default=False)
+    # Bitemporal: valid_date é quando o lançamento vale (when_occurred do evento),
+    # recorded_at é quando o sistema passou a saber dele
+    valid_date = models.DateTimeField()
+    recorded_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date']),
+            models.Index(fields=['account', 'date']),
+            models.Index(fields=['account', 'valid_date', 'recorded_at']),
+        ]
+
+    objects = EntryQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        entry = super().from_db(db, field_names, values)
+        if {'account_id', 'date', 'amount_id', 'entry_type_id'} <= set(field_names):
+            entry._digested = entry._digest_key()
+        return entry
+
+    def _digest_key(self):
+        return (self.account_id, self.date, self.amount_id, self.entry_type_id)
+
+    def digest_row(self):
+        return (self.account_id, self.id, self.date, self.amount.amount, self.amount.currency_id, self.entry_type_id)
+
+    def save(self, *args, **kwargs):
+        if self.valid_date is None:
+            self.valid_date = self.date
+        # O digest do dia só muda se a entrada é nova ou se os campos do digest mudaram
+        previous = None
+        changed = self._state.adding or getattr(self, '_digested', None) != self._digest_key()
+        if changed and not self._state.adding:
+            previous = Entry.objects.using(self._state.db).filter(pk=self.pk).values_list(*AccountDayDigest.ENTRY_FIELDS).first()
+        super().save(*args, **kwargs)
+        if changed:
+            if previous is not None:
+                AccountDayDigest.record([previous], sign=-1, using=self._state.db)
+            shards = None
+            if Entry.account.is_cached(self):
+                shards = {self.account_id: self.account.balance_shards if self.account.is_hot else 1}
+            AccountDayDigest.record([self.digest_row()], using=self._state.db, shards=shards)
+            self._digested = self._digest_key()
+
+    def delete(self, *args, **kwargs):
+        row = self.digest_row()
+        using = self._state.db
+        result = super().delete(*args, **kwargs)
+        AccountDayDigest.record([row], sign=-1, using=using)
+        return result
+
+    def __str__(self):
+        return f"{self.entry_type} {self.amount} {self.date:%Y-%m-%d}"
+
+class AccountDayDigest(models.Model):
+    # Digest das entradas vivas de uma conta num dia (UTC), atualizado a cada postagem; a
+    # reconciliação (accounts/reconcile.py) compara só estas linhas. O digest é a soma, módulo
+    # MODULUS, do sha256 de cada entrada em duas faixas: somar é comutativo, então uma entrada
+    # nova ou apagada ajusta o dia com um UPDATE, sem reler as demais entradas. Pelo mesmo motivo
+    # o dia de uma conta quente é espalhado em balance_shards linhas (como AccountBalanceShard),
+    # para que as postagens concorrentes não disputem uma única linha; quem lê soma as linhas.
+    MODULUS = 2 ** 61 - 1
+    ENTRY_FIELDS = ('account_id', 'id', 'date', 'amount__amount', 'amount__currency_id', 'entry_type_id')
+
+    account = models.ForeignKey(Account, related_name='day_digests', on_delete=models.CASCADE)
+    day = models.DateField()
+    shard = models.PositiveSmallIntegerField(default=0)
+    low = models.BigIntegerField(default=0)
+    high = models.BigIntegerField(default=0)
+    entries = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('account', 'day', 'shard')
+
+    @staticmethod
+    def line(entry_id, date, amount, currency_id, entry_type_id):
+        date = date.astimezone(datetime.timezone.utc)
+        return f"{entry_id}|{date.isoformat()}|{Decimal(amount).quantize(Decimal('0.01'))}|{currency_id}|{entry_type_id}\n"
+
+    @classmethod
+    def deltas(cls, rows, sign=1):
+        # rows: (account_id, entry_id, date, amount, currency_id, entry_type_id) -> {(conta, dia): [low, high, n]}
+        deltas = {}
+        for account_id, entry_id, date, amount, currency_id, entry_type_id in rows:
+            digest = hashlib.sha256(cls.line(entry_id, date, amount, currency_id, entry_type_id).encode()).digest()
+            low, high = int.from_bytes(digest[:8], 'big') % cls.MODULUS, int.from_bytes(digest[8:16], 'big') % cls.MODULUS
+            if sign < 0:
+                low, high = (cls.MODULUS - low) % cls.MODULUS, (cls.MODULUS - high) % cls.MODULUS
+            total = deltas.setdefault((account_id, date.astimezone(datetime.timezone.utc).date()), [0, 0, 0])
+            total[0] = (total[0] + low) % cls.MODULUS
+            total[1] = (total[1] + high) % cls.MODULUS
+            total[2] += sign
+        return deltas
+
+    @classmethod
+    def record(cls, rows, sign=1, using=None, shards=None):
+        # shards: {account_id: linhas por dia}; sem ele, as contas quentes são buscadas no banco.
+        # Remoções vão sempre para a linha 0: a soma das linhas do dia é a mesma.
+        manager = cls.objects.db_manager(using) if using else cls.objects
+        deltas = cls.deltas(rows, sign)
+        if sign > 0 and shards is None:
+            shards = dict(
+                Account.objects.db_manager(manager.db)
+                .filter(id__in={account_id for account_id, _ in deltas}, is_hot=True)
+                .values_list('id', 'balance_shards')
+            )
+        for (account_id, day), (low, high, count) in deltas.items():
+            spread = shards.get(account_id, 1) if sign > 0 else 1
+            key = {'account_id': account_id, 'day': day, 'shard': random.randrange(spread) if spread > 1 else 0}
+            changes = {'low': (F('low') + low) % cls.MODULUS, 'high': (F('high') + high) % cls.MODULUS, 'entries': F('entries') + count}
+            if manager.filter(**key).update(**changes):
+                continue
+            try:
+                with transaction.atomic(using=manager.db):
+                    manager.create(**key, low=low, high=high, entries=count)
+            except IntegrityError:
+                # Outro processo criou a linha entre o UPDATE e o INSERT
+                manager.filter(**key).update(**changes)
+
+    @classmethod
+    def combine(cls, rows):
+        # rows: (account_id, dia, low, high, entries) de cada linha -> {(conta, dia): (low, high, entries)}
+        combined = {}
+        for account_id, day, low, high, entries in rows:
+            total = combined.setdefault((account_id, day), [0, 0, 0])
+            total[0] = (total[0] + low) % cls.MODULUS
+            total[1] = (total[1] + high) % cls.MODULUS
+            total[2] += entries
+        return {key: tuple(total) for key, total in combined.items()}
+
+    @classmethod
+    def rebuild(cls, account_ids=None, using=None):
+        """Recalcula os digests das contas (todas, sem account_ids) a partir das entradas."""
+        manager = cls.objects.db_manager(using) if using else cls.objects
+        entries = Entry.objects.db_manager(manager.db).all()
+        digests = manager.all()
+        if account_ids is not None:
+            entries, digests = entries.filter(account__in=account_ids), digests.filter(account__in=account_ids)
+        with transaction.atomic(using=manager.db):
+            digests.delete()
+            deltas = cls.deltas(entries.values_list(*cls.ENTRY_FIELDS).iterator())
+            manager.bulk_create([
+                cls(account_id=account_id, day=day, low=low, high=high, entries=count)
+                for (account_id, day), (low, high, count) in deltas.items()
+            ])
+        return len(deltas)
+
+    def __str__(self):
+        return f"Digest {self.account_id} {self.day} ({self.entries})"
+
+class ArchivedEntry(models.Model):
+    # Entradas antigas movidas para fora de accounts_entry pelo comando archive_entries
+    original_id = models.BigIntegerField()
+    account = models.ForeignKey(Account, related_name='archived_entries', on_delete=models.PROTECT)
+    entry_type = models.ForeignKey(EntryType, on_delete=models.PROTECT)
+    amount = models.DecimalField(max_digits=15, decimal_places=2)
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT)
+    date = models.DateTimeField()
+    period = models.CharField(max_length=7)  # AAAA-MM
+    # Eventos que geraram a entrada original (o vínculo resulting_entries some com ela)
+    events = models.ManyToManyField('AccountingEvent', related_name='archived_entries', blank=True)
+    valid_date = models.DateTimeField()
+    recorded_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'date']),
+            models.Index(fields=['period']),
+            models.Index(fields=['account', 'valid_date', 'recorded_at']),
+        ]
+
+class BalanceCheckpoint(models.Model):
+    # Saldo bitemporal pré-calculado: soma das entradas com valid_date <= valid_at e recorded_at <= known_at
+    account = models.ForeignKey(Account, related_name='checkpoints', on_delete=models.CASCADE)
+    valid_at = models.DateTimeField()
+    known_at = models.DateTimeField()
+    amount = models.DecimalField(max_digits=18, decimal_places=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'valid_at', 'known_at']),
+        ]
+
+class AccountArchive(models.Model):
+    # Corte do arquivo de cada conta: entradas anteriores a archived_until estão em ArchivedEntry
+    account = models.OneToOneField(Account, related_name='archive', on_delete=models.PROTECT)
+    archived_until = models.DateTimeField()
+    opening_entry = models.ForeignKey(Entry, null=True, blank=True, on_delete=models.SET_NULL)
+
+class OutboxMessage(models.Model):
+    # Outbox transacional: escrita na mesma transação da postagem e lida pelo dispatch_outbox
+    ENTRY_POSTED = 'entry.posted'
+    ENTRY_REVERSED = 'entry.reversed'
+
+    topic = models.CharField(max_length=50)
+    event_id = models.BigIntegerField(null=True, blank=True)
+    entry_id = models.BigIntegerField(null=True, blank=True)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def record_entry(cls, entry, event, topic, **extra):
+        # event pode ser None para pernas sem evento local (transferências entre shards)
+        amount = entry.amount
+        return cls.objects.create(
+            topic=topic,
+            event_id=event.id if event else None,
+            entry_id=entry.id,
+            payload={
+                'entry_id': entry.id,
+                'event_id': event.id if event else None,
+                'event_type': event.event_type.name if event else None,
+                'customer_id': event.customer_id if event else None,
+                'account_id': entry.account_id,
+                'entry_type': entry.entry_type.name,
+                'amount': str(amount.amount),
+                'currency': amount.currency.code,
+                'date': entry.date.isoformat(),
+                **extra,
+            },
+        )
+
+    def __str__(self):
+        return f"{self.topic} #{self.id}"
+
+class OutboxConsumer(models.Model):
+    # Offset de cada consumidor: último OutboxMessage.id entregue com sucesso
+    name = models.CharField(max_length=100, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.last_id}"
 
 class AccountingEvent(models.Model):
     event_type = models.ForeignKey(EventType, on_delete=models.PROTECT)
-    when_occurred = models.DateTimeField()
+    when_occurred = models.DateTimeField(db_index=True)
     when_noticed = models.DateTimeField()
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
     adjusted_event = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='adjustments')
     resulting_entries = models.ManyToManyField(Entry)
     is_processed = models.BooleanField(default=False)
+    idempotency_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
 
+    @profiled('process')
+    @on_instance_shard
     def process(self):
         print("Processing")
         if self.is_processed:
             raise ValueError('Cannot process an event twice')
-        if self.adjusted_event:
-            self.adjusted_event.reverse()
-        rule = self.find_rule()
-        if rule is not None:
-            rule.process(self)
-            self.is_processed = True
-        else:
-            raise ValueError('No posting rule found for this event')
+        with memory_postings(), shard_atomic():
+            # Marca como processado no banco apenas se ainda não estava, para que um reenvio
+            # concorrente do mesmo evento não gere entradas duplicadas
+            if self.pk and not AccountingEvent.objects.filter(pk=self.pk, is_processed=False).update(is_processed=True):
+                self.is_processed = True
+                raise ValueError('Cannot process an event twice')
+            if self.adjusted_event:
+                self.adjusted_event.reverse()
+            rule = self.find_rule()
+            if rule is not None:
+                rule.process(self)
+                self.is_processed = True
+            else:
+                raise ValueError('No posting rule found for this event')
+
+    @classmethod
+    def get_by_idempotency_key(cls, key):
+        return cls.objects.filter(idempotency_key=key).first()
+
+    @on_instance_shard
+    def defer(self):
+        # Enfileira o evento para um worker do process_events em vez de processar agora
+        job, _ = EventJob.objects.get_or_create(event=self)
+        return job
+
+    def specific(self):
+        # Retorna a instância da subclasse concreta (DepositoAE, TransferEvent, ...) deste evento
+        for subclass in self.__class__.__subclasses__():
+            try:
+                child = getattr(self, subclass._meta.model_name)
+            except (AttributeError, models.ObjectDoesNotExist):
+                continue
+            return child.specific()
+        return self
 
     def find_rule(self):
         print("Procurando Regra de postagem pelo agreement")
@@ -143,42 +760,101 @@ class AccountingEvent(models.Model):
         else:
             raise ValueError('Não foi encontrado uma regra de postagem para esse evento')
 
+    @on_instance_shard
     def reverse(self):
-        for entry in self.resulting_entries.all():
-            reversing_entry = Entry.objects.create(
-                account=entry.account,
-                entry_type=entry.entry_type,
-                amount=entry.amount.negate(),
-                date=timezone.now()
-            )
-            self.customer.add_entry(reversing_entry)
-            self.resulting_entries.add(reversing_entry)
-        self.reverse_secondary_events()
+        from .memledger import unflushed_postings
+        with memory_postings(), shard_atomic():
+            # Pernas do razão em memória ainda não gravadas também são estornadas
+            with unflushed_postings(self) as pending:
+                entries = list(self.resulting_entries.all())
+            for account_id, entry_type_id, amount, valid_date in pending:
+                account = Account.objects.get(id=account_id)
+                self._post_reversal(account, entry_type_id, Money(amount=-amount, currency_id=account.currency_id), valid_date)
+            # Pernas já arquivadas (ver accounts/archive.py) são estornadas por entradas vivas;
+            # o detalhe arquivado fica como está
+            for archived in self.archived_entries.select_related('account', 'entry_type', 'currency'):
+                money = Money.objects.create(amount=-archived.amount, currency=archived.currency)
+                self._post_reversal(archived.account, archived.entry_type, money, archived.valid_date)
+            for entry in entries:
+                # A entrada de estorno fica na mesma conta da entrada original
+                self._post_reversal(entry.account, entry.entry_type, entry.amount.negate(), entry.valid_date)
+            self.reverse_secondary_events()
+
+    def _post_reversal(self, account, entry_type, amount, valid_date):
+        if account.memory_ledger:
+            # O estorno desfaz uma postagem já aceita: não passa pela verificação de saldo
+            return post_to_memory_ledger(account, entry_type, amount, timezone.now(), self, allow_overdraft=True, valid_date=valid_date)
+        reversing_entry = Entry.objects.create(
+            account=account,
+            entry_type=entry_type,
+            amount=amount,
+            date=timezone.now(),
+            valid_date=valid_date,
+        )
+        self.resulting_entries.add(reversing_entry)
+        reversing_entry.account.apply_posting(reversing_entry.amount, reversing_entry.date)
+        OutboxMessage.record_entry(reversing_entry, self, OutboxMessage.ENTRY_REVERSED)
 
     def reverse_secondary_events(self):
-        for secondary_event in self.secondary_events.all():
+        secondary_events = getattr(self, 'secondary_events', None)
+        if secondary_events is None:
+            return
+        for secondary_event in secondary_events.all():
             secondary_event.reverse()
 
+class EventJob(models.Model):
+    # Fila de processamento adiado de eventos (ver accounts/jobs.py)
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    DEAD = 'DEAD'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (DEAD, 'Dead letter')]
+
+    event = models.OneToOneField(AccountingEvent, related_name='job', on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    lease_token = models.CharField(max_length=32, null=True, blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+            models.Index(fields=['status', 'leased_until']),
+            models.Index(fields=['lease_token']),
+        ]
+
+    def __str__(self):
+        return f"Job {self.event_id} {self.status}"
+
 class ServiceAgreement(models.Model):
     rate = models.DecimalField(max_digits=10, decimal_places=2)
 
-    def get_posting_rule(self, event_type, date):
+    # Lista de regras de postagem para cada evento
+    # Todo novo objeto de regra de postagem (PostingRule) deve adicionar seu nome em minúsculo na lista abaixo
+    lista_Posting_rules = ['depositopr', 'saquepr', 'depositpr', 'withdrawalpr', 'transferpr']
 
-        # Lista de regras de postagem para cada evento
-        # Todo novo objeto de regra de postagem (PostingRule) deve adicionar seu nome em minúsculo na lista abaixo
-        lista_Posting_rules = ['depositopr', 'saquepr', 'depositpr', 'withdrawalpr', 'transferpr']
+    def get_posting_rule(self, event_type, date):
 
         print("Getting posting rule for event", event_type)
-        for related_name in lista_Posting_rules:  # Add more as needed
+        from .rules import warm_rule_index
+        index = warm_rule_index()
+        if index is not None:
+            return index.find(self.id, getattr(event_type, 'id', event_type), date)
+        for related_name in self.lista_Posting_rules:  # Add more as needed
             rules = getattr(self, related_name).filter(
-                event_type=event_type, 
+                event_type=event_type,
                 start_date__lte=date
-            ).filter(models.Q(end_date__gte=date) | models.Q(end_date__isnull=True))
+            ).filter(Q(end_date__gte=date) | Q(end_date__isnull=True)).order_by('id')
             rule = rules.first()
             if rule:
                 return rule
         return None
-    
+
 class PostingRule(models.Model):
     service_agreement = models.ForeignKey(ServiceAgreement, related_name='%(class)s', on_delete=models.PROTECT)
     event_type = models.ForeignKey(EventType, on_delete=models.PROTECT)
@@ -189,24 +865,77 @@ class PostingRule(models.Model):
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.__dict__.pop('plan', None)
+        from .rules import invalidate_rules
+        invalidate_rules()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        from .rules import invalidate_rules
+        invalidate_rules()
+        return result
+
+    @cached_property
+    def plan(self):
+        return self.compile_plan()
+
+    def compile_plan(self):
+        # Subclasses sem plano (None) são calculadas por calculate_amount
+        return None
+
     def process(self, event):
-        if self.is_transfer():
-            a = self.calculate_amount(event)
-            
-        else:
-            amount = self.calculate_amount(event)
-            self.make_entry(event, amount)
+        # Todas as pernas da postagem (e as mensagens do outbox) na mesma transação
+        with shard_atomic():
+            if self.plan is not None:
+                self.process_plan(event)
+            elif self.is_transfer():
+                a = self.calculate_amount(event)
 
-    def make_entry(self, event, amount):
-        entry = Entry.objects.create(
-            account=event.customer.accounts.get(account_type=self.entry_type.account_type),
-            entry_type=self.entry_type,
-            amount=amount,
-            date=event.when_noticed
+            else:
+                amount = self.calculate_amount(event)
+                self.make_entry(event, amount)
+
+    def process_plan(self, event):
+        # Calcula as pernas pelo plano e cria só o Money de cada entrada; uma perna igual ao valor
+        # do evento reaproveita event.amount, como calculate_amount faz
+        source = event.amount
+        currencies = {source.currency.code: source.currency}
+        accounts = {role: getattr(event, role) for role in self.plan.roles if role != ACCOUNT}
+        currencies.update({account.currency.code: account.currency for account in accounts.values()})
+        legs = self.plan.apply(
+            source.amount, source.currency.code, event.when_occurred,
+            balance=event.account.balance() if self.plan.check_funds else None,
+            currencies={role: account.currency.code for role, account in accounts.items()},
         )
-        print(f"Entrada: {self.entry_type} Valor: {amount} Evento: {event.event_type}")
-        event.customer.add_entry(entry)
-        event.resulting_entries.add(entry)
+        amounts = [
+            (role, source if value is source.amount else Money.objects.create(amount=value, currency=currencies[code]))
+            for role, value, code in legs
+        ]
+        for role, amount in amounts:
+            if role == ACCOUNT:
+                self.make_entry(event, amount)
+            else:
+                self.make_entry_with_account(event, amount, accounts[role])
+
+    def make_entry(self, event, amount):
+        account = event.customer.accounts.get(account_type=self.entry_type.account_type)
+        if account.memory_ledger:
+            return post_to_memory_ledger(account, self.entry_type, amount, event.when_noticed, event, valid_date=event.when_occurred)
+        with shard_atomic():
+            entry = Entry.objects.create(
+                account=account,
+                entry_type=self.entry_type,
+                amount=amount,
+                date=event.when_noticed,
+                valid_date=event.when_occurred,
+            )
+            print(f"Entrada: {self.entry_type} Valor: {amount} Evento: {event.event_type}")
+            event.customer.add_entry(entry)
+            event.resulting_entries.add(entry)
+            entry.account.apply_posting(amount, entry.date)
+            OutboxMessage.record_entry(entry, event, OutboxMessage.ENTRY_POSTED)
 
     def calculate_amount(self, event):
         raise NotImplementedError("Subclasses must implement calculate_amount")
@@ -265,6 +994,9 @@ class DepositoAE(AccountingEvent):
 
 class DepositoPR(PostingRule):
     
+    def compile_plan(self):
+        return CalculationPlan([(ACCOUNT, 1)])
+
     def calculate_amount(self, event):
         return event.amount
 
@@ -273,7 +1005,10 @@ class SaqueAE(AccountingEvent):
     amount = models.ForeignKey(Money, on_delete=models.PROTECT)
 
 class SaquePR(PostingRule):
-    
+
+    def compile_plan(self):
+        return CalculationPlan([(ACCOUNT, -1)], check_funds=True)
+
     def calculate_amount(self, event):
         # Verify that the account amount is more than the saque amount
         if event.amount.amount > event.account.balance():
@@ -288,6 +1023,75 @@ class TaxEvent(AccountingEvent):
 class AmountAdd(PostingRule):
     multiplier = models.DecimalField(max_digits=10, decimal_places=5)
     fixedFee = models.ForeignKey(Money, on_delete=models.PROTECT)
+
+    def compile_plan(self):
+        return CalculationPlan(
+            [(ACCOUNT, 1)], multiplier=Decimal(self.multiplier), fee=self.fixedFee.amount, fee_currency=self.fixedFee.currency.code
+        )
+
     def calculate_amount(self, event):
         eventAmount = event.amount
         return eventAmount.multiply(self.multiplier).add(self.fixedFee)
+
+class AccrualRun(models.Model):
+    # Uma execução do motor de acúmulo (accounts/accrual.py) por acordo e data; permite retomar
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+
+    service_agreement = models.ForeignKey(ServiceAgreement, related_name='accrual_runs', on_delete=models.PROTECT)
+    run_date = models.DateField()
+    status = models.CharField(max_length=10, default=RUNNING)
+    accounts = models.PositiveIntegerField(default=0)
+    interest_total = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    fee_total = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('service_agreement', 'run_date')
+
+    def __str__(self):
+        return f"Accrual {self.service_agreement_id} {self.run_date} {self.status}"
+
+class LedgerRebuild(models.Model):
+    # Uma reconstrução de entradas a partir do histórico de eventos (accounts/replay.py)
+    SHADOWED = 'SHADOWED'
+    SWAPPED = 'SWAPPED'
+
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    customer_ids = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=10, default=SHADOWED)
+    report = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    swapped_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Rebuild {self.id} {self.start:%Y-%m-%d}..{self.end:%Y-%m-%d} {self.status}"
+
+class LedgerPeriodSummary(models.Model):
+    # Resultado do GL de um mês fechado (accounts/reports.py), calculado uma vez por shard
+    period = models.CharField(max_length=7, unique=True)  # AAAA-MM
+    rows = models.JSONField(default=list)
+    # period_watermark() no momento do cálculo; se mudar, o mês é recalculado
+    watermark = models.CharField(max_length=64, default='')
+    computed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"GL {self.period}"
+
+class ShadowEntry(models.Model):
+    # Entradas reconstruídas, gravadas aqui antes da troca atômica com accounts_entry
+    rebuild = models.ForeignKey(LedgerRebuild, related_name='entries', on_delete=models.CASCADE)
+    event = models.ForeignKey(AccountingEvent, on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    entry_type = models.ForeignKey(EntryType, on_delete=models.PROTECT)
+    amount = models.DecimalField(max_digits=15, decimal_places=2)
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT)
+    date = models.DateTimeField()
+    valid_date = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['rebuild', 'account']),
+        ]
@@ -0,0 +1,142 @@
+import json
+import os
+import queue
+import socket
+import time
+
+
+from .models import OutboxConsumer, OutboxMessage
+from .sharding import shard_atomic
+
+
+def serialize(message):
+    return {
+        'id': message.id,
+        'topic': message.topic,
+        'created_at': message.created_at.isoformat(),
+        'payload': message.payload,
+    }
+
+
+class FileSink:
+    # Uma mensagem JSON por linha; fsync antes de confirmar o lote
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, messages):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for message in messages:
+                f.write(json.dumps(message) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        pass
+
+
+class UnixSocketSink:
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._socket = None
+
+    def _connect(self):
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._socket = sock
+        return self._socket
+
+    def send(self, messages):
+        data = ''.join(json.dumps(message) + '\n' for message in messages).encode('utf-8')
+        try:
+            self._connect().sendall(data)
+        except OSError:
+            # Reconecta no próximo lote; o offset não avança, então o lote é reenviado
+            self.close()
+            raise
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+_queues = {}
+
+
+def get_queue(name):
+    return _queues.setdefault(name, queue.Queue())
+
+
+class QueueSink:
+    def __init__(self, name):
+        self.queue = get_queue(name)
+
+    def send(self, messages):
+        for message in messages:
+            self.queue.put(message)
+
+    def close(self):
+        pass
+
+
+SINKS = {
+    'file': FileSink,
+    'unix': UnixSocketSink,
+    'queue': QueueSink,
+}
+
+
+def get_sink(spec):
+    # Formato "tipo:alvo", por exemplo "file:/tmp/feed.jsonl", "unix:/tmp/feed.sock" ou "queue:reports"
+    kind, _, target = spec.partition(':')
+    if kind not in SINKS or not target:
+        raise ValueError(f"Invalid sink '{spec}', expected one of: {', '.join(f'{k}:<target>' for k in SINKS)}")
+    return SINKS[kind](target)
+
+
+class OutboxDispatcher:
+    """Entrega as mensagens do outbox em lotes, com entrega pelo menos uma vez.
+
+    O offset do consumidor só avança depois que o sink aceita o lote inteiro,
+    então uma falha no meio do caminho faz o lote ser reenviado.
+    """
+
+    def __init__(self, consumer_name, sink, batch_size=500):
+        self.consumer_name = consumer_name
+        self.sink = sink
+        self.batch_size = batch_size
+
+    def consumer(self):
+        consumer, _ = OutboxConsumer.objects.get_or_create(name=self.consumer_name)
+        return consumer
+
+    def dispatch_batch(self):
+        consumer = self.consumer()
+        messages = list(
+            OutboxMessage.objects.filter(id__gt=consumer.last_id).order_by('id')[:self.batch_size]
+        )
+        if not messages:
+            return 0
+        self.sink.send([serialize(message) for message in messages])
+        with shard_atomic():
+            OutboxConsumer.objects.filter(id=consumer.id, last_id=consumer.last_id).update(last_id=messages[-1].id)
+        return len(messages)
+
+    def run(self, follow=False, poll_interval=1.0, max_batches=None):
+        sent = 0
+        batches = 0
+        try:
+            while max_batches is None or batches < max_batches:
+                count = self.dispatch_batch()
+                sent += count
+                batches += 1
+                if count < self.batch_size:
+                    if not follow:
+                        break
+                    time.sleep(poll_interval)
+        finally:
+            self.sink.close()
+        return sent
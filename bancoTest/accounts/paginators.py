@@ -0,0 +1,40 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+# Abaixo deste tamanho o COUNT(*) exato é barato o suficiente
+EXACT_COUNT_THRESHOLD = 10000
+
+
+def estimate_row_count(model, using='default'):
+    # Estimativa do número de linhas sem varrer a tabela; None se o banco não suportar
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute("SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s", [table])
+        elif connection.vendor == 'sqlite':
+            # MAX(rowid) é resolvido pela própria árvore da tabela
+            cursor.execute(f"SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}")
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return 0
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    # Para listas sem filtro usa a estimativa do banco em vez de COUNT(*) na tabela inteira
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        query = getattr(queryset, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > EXACT_COUNT_THRESHOLD:
+                return estimate
+        return super().count
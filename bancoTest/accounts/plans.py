@@ -0,0 +1,70 @@
+# Planos de cálculo das regras de postagem.
+#
+# PostingRule.compile_plan() captura uma vez os parâmetros da regra (sinal de cada perna,
+# multiplicador, tarifa fixa, verificação de saldo) num CalculationPlan, que calcula as pernas
+# sobre valores simples (Decimal e código de moeda), sem criar Money nem consultar o banco.
+# PostingRule.process e o replay (accounts/replay.py) usam o plano; calculate_amount continua
+# sendo a implementação de referência, e os testes comparam as duas.
+
+# Papéis das pernas: ACCOUNT é a conta do cliente com o tipo de conta da regra, na moeda do
+# evento; FROM_ACCOUNT/TO_ACCOUNT são as contas do próprio evento, na moeda de cada conta.
+ACCOUNT = 'account'
+FROM_ACCOUNT = 'from_account'
+TO_ACCOUNT = 'to_account'
+
+
+class CalculationPlan:
+    """Pernas (papel, sinal) aplicadas a amount * multiplier + fee.
+
+    Imutável depois de compilado; o mesmo plano serve para todos os eventos da regra.
+    """
+
+    __slots__ = ('legs', 'multiplier', 'fee', 'fee_currency', 'check_funds')
+
+    def __init__(self, legs, multiplier=None, fee=None, fee_currency=None, check_funds=False):
+        self.legs = tuple(legs)
+        self.multiplier = multiplier
+        self.fee = fee
+        self.fee_currency = fee_currency
+        self.check_funds = check_funds
+
+    def __repr__(self):
+        return (f"CalculationPlan(legs={self.legs!r}, multiplier={self.multiplier!r}, "
+                f"fee={self.fee!r} {self.fee_currency}, check_funds={self.check_funds})")
+
+    @property
+    def roles(self):
+        return [role for role, _ in self.legs]
+
+    def apply(self, amount, currency, when=None, balance=None, currencies=None, convert=None):
+        """[(papel, valor, moeda)] de um evento de `amount` na moeda `currency`.
+
+        balance é o saldo da conta do evento (obrigatório com check_funds); currencies mapeia
+        FROM_ACCOUNT/TO_ACCOUNT para a moeda da conta; convert(amount, de, para, when) é por
+        padrão o serviço de conversão em memória. Sem multiplicador nem tarifa, uma perna
+        positiva na moeda do evento devolve o próprio objeto `amount`.
+        """
+        if self.check_funds:
+            if balance is None:
+                raise ValueError('Balance required to check funds')
+            if amount > balance:
+                raise ValueError('Insufficient funds')
+        value = amount
+        if self.multiplier is not None:
+            value = value * self.multiplier
+        if self.fee is not None:
+            if self.fee_currency != currency:
+                raise ValueError('Currencies must match')
+            value = value + self.fee
+        legs = []
+        for role, sign in self.legs:
+            target, leg = currency, value
+            if role != ACCOUNT:
+                target = currencies[role]
+                if target != currency:
+                    if convert is None:
+                        from .conversion import get_conversion_service
+                        convert = get_conversion_service().convert
+                    leg = convert(value, currency, target, when)
+            legs.append((role, -leg if sign < 0 else leg, target))
+        return legs
@@ -0,0 +1,169 @@
+import datetime
+import hashlib
+import multiprocessing
+from decimal import Decimal
+
+from django.apps import apps
+from django.db import connections
+from django.db.models import Case, F, Q, Sum, Value, When
+
+from .archive import in_account_currency
+from .models import Account, AccountArchive, AccountDayDigest, AccountingEvent, ArchivedEntry, Entry, conversion_service
+
+TOLERANCE = Decimal('0.01')
+
+
+def account_digests(account_ids, using='default'):
+    """Árvore de digests das contas: {account_id: {'root': hex, 'days': {dia: digest}}}.
+
+    Lê só os digests gravados em AccountDayDigest (mantidos a cada postagem), sem varrer as
+    entradas; a raiz da conta é o sha256 dos pares (dia, digest).
+    """
+    rows = (
+        AccountDayDigest.objects.using(using)
+        .filter(account__in=account_ids)
+        .order_by('account', 'day', 'shard')
+        .values_list('account', 'day', 'low', 'high', 'entries')
+    )
+    days = {}
+    # Contas quentes têm várias linhas por dia (AccountDayDigest.shard), somadas aqui
+    for (account_id, day), (low, high, entries) in AccountDayDigest.combine(rows).items():
+        if entries:
+            days.setdefault(account_id, {})[day.isoformat()] = f"{low:016x}{high:016x}:{entries}"
+
+    tree = {}
+    for account_id in account_ids:
+        account_days = days.get(account_id, {})
+        root = hashlib.sha256()
+        for day, digest in account_days.items():
+            root.update(f"{day}:{digest}\n".encode())
+        tree[account_id] = {'root': root.hexdigest(), 'days': account_days}
+    return tree
+
+
+def _day_entries(account_id, day, using):
+    # Os digests são por dia UTC
+    start = datetime.datetime.combine(datetime.date.fromisoformat(day), datetime.time(), datetime.timezone.utc)
+    return {
+        entry_id: (date, amount, currency_id, entry_type_id)
+        for entry_id, date, amount, currency_id, entry_type_id in Entry.objects.using(using)
+        .filter(account=account_id, date__gte=start, date__lt=start + datetime.timedelta(days=1))
+        .values_list('id', 'date', 'amount__amount', 'amount__currency_id', 'entry_type')
+    }
+
+
+def diff_trees(primary, replica):
+    # Compara raízes e só desce para os dias das contas divergentes: {account_id: [dias]}
+    divergent = {}
+    for account_id in set(primary) | set(replica):
+        left = primary.get(account_id, {'root': None, 'days': {}})
+        right = replica.get(account_id, {'root': None, 'days': {}})
+        if left['root'] == right['root']:
+            continue
+        days = sorted(day for day in set(left['days']) | set(right['days']) if left['days'].get(day) != right['days'].get(day))
+        divergent[account_id] = days
+    return divergent
+
+
+def diff_partition(account_ids, primary='default', replica='replica'):
+    divergent = diff_trees(account_digests(account_ids, primary), account_digests(account_ids, replica))
+    report = {}
+    for account_id, days in divergent.items():
+        report[account_id] = []
+        for day in days:
+            left, right = _day_entries(account_id, day, primary), _day_entries(account_id, day, replica)
+            report[account_id].append({
+                'day': day,
+                'missing_in_replica': sorted(set(left) - set(right)),
+                'missing_in_primary': sorted(set(right) - set(left)),
+                'changed': sorted(i for i in set(left) & set(right) if left[i] != right[i]),
+            })
+    return report
+
+
+def _diff_in_worker(args):
+    try:
+        return diff_partition(*args)
+    finally:
+        connections.close_all()
+
+
+def processed_events_without_entries(using='default'):
+    return list(
+        AccountingEvent.objects.using(using)
+        .filter(is_processed=True, resulting_entries__isnull=True, archived_entries__isnull=True)
+        .values_list('id', flat=True)
+    )
+
+
+def unbalanced_transfers(using='default'):
+    # Transferências cujas pernas (convertidas para a moeda do evento) não somam zero
+    TransferEvent = apps.get_model('transaction', 'TransferEvent')
+    rows = (
+        TransferEvent.objects.using(using)
+        .filter(is_processed=True)
+        .values('id', 'when_occurred', 'amount__currency__code', 'resulting_entries__amount__currency__code')
+        .annotate(total=Sum('resulting_entries__amount__amount'))
+    )
+    totals = {}
+    for row in rows:
+        if row['total'] is None:
+            continue
+        total = row['total']
+        if row['resulting_entries__amount__currency__code'] != row['amount__currency__code']:
+            total = conversion_service().convert(total, row['resulting_entries__amount__currency__code'], row['amount__currency__code'], row['when_occurred'])
+        totals[row['id']] = totals.get(row['id'], Decimal('0.00')) + total
+    # Com conversão de câmbio cada perna é arredondada; tolera um centavo por perna
+    return sorted(event_id for event_id, total in totals.items() if abs(total) > TOLERANCE * 2)
+
+
+def archive_mismatches(using='default'):
+    # Contas cujo saldo de abertura difere da soma das entradas arquivadas, convertidas para a
+    # moeda da conta como archive_account faz (entrada a entrada, na taxa da data da entrada)
+    foreign = ~Q(currency=F('account__currency'))
+    rows = (
+        ArchivedEntry.objects.using(using)
+        .values(
+            'account', 'account__currency__code', 'currency__code',
+            converted=Case(When(foreign, then=F('id')), default=Value(None)),
+            converted_at=Case(When(foreign, then=F('date')), default=Value(None)),
+        )
+        .annotate(total=Sum('amount'))
+        .values_list('account', 'account__currency__code', 'currency__code', 'converted_at', 'total')
+    )
+    archived = {}
+    for account_id, account_code, code, converted_at, total in rows:
+        if converted_at is not None:
+            total = in_account_currency(total, code, account_code, converted_at)
+        archived[account_id] = archived.get(account_id, Decimal('0.00')) + total
+    mismatches = []
+    for account_id, opening in AccountArchive.objects.using(using).values_list('account', 'opening_entry__amount__amount'):
+        if (opening or Decimal('0.00')) != archived.get(account_id, Decimal('0.00')):
+            mismatches.append(account_id)
+    return mismatches
+
+
+def reconcile(primary='default', replica=None, workers=1, partition_size=500):
+    report = {
+        'processed_events_without_entries': processed_events_without_entries(primary),
+        'unbalanced_transfers': unbalanced_transfers(primary),
+        'archive_mismatches': archive_mismatches(primary),
+        'divergent_accounts': {},
+    }
+    if replica is None:
+        return report
+
+    account_ids = sorted(
+        set(Account.objects.using(primary).values_list('id', flat=True))
+        | set(Account.objects.using(replica).values_list('id', flat=True))
+    )
+    partitions = [(account_ids[i:i + partition_size], primary, replica) for i in range(0, len(account_ids), partition_size)]
+    if workers <= 1:
+        results = [diff_partition(*partition) for partition in partitions]
+    else:
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.map(_diff_in_worker, partitions)
+    for result in results:
+        report['divergent_accounts'].update(result)
+    return report
@@ -0,0 +1,409 @@
+import multiprocessing
+from decimal import Decimal
+
+from django.db import connections
+from django.db.models import Case, F, Q, Sum, Value, When
+from django.utils import timezone
+
+from .conversion import get_conversion_service
+from .models import (
+    Account,
+    AccountingEvent,
+    Customer,
+    Entry,
+    LedgerPeriodSummary,
+    LedgerRebuild,
+    Money,
+    OutboxMessage,
+    ServiceAgreement,
+    ShadowEntry,
+)
+from .plans import ACCOUNT
+from .reports import period_key
+from .sharding import shard_atomic
+
+ENTRY_REBUILT = 'entry.rebuilt'
+
+
+def concrete_event_models():
+    models, stack = [], list(AccountingEvent.__subclasses__())
+    while stack:
+        model = stack.pop()
+        if not model._meta.abstract and not model._meta.proxy:
+            models.append(model)
+        stack += model.__subclasses__()
+    return models
+
+
+def event_details(event_ids):
+    # Campos das subclasses (valor, contas) de vários eventos, com uma consulta por subclasse
+    details = {}
+    for model in concrete_event_models():
+        local = {field.name for field in model._meta.local_fields}
+        if 'amount' not in local:
+            continue
+        fields = ['id', 'amount__amount', 'amount__currency_id', 'amount__currency__code']
+        fields += [name for name in ('account', 'from_account', 'to_account') if name in local]
+        for row in model.objects.filter(id__in=event_ids).values(*fields):
+            row['model'] = model.__name__
+            details[row['id']] = row
+    return details
+
+
+class RuleCache:
+    # Todas as regras de postagem dos acordos carregadas uma vez, na mesma precedência de get_posting_rule
+    def __init__(self, agreement_ids):
+        self._rules = {}
+        for name in ServiceAgreement.lista_Posting_rules:
+            model = ServiceAgreement._meta.get_field(name).related_model
+            rules = model.objects.filter(service_agreement__in=agreement_ids).select_related('entry_type').order_by('id')
+            for rule in rules:
+                self._rules.setdefault((rule.service_agreement_id, rule.event_type_id), []).append(rule)
+
+    def find(self, agreement_id, event_type_id, when):
+        for rule in self._rules.get((agreement_id, event_type_id), []):
+            if rule.start_date <= when and (rule.end_date is None or rule.end_date >= when):
+                return rule
+        return None
+
+
+class ReplayContext:
+    # Estado em memória de uma partição: contas por cliente e tipo, moedas e saldos correntes
+    def __init__(self, customer_ids):
+        self.accounts_by_type = {}
+        self.currencies = {}
+        rows = Account.objects.filter(customer__in=customer_ids).values_list('customer', 'id', 'account_type', 'currency', 'currency__code')
+        for customer_id, account_id, account_type_id, currency_id, code in rows:
+            self.accounts_by_type.setdefault(customer_id, {}).setdefault(account_type_id, account_id)
+            self.currencies[account_id] = (currency_id, code)
+        self.balances = {}
+
+    def post(self, account_id, amount, currency_id, code, date):
+        # Soma ao saldo corrente na moeda da conta, convertendo na data da entrada como Account.balance
+        account_currency_id, account_code = self.currencies[account_id]
+        if currency_id != account_currency_id:
+            amount = get_conversion_service().convert(amount, code, account_code, date)
+        self.balances[account_id] = self.balances.get(account_id, Decimal('0.00')) + amount
+
+    def load_accounts(self, account_ids):
+        missing = [a for a in account_ids if a not in self.currencies]
+        if missing:
+            self.currencies.update({
+                account_id: (currency_id, code)
+                for account_id, currency_id, code in Account.objects.filter(id__in=missing).values_list('id', 'currency', 'currency__code')
+            })
+
+    def customer_account(self, customer_id, account_type_id):
+        account_id = self.accounts_by_type.get(customer_id, {}).get(account_type_id)
+        if account_id is None:
+            raise ValueError('Customer has no account for this entry type')
+        return account_id
+
+
+def calculate_legs(rule, event, detail, context):
+    """Pernas de uma postagem calculadas em memória: [(account_id, amount, currency_id)].
+
+    Aplica o plano compilado da regra (accounts/plans.py) sem criar Money nem Entry.
+    """
+    plan = rule.plan
+    if plan is None:
+        raise ValueError(f'Posting rule {type(rule).__name__} cannot be replayed')
+    amount, currency_id, code = detail['amount__amount'], detail['amount__currency_id'], detail['amount__currency__code']
+    accounts = {role: detail[role] for role in plan.roles if role != ACCOUNT}
+    context.load_accounts(list(accounts.values()))
+    legs = plan.apply(
+        amount, code, event['when_occurred'],
+        balance=context.balances.get(detail.get('account'), Decimal('0.00')) if plan.check_funds else None,
+        currencies={role: context.currencies[account_id][1] for role, account_id in accounts.items()},
+    )
+    return [
+        (context.customer_account(event['customer_id'], rule.entry_type.account_type_id), value, currency_id)
+        if role == ACCOUNT else (accounts[role], value, context.currencies[accounts[role]][0])
+        for role, value, _ in legs
+    ]
+
+
+def existing_entries(event_ids):
+    # {event_id: [(entry_id, account_id, amount)]}
+    through = AccountingEvent.resulting_entries.through
+    entries = {}
+    rows = through.objects.filter(accountingevent_id__in=event_ids).values_list(
+        'accountingevent_id', 'entry_id', 'entry__account_id', 'entry__amount__amount'
+    )
+    for event_id, entry_id, account_id, amount in rows:
+        entries.setdefault(event_id, []).append((entry_id, account_id, amount))
+    return entries
+
+
+def is_reversed(entries):
+    totals = {}
+    for _, account_id, amount in entries:
+        totals[account_id] = totals.get(account_id, Decimal('0.00')) + amount
+    return all(total == 0 for total in totals.values())
+
+
+class ReplayEngine:
+    """Reconstrói as entradas de eventos já processados a partir do histórico.
+
+    Os eventos do período (opcionalmente de alguns clientes) são lidos em ordem de
+    when_occurred, as regras são resolvidas num cache em memória e as pernas
+    recalculadas sem escrita no banco. O resultado vai para ShadowEntry, em paralelo
+    por partição de clientes; swap() estorna as entradas antigas e grava as novas numa
+    única transação. Eventos estornados (entradas que se anulam) ou sem entradas
+    vivas (por exemplo, arquivadas) são mantidos como estão.
+    """
+
+    def __init__(self, start, end, customer_ids=None, workers=1, batch_size=2000):
+        self.start = start
+        self.end = end
+        self.customer_ids = customer_ids
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def events(self, customer_ids):
+        return (
+            AccountingEvent.objects.filter(
+                is_processed=True, when_occurred__gte=self.start, when_occurred__lt=self.end, customer__in=customer_ids
+            )
+            .order_by('when_occurred', 'id')
+            .values('id', 'event_type_id', 'customer_id', 'customer__service_agreement_id', 'when_occurred', 'when_noticed')
+        )
+
+    def customers(self):
+        customers = Customer.objects.all()
+        if self.customer_ids is not None:
+            customers = customers.filter(id__in=self.customer_ids)
+        return list(customers.order_by('id').values_list('id', flat=True))
+
+    def opening_balances(self, context, customer_ids):
+        """Carrega em context.balances o saldo de cada conta em self.start.
+
+        Devolve, em ordem de valid_date, as demais entradas do período que não pertencem a
+        eventos reconstruídos (estornos, ordens permanentes, juros...), para que replay_partition
+        as aplique entre os eventos e a verificação de saldo veja o saldo da data de cada evento.
+        """
+        through = AccountingEvent.resulting_entries.through
+        replayed = through.objects.filter(accountingevent__in=self.events(customer_ids).values('id')).values('entry_id')
+        entries = Entry.objects.filter(account__customer__in=customer_ids, valid_date__lt=self.end).exclude(id__in=replayed)
+        # Entradas em outra moeda são agrupadas também pela data, para a conversão na taxa da data
+        converted_at = Case(When(amount__currency=F('account__currency'), then=Value(None)), default=F('date'))
+        rows = (
+            entries.filter(valid_date__lt=self.start)
+            .annotate(converted_at=converted_at)
+            .values('account', 'amount__currency', 'amount__currency__code', 'converted_at')
+            .annotate(total=Sum('amount__amount'))
+            .order_by()
+        )
+        context.balances = {}
+        for row in rows:
+            context.post(row['account'], row['total'], row['amount__currency'], row['amount__currency__code'], row['converted_at'])
+        return (
+            entries.filter(valid_date__gte=self.start)
+            .order_by('valid_date', 'id')
+            .values_list('account', 'amount__amount', 'amount__currency', 'amount__currency__code', 'date', 'valid_date')
+            .iterator(chunk_size=self.batch_size)
+        )
+
+    def replay_partition(self, rebuild_id, customer_ids, rules):
+        context = ReplayContext(customer_ids)
+        later = self.opening_balances(context, customer_ids)
+        upcoming = next(later, None)
+        summary = {'replayed': 0, 'skipped': [], 'failed': {}, 'old': {}, 'new': {}}
+        now = timezone.now()
+
+        events = self.events(customer_ids).iterator(chunk_size=self.batch_size)
+        batch = []
+        while True:
+            chunk = [event for _, event in zip(range(self.batch_size), events)]
+            if not chunk:
+                break
+            ids = [event['id'] for event in chunk]
+            details = event_details(ids)
+            current = existing_entries(ids)
+            for event in chunk:
+                while upcoming is not None and upcoming[-1] < event['when_occurred']:
+                    context.post(*upcoming[:-1])
+                    upcoming = next(later, None)
+                entries = current.get(event['id'], [])
+                if not entries or is_reversed(entries) or event['id'] not in details:
+                    summary['skipped'].append(event['id'])
+                    continue
+                rule = rules.find(event['customer__service_agreement_id'], event['event_type_id'], event['when_occurred'])
+                try:
+                    if rule is None:
+                        raise ValueError('No posting rule found for this event')
+                    legs = calculate_legs(rule, event, details[event['id']], context)
+                except ValueError as e:
+                    summary['failed'][event['id']] = str(e)
+                    continue
+                summary['replayed'] += 1
+                for _, account_id, amount in entries:
+                    summary['old'][account_id] = summary['old'].get(account_id, Decimal('0.00')) + amount
+                for account_id, amount, currency_id in legs:
+                    context.post(account_id, amount, currency_id, details[event['id']]['amount__currency__code'], event['when_noticed'])
+                    summary['new'][account_id] = summary['new'].get(account_id, Decimal('0.00')) + amount
+                    batch.append(ShadowEntry(
+                        rebuild_id=rebuild_id,
+                        event_id=event['id'],
+                        account_id=account_id,
+                        entry_type_id=rule.entry_type_id,
+                        amount=amount,
+                        currency_id=currency_id,
+                        date=event['when_noticed'],
+                        valid_date=event['when_occurred'],
+                    ))
+            if len(batch) >= self.batch_size:
+                ShadowEntry.objects.bulk_create(batch)
+                batch = []
+        ShadowEntry.objects.bulk_create(batch)
+        return summary
+
+    def shadow(self):
+        customer_ids = self.customers()
+        rebuild = LedgerRebuild.objects.create(start=self.start, end=self.end, customer_ids=self.customer_ids or [])
+        agreement_ids = set(Customer.objects.filter(id__in=customer_ids).values_list('service_agreement', flat=True))
+        rules = RuleCache(agreement_ids)
+
+        workers = max(1, min(self.workers, len(customer_ids)))
+        partitions = [customer_ids[i::workers] for i in range(workers)]
+        if workers == 1:
+            summaries = [self.replay_partition(rebuild.id, partitions[0], rules)]
+        else:
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                summaries = pool.map(_replay_in_worker, [(self, rebuild.id, partition, rules) for partition in partitions])
+
+        rebuild.report = self.diff_report(summaries)
+        rebuild.save(update_fields=['report'])
+        return rebuild
+
+    def diff_report(self, summaries):
+        old, new = {}, {}
+        report = {'replayed': 0, 'skipped': [], 'failed': {}, 'accounts': {}}
+        for summary in summaries:
+            report['replayed'] += summary['replayed']
+            report['skipped'] += summary['skipped']
+            report['failed'].update({str(k): v for k, v in summary['failed'].items()})
+            for target, values in ((old, summary['old']), (new, summary['new'])):
+                for account_id, amount in values.items():
+                    target[account_id] = target.get(account_id, Decimal('0.00')) + amount
+        for account_id in sorted(set(old) | set(new)):
+            before, after = old.get(account_id, Decimal('0.00')), new.get(account_id, Decimal('0.00'))
+            if before != after:
+                report['accounts'][str(account_id)] = {'before': str(before), 'after': str(after), 'delta': str(after - before)}
+        return report
+
+    def swap(self, rebuild):
+        """Troca atômica das entradas dos eventos reconstruídos pelas novas.
+
+        As entradas antigas não são apagadas: cada evento recebe entradas de estorno (mesma
+        date e valid_date das antigas, recorded_at agora) e depois as novas, de modo que
+        bitemporal_balance e os BalanceCheckpoint continuam valendo para o que se sabia antes.
+        """
+        through = AccountingEvent.resulting_entries.through
+        with shard_atomic():
+            rebuild = LedgerRebuild.objects.select_for_update().get(id=rebuild.id)
+            if rebuild.status == LedgerRebuild.SWAPPED:
+                return rebuild
+            event_ids = list(ShadowEntry.objects.filter(rebuild=rebuild).values_list('event', flat=True).distinct())
+            touched = set(ShadowEntry.objects.filter(rebuild=rebuild).values_list('account', flat=True).distinct())
+            # O saldo das contas do razão em memória fica no motor (accounts/memledger.py), que não
+            # vê entradas trocadas por baixo dele: essas contas não podem ser reconstruídas
+            owned = sorted(set(
+                Account.objects.exclude(memory_ledger='')
+                .filter(Q(id__in=touched) | Q(entries__accountingevent__in=event_ids))
+                .values_list('id', flat=True)
+            ))
+            if owned:
+                raise ValueError(f'Cannot swap entries of memory-ledger accounts {owned}')
+            for start in range(0, len(event_ids), self.batch_size):
+                chunk = event_ids[start:start + self.batch_size]
+                # Um estorno por grupo com saldo: entradas já estornadas numa troca anterior se anulam
+                rows = (
+                    through.objects.filter(accountingevent_id__in=chunk)
+                    .values(
+                        'accountingevent_id', 'entry__account_id', 'entry__entry_type_id', 'entry__entry_type__name',
+                        'entry__amount__currency_id', 'entry__amount__currency__code', 'entry__date', 'entry__valid_date',
+                    )
+                    .annotate(total=Sum('entry__amount__amount'))
+                    .exclude(total=0)
+                    .order_by()
+                )
+                old = list(rows)
+                touched.update(row['entry__account_id'] for row in old)
+                monies = Money.objects.bulk_create([
+                    Money(amount=-row['total'], currency_id=row['entry__amount__currency_id']) for row in old
+                ])
+                reversals = Entry.objects.bulk_create([
+                    Entry(
+                        account_id=row['entry__account_id'], entry_type_id=row['entry__entry_type_id'], amount=money,
+                        date=row['entry__date'], valid_date=row['entry__valid_date'],
+                    )
+                    for row, money in zip(old, monies)
+                ])
+                through.objects.bulk_create([
+                    through(accountingevent_id=row['accountingevent_id'], entry_id=entry.id) for row, entry in zip(old, reversals)
+                ])
+                OutboxMessage.objects.bulk_create([
+                    OutboxMessage(topic=OutboxMessage.ENTRY_REVERSED, event_id=row['accountingevent_id'], entry_id=entry.id, payload={
+                        'entry_id': entry.id,
+                        'event_id': row['accountingevent_id'],
+                        'rebuild_id': rebuild.id,
+                        'account_id': row['entry__account_id'],
+                        'entry_type': row['entry__entry_type__name'],
+                        'amount': str(-row['total']),
+                        'currency': row['entry__amount__currency__code'],
+                        'date': row['entry__date'].isoformat(),
+                    })
+                    for row, entry in zip(old, reversals)
+                ])
+
+            shadows = ShadowEntry.objects.filter(rebuild=rebuild).select_related('entry_type').order_by('id')
+            rows = list(shadows)
+            for start in range(0, len(rows), self.batch_size):
+                chunk = rows[start:start + self.batch_size]
+                monies = Money.objects.bulk_create([Money(amount=s.amount, currency_id=s.currency_id) for s in chunk])
+                entries = Entry.objects.bulk_create([
+                    Entry(account_id=s.account_id, entry_type_id=s.entry_type_id, amount=money, date=s.date, valid_date=s.valid_date)
+                    for s, money in zip(chunk, monies)
+                ])
+                through.objects.bulk_create([
+                    through(accountingevent_id=s.event_id, entry_id=entry.id) for s, entry in zip(chunk, entries)
+                ])
+                OutboxMessage.objects.bulk_create([
+                    OutboxMessage(topic=ENTRY_REBUILT, event_id=s.event_id, entry_id=entry.id, payload={
+                        'entry_id': entry.id,
+                        'event_id': s.event_id,
+                        'rebuild_id': rebuild.id,
+                        'account_id': s.account_id,
+                        'entry_type': s.entry_type.name,
+                        'amount': str(s.amount),
+                        'currency_id': s.currency_id,
+                        'date': s.date.isoformat(),
+                    })
+                    for s, entry in zip(chunk, entries)
+                ])
+            ShadowEntry.objects.filter(rebuild=rebuild).delete()
+            # Os meses fechados do GL a partir do início da reconstrução precisam ser recalculados
+            LedgerPeriodSummary.objects.filter(period__gte=period_key(rebuild.start)).delete()
+            # Contas quentes afetadas têm o saldo fragmentado recalculado a partir das entradas
+            for account in Account.objects.filter(id__in=touched, is_hot=True):
+                account.compact_shards(resync=True)
+            rebuild.status = LedgerRebuild.SWAPPED
+            rebuild.swapped_at = timezone.now()
+            rebuild.save(update_fields=['status', 'swapped_at'])
+        return rebuild
+
+    def run(self, swap=True):
+        rebuild = self.shadow()
+        if swap:
+            rebuild = self.swap(rebuild)
+        return rebuild
+
+
+def _replay_in_worker(args):
+    engine, rebuild_id, customer_ids, rules = args
+    try:
+        return engine.replay_partition(rebuild_id, customer_ids, rules)
+    finally:
+        connections.close_all()
@@ -0,0 +1,183 @@
+# Balancete e razão geral (GL) agrupados por tipo de conta, tipo de entrada, moeda e mês.
+#
+# Cada mês é uma partição calculada com duas consultas agregadas (entradas vivas sem o saldo
+# de abertura + entradas arquivadas), por shard. As partições são independentes e podem rodar
+# em processos separados. Meses fechados (terminados há mais de REPORT_CLOSE_AFTER_DAYS dias)
+# ficam gravados em LedgerPeriodSummary junto com a marca d'água do mês (maior id e contagem
+# das entradas vivas e arquivadas); se a marca mudar (postagem retroativa, accrue --date,
+# flush do memledger, arquivamento, reconstrução) o mês é recalculado. O balancete é a soma das
+# partições desde o primeiro mês com entradas. Débitos são a soma (com sinal) das entradas
+# negativas e créditos a das positivas.
+import datetime
+import multiprocessing
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils import timezone
+
+from .models import ArchivedEntry, Entry, LedgerPeriodSummary
+from .sharding import each_shard, shard_aliases, use_shard
+
+ZERO = Decimal('0.00')
+
+
+def period_key(when):
+    return timezone.localtime(when).strftime('%Y-%m')
+
+
+def period_bounds(period):
+    year, month = map(int, period.split('-'))
+    start = timezone.make_aware(datetime.datetime(year, month, 1))
+    end = timezone.make_aware(datetime.datetime(year + month // 12, month % 12 + 1, 1))
+    return start, end
+
+
+def period_range(first, last):
+    periods = []
+    year, month = map(int, first.split('-'))
+    while f"{year:04d}-{month:02d}" <= last:
+        periods.append(f"{year:04d}-{month:02d}")
+        year, month = year + month // 12, month % 12 + 1
+    return periods
+
+
+def is_closed(period, now=None):
+    _, end = period_bounds(period)
+    grace = datetime.timedelta(days=getattr(settings, 'REPORT_CLOSE_AFTER_DAYS', 5))
+    return end + grace <= (now or timezone.now())
+
+
+def period_watermark(period):
+    """Maior id e contagem das entradas do mês no shard ativo; muda com qualquer entrada nova ou removida."""
+    start, end = period_bounds(period)
+    marks = []
+    for queryset in (Entry.objects.filter(date__gte=start, date__lt=end, is_opening_balance=False),
+                     ArchivedEntry.objects.filter(date__gte=start, date__lt=end)):
+        mark = queryset.aggregate(latest=Max('id'), count=Count('id'))
+        marks.append(f"{mark['latest'] or 0}.{mark['count']}")
+    return ':'.join(marks)
+
+
+def compute_period(period):
+    """Linhas do GL do mês no shard ativo, direto das entradas."""
+    start, end = period_bounds(period)
+    totals = {}
+    sources = [
+        (Entry.objects.filter(date__gte=start, date__lt=end, is_opening_balance=False),
+         'amount__amount', 'amount__currency__code'),
+        (ArchivedEntry.objects.filter(date__gte=start, date__lt=end), 'amount', 'currency__code'),
+    ]
+    for queryset, amount, currency in sources:
+        grouped = (
+            queryset.values('account__account_type__name', 'entry_type__name', currency)
+            .annotate(
+                debit=Sum(amount, filter=Q(**{f'{amount}__lt': 0})),
+                credit=Sum(amount, filter=Q(**{f'{amount}__gt': 0})),
+                entries=Count('id'),
+            )
+        )
+        for row in grouped:
+            key = (row['account__account_type__name'], row['entry_type__name'], row[currency])
+            total = totals.setdefault(key, [ZERO, ZERO, 0])
+            total[0] += row['debit'] or ZERO
+            total[1] += row['credit'] or ZERO
+            total[2] += row['entries']
+    return [
+        {'account_type': account_type, 'entry_type': entry_type, 'currency': currency,
+         'debit': str(debit), 'credit': str(credit), 'entries': entries}
+        for (account_type, entry_type, currency), (debit, credit, entries) in sorted(totals.items())
+    ]
+
+
+def period_summary(period, refresh=False):
+    """Linhas do GL do mês no shard ativo; meses fechados vêm de LedgerPeriodSummary."""
+    closed = is_closed(period)
+    if closed:
+        watermark = period_watermark(period)
+        if not refresh:
+            cached = LedgerPeriodSummary.objects.filter(period=period, watermark=watermark).values_list('rows', flat=True).first()
+            if cached is not None:
+                return cached
+    rows = compute_period(period)
+    if closed:
+        LedgerPeriodSummary.objects.update_or_create(period=period, defaults={'rows': rows, 'watermark': watermark})
+    return rows
+
+
+def _partition(alias, period, refresh):
+    with use_shard(alias):
+        return period, period_summary(period, refresh)
+
+
+def _partition_in_worker(args):
+    try:
+        return _partition(*args)
+    finally:
+        connections.close_all()
+
+
+def first_period():
+    dates = []
+    for _ in each_shard():
+        dates.append(Entry.objects.filter(is_opening_balance=False).aggregate(first=Min('date'))['first'])
+        dates.append(ArchivedEntry.objects.aggregate(first=Min('date'))['first'])
+    dates = [d for d in dates if d is not None]
+    return period_key(min(dates)) if dates else None
+
+
+class LedgerReport:
+    def __init__(self, workers=1, refresh=False):
+        self.workers = workers
+        self.refresh = refresh
+
+    def partitions(self, periods):
+        # {período: [linhas de cada shard]}; uma partição por (shard, mês)
+        tasks = [(alias, period, self.refresh) for alias in shard_aliases() for period in periods]
+        if self.workers <= 1 or len(tasks) <= 1:
+            results = [_partition(*task) for task in tasks]
+        else:
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(min(self.workers, len(tasks))) as pool:
+                results = pool.map(_partition_in_worker, tasks)
+        partitions = {period: [] for period in periods}
+        for period, rows in results:
+            partitions[period].extend(rows)
+        return partitions
+
+    def general_ledger(self, first, last):
+        """Linhas do GL de first a last (AAAA-MM), somadas entre shards, com o líquido de cada grupo."""
+        report = []
+        for period, rows in self.partitions(period_range(first, last)).items():
+            totals = {}
+            for row in rows:
+                total = totals.setdefault((row['account_type'], row['entry_type'], row['currency']), [ZERO, ZERO, 0])
+                total[0] += Decimal(row['debit'])
+                total[1] += Decimal(row['credit'])
+                total[2] += row['entries']
+            for (account_type, entry_type, currency), (debit, credit, entries) in sorted(totals.items()):
+                report.append({
+                    'period': period, 'account_type': account_type, 'entry_type': entry_type, 'currency': currency,
+                    'debit': debit, 'credit': credit, 'net': debit + credit, 'entries': entries,
+                })
+        return report
+
+    def trial_balance(self, as_of=None):
+        """Saldos por tipo de conta e moeda ao fim do mês as_of (padrão: mês corrente), com totais por moeda."""
+        as_of = as_of or period_key(timezone.now())
+        first = first_period()
+        balances, totals = {}, {}
+        if first is not None and first <= as_of:
+            for row in self.general_ledger(first, as_of):
+                for key, target in (((row['account_type'], row['currency']), balances), (row['currency'], totals)):
+                    total = target.setdefault(key, {'debit': ZERO, 'credit': ZERO, 'balance': ZERO})
+                    total['debit'] += row['debit']
+                    total['credit'] += row['credit']
+                    total['balance'] += row['net']
+        return {
+            'as_of': as_of,
+            'rows': [{'account_type': account_type, 'currency': currency, **values}
+                     for (account_type, currency), values in sorted(balances.items())],
+            'totals': dict(sorted(totals.items())),
+        }
@@ -0,0 +1,70 @@
+# Índice de regras de postagem para os workers pré-fork (bancoTest/prefork.py).
+#
+# Só processos que aqueceram o índice (warm_caches no pai do prefork) o consultam; as
+# requisições continuam buscando a regra no banco. Salvar ou apagar uma regra pelo modelo
+# invalida o índice do próprio processo; alterações feitas em outros processos ou por
+# update()/bulk_create aparecem depois de no máximo RULE_INDEX_TTL segundos.
+import time
+
+from django.conf import settings
+
+from .models import ServiceAgreement
+
+
+class PostingRuleIndex:
+    """Regras de postagem em memória, indexadas por (acordo, tipo de evento).
+
+    Todas as regras de ServiceAgreement.lista_Posting_rules são carregadas com uma consulta
+    por modelo, na ordem da lista e depois por id (a mesma precedência de get_posting_rule);
+    a busca percorre só as regras do par.
+    """
+
+    def __init__(self):
+        self._rules = {}
+        for related_name in ServiceAgreement.lista_Posting_rules:
+            model = ServiceAgreement._meta.get_field(related_name).related_model
+            for rule in model.objects.select_related('event_type', 'entry_type').order_by('id'):
+                self._rules.setdefault((rule.service_agreement_id, rule.event_type_id), []).append(rule)
+
+    def __len__(self):
+        return sum(len(rules) for rules in self._rules.values())
+
+    def compile(self):
+        # Compila (e guarda em cada regra) os planos de cálculo; devolve quantos foram compilados
+        return sum(rule.plan is not None for rules in self._rules.values() for rule in rules)
+
+    def find(self, agreement_id, event_type_id, date):
+        for rule in self._rules.get((agreement_id, event_type_id), ()):
+            if rule.start_date <= date and (rule.end_date is None or rule.end_date >= date):
+                return rule
+        return None
+
+
+_index = None
+_loaded_at = None
+
+
+def get_rule_index():
+    """Aquece o índice neste processo, recarregando-o se foi invalidado ou passou do TTL."""
+    global _index, _loaded_at
+    ttl = getattr(settings, 'RULE_INDEX_TTL', 60)
+    if _index is None or _loaded_at is None or time.monotonic() - _loaded_at > ttl:
+        _index = PostingRuleIndex()
+        _loaded_at = time.monotonic()
+    return _index
+
+
+def warm_rule_index():
+    """O índice, se este processo o aqueceu; None no caminho das requisições."""
+    return get_rule_index() if _index is not None else None
+
+
+def invalidate_rules():
+    # O processo continua aquecido; o índice é recarregado na próxima busca
+    global _loaded_at
+    _loaded_at = None
+
+
+def unload_rules():
+    global _index, _loaded_at
+    _index = _loaded_at = None
@@ -0,0 +1,161 @@
+# Particionamento do razão por cliente entre vários bancos (settings.LEDGER_SHARDS).
+#
+# - O banco 'default' é o diretório: guarda o ShardMap (cliente -> shard), as transferências
+#   entre shards e a cópia mestre dos dados de referência (moedas, tipos, acordos, regras, câmbio).
+# - Os dados de um cliente (contas, entradas, eventos, transações) ficam no shard dele.
+# - Os dados de referência são gravados no diretório e replicados para cada shard com o mesmo id.
+#
+# O roteamento usa, nesta ordem: o banco da instância envolvida (hint 'instance'), o shard
+# ativo em use_shard() e, por fim, o 'default'. Com LEDGER_SHARDS vazio tudo fica no 'default'.
+import functools
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+DIRECTORY = DEFAULT_DB_ALIAS
+DIRECTORY_MODELS = {'accounts.shardmap', 'transaction.crossshardtransfer'}
+REFERENCE_MODELS = {
+    'accounts.currency', 'accounts.accounttype', 'accounts.entrytype', 'accounts.eventtype',
+    'accounts.serviceagreement', 'accounts.exchangerate',
+    'transaction.transactiontype', 'transaction.transactionstatus',
+}
+
+_state = threading.local()
+
+
+def shard_aliases():
+    return list(getattr(settings, 'LEDGER_SHARDS', None) or [DEFAULT_DB_ALIAS])
+
+
+def is_sharded():
+    return bool(getattr(settings, 'LEDGER_SHARDS', None))
+
+
+def current_shard():
+    return getattr(_state, 'alias', None) or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_shard(alias):
+    previous = getattr(_state, 'alias', None)
+    _state.alias = alias
+    try:
+        yield alias
+    finally:
+        _state.alias = previous
+
+
+def each_shard():
+    # Para as ferramentas em lote: executa o corpo do laço uma vez em cada shard
+    for alias in shard_aliases():
+        with use_shard(alias):
+            yield alias
+
+
+def shard_atomic():
+    return transaction.atomic(using=current_shard())
+
+
+def on_instance_shard(method):
+    """Executa o método com o shard da instância ativo (consultas sem hint e atomic() vão para ele)."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        alias = self._state.db
+        if alias is None or alias == getattr(_state, 'alias', None):
+            return method(self, *args, **kwargs)
+        with use_shard(alias):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def shard_for_customer(customer_id):
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS
+    from .models import ShardMap
+    return ShardMap.objects.using(DIRECTORY).values_list('shard', flat=True).get(customer_id=customer_id)
+
+
+@contextmanager
+def customer_shard(customer):
+    with use_shard(customer._state.db or shard_for_customer(customer.id)):
+        yield
+
+
+def is_reference_model(model):
+    from .models import PostingRule
+    return model._meta.label_lower in REFERENCE_MODELS or issubclass(model, PostingRule)
+
+
+def replicate_reference_data(aliases=None):
+    """Copia todos os dados de referência do diretório para os shards (ex.: ao criar um shard novo)."""
+    from django.apps import apps
+    from .models import PostingRule
+    # Ordem das dependências: tipos e moedas antes de acordos, regras e câmbio
+    labels = [
+        'accounts.currency', 'accounts.accounttype', 'accounts.entrytype', 'accounts.eventtype',
+        'accounts.serviceagreement', 'accounts.exchangerate',
+        'transaction.transactiontype', 'transaction.transactionstatus',
+    ]
+    models = [apps.get_model(label) for label in labels]
+    models += [m for m in apps.get_models() if issubclass(m, PostingRule)]
+    copied = 0
+    for alias in aliases or shard_aliases():
+        if alias == DIRECTORY:
+            continue
+        with transaction.atomic(using=alias):
+            for model in models:
+                for obj in model.objects.using(DIRECTORY).all():
+                    obj.save(using=alias)
+                    copied += 1
+    return copied
+
+
+def replicate_on_save(sender, instance, raw=False, using=None, **kwargs):
+    if raw or using != DIRECTORY or not is_sharded() or not is_reference_model(sender):
+        return
+    for alias in shard_aliases():
+        if alias != DIRECTORY:
+            instance.save(using=alias)
+    instance._state.db = DIRECTORY
+
+
+def replicate_on_delete(sender, instance, using=None, **kwargs):
+    if using != DIRECTORY or not is_sharded() or not is_reference_model(sender):
+        return
+    for alias in shard_aliases():
+        if alias != DIRECTORY:
+            sender._base_manager.using(alias).filter(pk=instance.pk).delete()
+
+
+class CustomerShardRouter:
+    def _route(self, model, hints):
+        label = model._meta.label_lower
+        if label in DIRECTORY_MODELS:
+            return DIRECTORY
+        if not is_sharded():
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return getattr(_state, 'alias', None)
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Referências são replicadas com o mesmo id, então podem ser ligadas a qualquer shard
+        if obj1._state.db == obj2._state.db:
+            return True
+        if is_reference_model(type(obj1)) or is_reference_model(type(obj2)):
+            return True
+        return False
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name and f"{app_label}.{model_name}" in DIRECTORY_MODELS:
+            return db == DIRECTORY
+        return None
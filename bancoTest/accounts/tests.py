@@ -1,9 +1,42 @@
-from django.test import TestCase
+import io
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from decimal import Decimal
-from .models import Currency, Money, AccountType, Account, Customer, EventType, EntryType, ServiceAgreement, DepositoAE, SaqueAE, DepositoPR, SaquePR, TaxEvent, AmountAdd
+from .models import Currency, Money, AccountType, Account, Customer, EventType, EntryType, ServiceAgreement, DepositoAE, SaqueAE, DepositoPR, SaquePR, TaxEvent, AmountAdd, ExchangeRate, Entry, OutboxMessage, OutboxConsumer, ArchivedEntry, AccountingEvent, EventJob, AccountBalanceShard, AccountDayDigest, LedgerJournal, LedgerPeriodSummary, LedgerRebuild
+from .conversion import ConversionService
+from .outbox import OutboxDispatcher, QueueSink
+from .archive import archive_entries
+from .paginators import estimate_row_count
+from .jobs import EventQueue, queue_metrics
+from .accrual import AccrualEngine, day_bounds
+from .memledger import LedgerEngine
+from .plans import ACCOUNT
+from .replay import ReplayEngine
+from .rules import get_rule_index, unload_rules
+from .reconcile import account_digests
+from .reports import LedgerReport, is_closed, period_key, period_range
+from bancoTest.prefork import PreforkRunner
+from bancoTest.profiling import SamplingProfiler, flush_profiles
+from bancoTest.snapshot import Snapshot, export_snapshot, import_snapshot, snapshot_models
+
+class BankFixture:
+    """Banco mínimo (moeda, tipos, regras, cliente e conta) e atalhos de depósito e saque."""
 
-class BankSystemTestCase(TestCase):
     def setUp(self):
         # Criar moeda
         self.currency = Currency.objects.create(code='BRL', name='Real Brasileiro')
@@ -56,6 +89,31 @@ class BankSystemTestCase(TestCase):
         self.account = Account.objects.create(name='Conta do João', account_type=self.account_type, currency=self.currency)
         self.customer.accounts.add(self.account)
 
+    def deposit(self, value, process=True):
+        event = DepositoAE.objects.create(
+            event_type=self.deposit_event_type,
+            when_occurred=timezone.now(),
+            when_noticed=timezone.now(),
+            customer=self.customer,
+            account=self.account,
+            amount=Money.objects.create(amount=Decimal(value), currency=self.currency)
+        )
+        if process:
+            event.process()
+        return event
+
+    def withdraw(self, value):
+        return SaqueAE.objects.create(
+            event_type=self.withdrawal_event_type,
+            when_occurred=timezone.now(),
+            when_noticed=timezone.now(),
+            customer=self.customer,
+            account=self.account,
+            amount=Money.objects.create(amount=Decimal(value), currency=self.currency)
+        )
+
+
+class BankSystemTestCase(BankFixture, TestCase):
     def test_account_creation(self):
         self.assertEqual(self.account.balance(), Decimal('0.00'))
         self.assertEqual(str(self.account), 'Conta do João')
@@ -189,3 +247,936 @@ class BankSystemTestCase(TestCase):
         self.account.refresh_from_db()
         self.assertEqual(self.account.balance(), Decimal('102.00'))  # 10% de taxa + 2.00 de taxa fixa = 12.00
 """
+
+
+class ConversionServiceTestCase(TestCase):
+    def setUp(self):
+        self.brl = Currency.objects.create(code='BRL', name='Real Brasileiro')
+        self.usd = Currency.objects.create(code='USD', name='US Dollar')
+        self.start = timezone.now() - timezone.timedelta(days=10)
+        ExchangeRate.objects.create(from_currency=self.usd, to_currency=self.brl, rate=Decimal('5.00'), effective_date=self.start)
+        ExchangeRate.objects.create(from_currency=self.usd, to_currency=self.brl, rate=Decimal('5.50'), effective_date=self.start + timezone.timedelta(days=5))
+
+    def test_effective_dated_rate(self):
+        service = ConversionService()
+        self.assertEqual(service.convert(Decimal('10.00'), 'USD', 'BRL', self.start + timezone.timedelta(days=1)), Decimal('50.00'))
+        self.assertEqual(service.convert(Decimal('10.00'), 'USD', 'BRL'), Decimal('55.00'))
+        with self.assertRaises(ValueError):
+            service.convert(Decimal('10.00'), 'USD', 'BRL', self.start - timezone.timedelta(days=1))
+
+    def test_inverse_rate_and_no_queries(self):
+        service = ConversionService()
+        with self.assertNumQueries(0):
+            self.assertEqual(service.convert(Decimal('55.00'), 'BRL', 'USD'), Decimal('10.00'))
+            self.assertEqual(service.total([(Decimal('1.00'), 'USD'), (Decimal('5.00'), 'BRL')], 'BRL'), Decimal('10.50'))
+
+
+class CustomerPositionsTestCase(TestCase):
+    def setUp(self):
+        self.brl = Currency.objects.create(code='BRL', name='Real Brasileiro')
+        self.usd = Currency.objects.create(code='USD', name='US Dollar')
+        ExchangeRate.objects.create(from_currency=self.usd, to_currency=self.brl, rate=Decimal('5.00'), effective_date=timezone.now() - timezone.timedelta(days=1))
+        self.checking = AccountType.objects.create(name='Conta Corrente')
+        self.savings = AccountType.objects.create(name='Poupança')
+        self.entry_type = EntryType.objects.create(name='Depósito', account_type=self.checking)
+        self.customer = Customer.objects.create(name='João Silva')
+        self.other = Customer.objects.create(name='Maria Souza')
+        self.checking_account = Account.objects.create(name='Corrente', account_type=self.checking, currency=self.brl)
+        self.savings_account = Account.objects.create(name='Poupança USD', account_type=self.savings, currency=self.usd)
+        self.empty_account = Account.objects.create(name='Vazia', account_type=self.checking, currency=self.brl)
+        self.customer.accounts.add(self.checking_account, self.savings_account)
+        self.other.accounts.add(self.empty_account)
+        for account, value, currency in [(self.checking_account, '100.00', self.brl), (self.checking_account, '20.00', self.brl), (self.savings_account, '10.00', self.usd)]:
+            account.add_entry(Entry(entry_type=self.entry_type, amount=Money.objects.create(amount=Decimal(value), currency=currency), date=timezone.now()))
+
+    def test_positions_single_query(self):
+        with self.assertNumQueries(1):
+            positions = Customer.positions_for([self.customer, self.other])
+        position = positions[self.customer.id]
+        self.assertEqual({a['name']: a['balance'] for a in position['accounts']}, {'Corrente': Decimal('120.00'), 'Poupança USD': Decimal('10.00')})
+        self.assertEqual(position['account_types']['Poupança'], {'USD': Decimal('10.00')})
+        self.assertEqual(positions[self.other.id]['accounts'][0]['balance'], Decimal('0.00'))
+
+    def test_positions_consolidated(self):
+        position = self.customer.positions(currency='BRL')
+        self.assertEqual(position['total'], Decimal('170.00'))
+        self.assertEqual(position['account_types'], {'Conta Corrente': {'BRL': Decimal('120.00')}, 'Poupança': {'BRL': Decimal('50.00')}})
+
+    def test_positions_endpoint(self):
+        response = self.client.get(f'/accounts/customers/{self.customer.id}/positions/', {'currency': 'BRL'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total'], '170.00')
+        response = self.client.get('/accounts/positions/', {'customer': [self.customer.id, self.other.id]})
+        self.assertEqual(set(response.json()), {str(self.customer.id), str(self.other.id)})
+        for params in ({'currency': 'XYZ'}, {'date': '2026-02-30T00:00:00'}):
+            response = self.client.get(f'/accounts/customers/{self.customer.id}/positions/', params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_positions_convert_at_entry_date(self):
+        # Com a taxa mudando, cada entrada em outra moeda é convertida na taxa da sua data
+        ExchangeRate.objects.create(from_currency=self.usd, to_currency=self.brl, rate=Decimal('6.00'), effective_date=timezone.now())
+        self.checking_account.add_entry(Entry(entry_type=self.entry_type, amount=Money.objects.create(amount=Decimal('10.00'), currency=self.usd), date=timezone.now() - timezone.timedelta(hours=1)))
+        self.checking_account.add_entry(Entry(entry_type=self.entry_type, amount=Money.objects.create(amount=Decimal('10.00'), currency=self.usd), date=timezone.now()))
+        position = self.customer.positions()
+        balance = {a['name']: a['balance'] for a in position['accounts']}['Corrente']
+        self.assertEqual(balance, Decimal('230.00'))
+        self.assertEqual(balance, self.checking_account.balance())
+
+
+class OutboxTestCase(BankFixture, TestCase):
+    def test_posting_and_reversal_write_outbox(self):
+        event = self.deposit('100.00')
+        event.reverse()
+        topics = list(OutboxMessage.objects.order_by('id').values_list('topic', flat=True))
+        self.assertEqual(topics, [OutboxMessage.ENTRY_POSTED, OutboxMessage.ENTRY_REVERSED])
+        self.assertEqual(OutboxMessage.objects.last().payload['amount'], '-100.00')
+        self.assertEqual(self.account.balance(), Decimal('0.00'))
+
+    def test_dispatcher_offsets(self):
+        self.deposit('10.00')
+        self.deposit('20.00')
+        sink = QueueSink('test-outbox')
+        self.assertEqual(OutboxDispatcher('reports', sink, batch_size=1).run(), 2)
+        self.assertEqual(OutboxDispatcher('reports', sink).run(), 0)
+        self.assertEqual([sink.queue.get_nowait()['payload']['amount'] for _ in range(2)], ['10.00', '20.00'])
+
+    def test_failed_sink_does_not_advance_offset(self):
+        self.deposit('10.00')
+
+        class FailingSink(QueueSink):
+            def send(self, messages):
+                raise OSError('sink down')
+
+        with self.assertRaises(OSError):
+            OutboxDispatcher('fraud', FailingSink('test-failing')).dispatch_batch()
+        self.assertEqual(OutboxConsumer.objects.get(name='fraud').last_id, 0)
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.currency = Currency.objects.create(code='BRL', name='Real Brasileiro')
+        self.account_type = AccountType.objects.create(name='Conta Corrente')
+        self.entry_type = EntryType.objects.create(name='Depósito', account_type=self.account_type)
+        self.account = Account.objects.create(name='Conta', account_type=self.account_type, currency=self.currency)
+        self.now = timezone.now()
+        for days, value in [(90, '100.00'), (60, '-30.00'), (40, '10.00'), (5, '50.00')]:
+            self.account.add_entry(Entry(
+                entry_type=self.entry_type,
+                amount=Money.objects.create(amount=Decimal(value), currency=self.currency),
+                date=self.now - timezone.timedelta(days=days),
+            ))
+
+    def test_archive_keeps_balances(self):
+        cutoff = self.now - timezone.timedelta(days=30)
+        before = [self.account.balance(self.now - timezone.timedelta(days=d)) for d in (70, 50, 20)] + [self.account.balance()]
+        self.assertEqual(archive_entries(cutoff), {self.account.id: 3})
+        self.assertEqual(self.account.entries.count(), 2)
+        self.assertEqual(ArchivedEntry.objects.filter(account=self.account).count(), 3)
+        after = [self.account.balance(self.now - timezone.timedelta(days=d)) for d in (70, 50, 20)] + [self.account.balance()]
+        self.assertEqual(before, after)
+
+        # Um segundo corte incorpora o saldo de abertura anterior
+        archive_entries(self.now - timezone.timedelta(days=1))
+        self.assertEqual(self.account.entries.get().amount.amount, Decimal('130.00'))
+        self.assertEqual(self.account.balance(self.now - timezone.timedelta(days=50)), Decimal('70.00'))
+
+    def test_statement_reaches_into_archive(self):
+        archive_entries(self.now - timezone.timedelta(days=30))
+        full = self.account.statement()
+        self.assertEqual([row['amount'] for row in full], [Decimal('100.00'), Decimal('-30.00'), Decimal('10.00'), Decimal('50.00')])
+        self.assertEqual([row['archived'] for row in full], [True, True, True, False])
+        page = self.account.statement(offset=2, limit=2)
+        self.assertEqual([row['amount'] for row in page], [Decimal('10.00'), Decimal('50.00')])
+        recent = self.account.statement(start=self.now - timezone.timedelta(days=30))
+        self.assertEqual([row['amount'] for row in recent], [Decimal('80.00'), Decimal('50.00')])
+
+        response = self.client.get(f'/accounts/{self.account.id}/statement/', {'page': 2, 'page_size': 3})
+        self.assertEqual([row['amount'] for row in response.json()['entries']], ['50.00'])
+        response = self.client.get(f'/accounts/{self.account.id}/balance/')
+        self.assertEqual(response.json()['balance'], '130.00')
+
+
+class AdminTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_entry_changelist_constant_queries(self):
+        self.deposit('10.00')
+        few = self.changelist_queries('/admin/accounts/entry/')
+        for _ in range(10):
+            self.deposit('10.00')
+        self.assertEqual(self.changelist_queries('/admin/accounts/entry/'), few)
+
+    def test_process_action(self):
+        events = [self.deposit('10.00', process=False) for _ in range(3)]
+        response = self.client.post('/admin/accounts/accountingevent/', {
+            'action': 'process_events',
+            '_selected_action': [e.id for e in events],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.account.balance(), Decimal('30.00'))
+        self.assertEqual(AccountingEvent.objects.filter(is_processed=True).count(), 3)
+
+    def test_transaction_models_registered(self):
+        self.assertEqual(self.client.get('/admin/transaction/transaction/').status_code, 200)
+        self.assertEqual(self.client.get('/admin/transaction/transactionlog/').status_code, 200)
+
+    def test_estimated_count(self):
+        self.assertEqual(estimate_row_count(Entry), Entry.objects.count())
+
+
+class ArchivedReversalTestCase(BankFixture, TestCase):
+    def test_reverse_archived_event(self):
+        event = self.deposit('100.00')
+        archive_entries(timezone.now() + timezone.timedelta(seconds=1))
+        self.assertFalse(event.resulting_entries.exists())
+        self.assertEqual(list(event.archived_entries.values_list('amount', flat=True)), [Decimal('100.00')])
+        event.reverse()
+        self.assertEqual(self.account.balance(), Decimal('0.00'))
+        self.assertEqual(OutboxMessage.objects.filter(topic=OutboxMessage.ENTRY_REVERSED, event_id=event.id).count(), 1)
+
+
+class EventQueueTestCase(BankFixture, TestCase):
+    def test_worker_processes_queued_events(self):
+        for _ in range(3):
+            self.deposit('10.00', process=False).defer()
+        queue = EventQueue(worker_id='w1')
+        self.assertEqual(queue_metrics()['depth'], 3)
+        self.assertEqual(queue.work(batch_size=2), (3, 0))
+        self.assertEqual(self.account.balance(), Decimal('30.00'))
+        self.assertEqual(queue_metrics()['done'], 3)
+
+    def test_claim_is_exclusive(self):
+        self.deposit('10.00', process=False).defer()
+        self.assertEqual(len(EventQueue(worker_id='w1').claim()), 1)
+        self.assertEqual(EventQueue(worker_id='w2').claim(), [])
+
+    def test_retry_backoff_and_dead_letter(self):
+        self.withdraw('50.00').defer()
+        queue = EventQueue(worker_id='w1', max_attempts=2, backoff_seconds=0)
+        self.assertEqual(queue.work(max_batches=1), (0, 1))
+        job = EventJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (EventJob.QUEUED, 1))
+        self.assertIn('Insufficient funds', job.last_error)
+        queue.work()
+        self.assertEqual(EventJob.objects.get().status, EventJob.DEAD)
+        self.assertEqual(self.account.balance(), Decimal('0.00'))
+
+
+class ReplayTestCase(BankFixture, TestCase):
+    def test_funds_checked_against_balance_at_event(self):
+        opening = self.deposit('100.00')
+        start = timezone.now()
+        withdrawal = self.withdraw('80.00')
+        withdrawal.process()
+        end = timezone.now()
+        self.deposit('500.00')
+        # Depósito anterior ao período corrigido para 10: o saque não teria saldo, apesar do depósito posterior
+        entry = opening.resulting_entries.get()
+        entry.amount = Money.objects.create(amount=Decimal('10.00'), currency=self.currency)
+        entry.save()
+
+        rebuild = ReplayEngine(start, end, customer_ids=[self.customer.id]).run(swap=False)
+        self.assertEqual(rebuild.report['failed'], {str(withdrawal.id): 'Insufficient funds'})
+
+    def test_swap_keeps_history(self):
+        start = timezone.now()
+        event = self.deposit('100.00')
+        entry = event.resulting_entries.get()
+        entry.amount = Money.objects.create(amount=Decimal('70.00'), currency=self.currency)
+        entry.save()
+        before_swap = timezone.now()
+        self.account.checkpoint(before_swap, before_swap)
+
+        engine = ReplayEngine(start, timezone.now() + timezone.timedelta(seconds=1), customer_ids=[self.customer.id])
+        engine.run()
+        self.assertEqual(self.account.balance(), Decimal('100.00'))
+        self.assertEqual(self.account.bitemporal_balance(), Decimal('100.00'))
+        self.assertEqual(self.account.balance(valid_at=before_swap, known_at=before_swap), Decimal('70.00'))
+        self.assertTrue(Entry.objects.filter(id=entry.id).exists())
+        self.assertEqual(OutboxMessage.objects.filter(topic=OutboxMessage.ENTRY_REVERSED, event_id=event.id).count(), 1)
+
+        # Uma segunda reconstrução não altera nada nem estorna de novo as entradas já estornadas
+        engine.run()
+        self.assertEqual(self.account.balance(), Decimal('100.00'))
+        self.assertEqual(event.resulting_entries.aggregate(total=Sum('amount__amount'))['total'], Decimal('100.00'))
+        self.assertEqual(OutboxMessage.objects.filter(topic=OutboxMessage.ENTRY_REVERSED, event_id=event.id).count(), 2)
+
+    def test_swap_refuses_memory_ledger_accounts(self):
+        start = timezone.now()
+        event = self.deposit('100.00')
+        entry = event.resulting_entries.get()
+        entry.amount = Money.objects.create(amount=Decimal('70.00'), currency=self.currency)
+        entry.save()
+        Account.objects.filter(id=self.account.id).update(memory_ledger='default')
+
+        engine = ReplayEngine(start, timezone.now() + timezone.timedelta(seconds=1), customer_ids=[self.customer.id])
+        rebuild = engine.run(swap=False)
+        with self.assertRaisesMessage(ValueError, 'memory-ledger accounts'):
+            engine.swap(rebuild)
+        self.assertEqual(LedgerRebuild.objects.get(id=rebuild.id).status, LedgerRebuild.SHADOWED)
+        self.assertEqual(self.account.entries.count(), 1)
+
+
+class AccrualTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.service_agreement.rate = Decimal('36.50')
+        self.service_agreement.save()
+        self.interest_type = EntryType.objects.create(name='INTEREST', account_type=self.account_type)
+        fee_event_type = EventType.objects.create(name='FEE')
+        fee_entry_type = EntryType.objects.create(name='FEE', account_type=self.account_type)
+        AmountAdd.objects.create(
+            service_agreement=self.service_agreement,
+            event_type=fee_event_type,
+            entry_type=fee_entry_type,
+            start_date=timezone.now() - timezone.timedelta(days=10),
+            multiplier=Decimal('0.001'),
+            fixedFee=Money.objects.create(amount=Decimal('0.50'), currency=self.currency)
+        )
+        self.deposit('1000.00')
+
+    def test_accrual_posts_interest_and_fees_once(self):
+        engine = AccrualEngine(timezone.localdate(), self.interest_type)
+        (run,) = engine.run()
+        # 1000 * 36.5% / 365 = 1.00 de juros; 1000 * 0.001 + 0.50 = 1.50 de tarifa
+        self.assertEqual((run.interest_total, run.fee_total, run.accounts), (Decimal('1.00'), Decimal('1.50'), 1))
+        self.assertEqual(self.account.balance(), Decimal('999.50'))
+        self.assertEqual(engine.run(), [])
+        self.assertEqual(self.account.balance(), Decimal('999.50'))
+
+    def test_balances_match_account_balance(self):
+        usd = Currency.objects.create(code='USD', name='Dólar')
+        now = timezone.now()
+        ExchangeRate.objects.create(from_currency=usd, to_currency=self.currency, rate=Decimal('5.00'), effective_date=now - timezone.timedelta(days=10))
+        ExchangeRate.objects.create(from_currency=usd, to_currency=self.currency, rate=Decimal('6.00'), effective_date=now - timezone.timedelta(hours=1))
+        # Entrada em dólar de antes da mudança de taxa: vale 5.00 por dólar, não a taxa do fim do dia
+        date = now - timezone.timedelta(days=2)
+        Entry.objects.create(account=self.account, entry_type=self.deposit_entry_type, amount=Money.objects.create(amount=Decimal('10.00'), currency=usd), date=date, valid_date=date)
+        _, end = day_bounds(timezone.localdate())
+        balances = AccrualEngine(timezone.localdate(), self.interest_type).balances(self.service_agreement.id, end)
+        self.assertEqual(balances[self.account.id]['balance'], self.account.balance())
+        self.assertEqual(self.account.balance(), Decimal('1050.00'))
+
+    def test_balances_include_unflushed_memory_ledger_postings(self):
+        Account.objects.filter(id=self.account.id).update(memory_ledger='default')
+        with tempfile.TemporaryDirectory() as tmp:
+            ledger = LedgerEngine(os.path.join(tmp, 'ledger.journal'))
+            ledger.deposit(self.account.id, '500.00', self.deposit_entry_type)
+            _, end = day_bounds(timezone.localdate())
+            with mock.patch('accounts.memledger._engine', ledger):
+                balances = AccrualEngine(timezone.localdate(), self.interest_type).balances(self.service_agreement.id, end)
+            ledger.stop()
+        self.assertEqual(balances[self.account.id]['balance'], Decimal('1500.00'))
+
+
+class BitemporalBalanceTestCase(BankFixture, TestCase):
+    def test_as_known_at(self):
+        occurred = timezone.now()
+        event = DepositoAE.objects.create(
+            event_type=self.deposit_event_type,
+            when_occurred=occurred,
+            when_noticed=timezone.now(),
+            customer=self.customer,
+            account=self.account,
+            amount=Money.objects.create(amount=Decimal('100.00'), currency=self.currency)
+        )
+        event.process()
+        after_deposit = timezone.now()
+        self.account.checkpoint(occurred + timezone.timedelta(days=1), after_deposit)
+        event.reverse()
+
+        valid_at = occurred + timezone.timedelta(days=1)
+        self.assertEqual(self.account.balance(), Decimal('0.00'))
+        # Antes do estorno acreditava-se num saldo de 100 naquela data; depois, 0
+        self.assertEqual(self.account.balance(valid_at=valid_at, known_at=after_deposit), Decimal('100.00'))
+        self.assertEqual(self.account.balance(valid_at=valid_at), Decimal('0.00'))
+        self.assertEqual(self.account.balance(valid_at=occurred - timezone.timedelta(seconds=1), known_at=after_deposit), Decimal('0.00'))
+        with self.assertNumQueries(3):
+            self.account.balance(valid_at=valid_at, known_at=timezone.now())
+
+
+class HotAccountTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.deposit('50.00')
+        self.account.make_hot(shards=4)
+
+    def test_make_hot_keeps_balance(self):
+        self.assertEqual(self.account.balance_shard_rows.count(), 4)
+        self.assertEqual(self.account.balance(), Decimal('50.00'))
+
+    def test_day_digest_spread_across_rows(self):
+        for _ in range(20):
+            self.deposit('1.00')
+        self.assertGreater(self.account.day_digests.count(), 1)
+        stored = account_digests([self.account.id])
+        self.assertEqual(list(stored[self.account.id]['days'].values())[0].split(':')[1], '21')
+        AccountDayDigest.rebuild([self.account.id])
+        self.assertEqual(self.account.day_digests.count(), 1)
+        self.assertEqual(account_digests([self.account.id]), stored)
+
+    def test_postings_update_shards(self):
+        for _ in range(5):
+            self.deposit('10.00')
+        event = self.deposit('20.00')
+        event.reverse()
+        entries = Entry.objects.filter(account=self.account).aggregate(total=Sum('amount__amount'))['total']
+        self.assertEqual(self.account.balance(), Decimal('100.00'))
+        self.assertEqual(self.account.balance(), entries)
+
+    def test_foreign_posting_converted_at_entry_date(self):
+        usd = Currency.objects.create(code='USD', name='Dólar')
+        now = timezone.now()
+        ExchangeRate.objects.create(from_currency=usd, to_currency=self.currency, rate=Decimal('5.00'), effective_date=now - timezone.timedelta(days=1))
+        ExchangeRate.objects.create(from_currency=usd, to_currency=self.currency, rate=Decimal('6.00'), effective_date=now + timezone.timedelta(days=1))
+        DepositoAE.objects.create(
+            event_type=self.deposit_event_type,
+            when_occurred=now,
+            when_noticed=now + timezone.timedelta(days=2),
+            customer=self.customer,
+            account=self.account,
+            amount=Money.objects.create(amount=Decimal('10.00'), currency=usd)
+        ).process()
+        # A entrada é datada em when_noticed: os fragmentos usam a mesma taxa que balance()
+        self.assertEqual(self.account.balance(), Decimal('110.00'))
+        self.assertEqual(self.account.balance(date=now + timezone.timedelta(days=3)), Decimal('110.00'))
+
+    def test_compact_shards(self):
+        for _ in range(8):
+            self.deposit('10.00')
+        self.assertEqual(self.account.compact_shards(), Decimal('130.00'))
+        self.assertEqual(list(self.account.balance_shard_rows.order_by('shard').values_list('amount', flat=True)),
+                         [Decimal('130.00')] + [Decimal('0.00')] * 3)
+        AccountBalanceShard.objects.filter(account=self.account, shard=0).update(amount=Decimal('1.00'))
+        self.assertEqual(self.account.compact_shards(resync=True), Decimal('130.00'))
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(100))
+
+
+def _busy_work(index, max_jobs):
+    _busy(0.05)
+    return 1, 0, None
+
+
+class ProfilerTestCase(BankFixture, TestCase):
+    def test_collapsed_and_speedscope(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with SamplingProfiler('busy', tmp, interval=0.001, memory=True) as profiler:
+                with SamplingProfiler('inner', tmp):
+                    _busy(0.1)
+            self.assertGreater(profiler.samples, 0)
+            self.assertEqual(len(os.listdir(tmp)), 2)
+            with open(profiler.paths[0]) as f:
+                self.assertIn('_busy (accounts/tests.py:', f.read())
+            speedscope = profiler.speedscope()
+            self.assertEqual(len(speedscope['profiles'][0]['samples']), len(profiler.stacks))
+            self.assertIn('_busy', {frame['name'] for frame in speedscope['shared']['frames']})
+
+    def test_process_profiled_by_setting(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.deposit('10.00')
+            self.assertEqual(os.listdir(tmp), [])
+            with self.settings(PROFILE_DIR=tmp):
+                self.deposit('10.00')
+                self.deposit('10.00')
+                # As chamadas somam amostras num só profiler, gravado uma vez por processo
+                self.assertEqual(os.listdir(tmp), [])
+                flush_profiles()
+            self.assertEqual(len(os.listdir(tmp)), 1)
+            self.assertTrue(os.listdir(tmp)[0].startswith('process-'))
+
+    def test_command_profile_flag(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            call_command('process_events', stats=True, profile=tmp, profile_format='speedscope', stdout=io.StringIO(), stderr=io.StringIO())
+            (name,) = os.listdir(tmp)
+            self.assertTrue(name.startswith('process_events-') and name.endswith('.speedscope.json'))
+
+
+class MemoryLedgerTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.deposit('50.00')
+        self.other = Account.objects.create(name='Poupança', account_type=self.account_type, currency=self.currency, memory_ledger='default')
+        Account.objects.filter(id=self.account.id).update(memory_ledger='default')
+        self.account.refresh_from_db()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = os.path.join(self.tmp.name, 'ledger.journal')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_post_and_flush(self):
+        engine = LedgerEngine(self.journal)
+        self.assertEqual(engine.balance(self.account.id), Decimal('50.00'))
+        engine.deposit(self.account.id, '25.00', self.deposit_entry_type)
+        engine.transfer(self.account.id, self.other.id, '30.00', self.deposit_entry_type)
+        with self.assertRaises(ValueError):
+            engine.withdraw(self.account.id, '100.00', self.withdrawal_entry_type)
+        self.assertEqual(engine.balance(self.account.id), Decimal('45.00'))
+        self.assertEqual(self.account.balance(), Decimal('50.00'))
+
+        self.assertEqual(engine.flush(), 2)
+        self.assertEqual(self.account.balance(), Decimal('45.00'))
+        self.assertEqual(self.other.balance(), Decimal('30.00'))
+        self.assertEqual(LedgerJournal.objects.get().last_seq, 2)
+        self.assertEqual(os.path.getsize(self.journal), 0)
+        engine.stop()
+
+    def test_recovery_replays_unflushed_postings(self):
+        engine = LedgerEngine(self.journal)
+        engine.deposit(self.account.id, '10.00', self.deposit_entry_type)
+        engine.flush()
+        engine.withdraw(self.account.id, '20.00', self.withdrawal_entry_type)
+        # Queda do processo no meio da escrita da postagem seguinte
+        engine._journal.write(b'3\t2026-01-01')
+        engine._journal.close()
+        # O lease do processo que caiu expira antes de outro motor assumir o journal
+        LedgerJournal.objects.update(leased_until=timezone.now() - timezone.timedelta(seconds=1))
+
+        recovered = LedgerEngine(self.journal)
+        self.assertEqual(recovered.recovered, 1)
+        self.assertEqual(recovered.balance(self.account.id), Decimal('40.00'))
+        self.assertEqual(recovered.deposit(self.account.id, '1.00', self.deposit_entry_type), 3)
+        recovered.stop()
+        self.assertEqual(self.account.balance(), Decimal('41.00'))
+        self.assertEqual(self.account.entries.count(), 4)
+
+    def test_single_writer_per_journal(self):
+        engine = LedgerEngine(self.journal)
+        with self.assertRaisesMessage(ValueError, 'held by another engine'):
+            LedgerEngine(os.path.join(self.tmp.name, 'second.journal'))
+        with self.assertRaisesMessage(ValueError, 'not owned by ledger'):
+            engine.deposit(Account.objects.create(name='Outra', account_type=self.account_type, currency=self.currency).id, '1.00', self.deposit_entry_type)
+        engine.stop()
+        LedgerEngine(os.path.join(self.tmp.name, 'second.journal')).stop()
+
+    def test_writer_retries_after_flush_error(self):
+        engine = LedgerEngine(self.journal, flush_interval=0.01, max_backoff=0.02)
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('database is locked')
+            return 0
+        engine.flush, engine.renew = flaky, lambda: None
+        with self.assertLogs('accounts.memledger', 'ERROR'):
+            engine.start()
+            deadline = time.monotonic() + 5
+            while len(calls) < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertTrue(engine._thread.is_alive())
+        self.assertGreaterEqual(len(calls), 3)
+        engine.stop()
+
+    def test_event_postings_go_through_engine(self):
+        engine = LedgerEngine(self.journal)
+        with mock.patch('accounts.memledger._engine', engine):
+            with self.captureOnCommitCallbacks(execute=True):
+                event = self.deposit('25.00')
+            self.assertEqual(engine.balance(self.account.id), Decimal('75.00'))
+            self.assertEqual(self.account.balance(), Decimal('75.00'))
+            withdrawal = SaqueAE.objects.create(
+                event_type=self.withdrawal_event_type,
+                when_occurred=timezone.now(),
+                when_noticed=timezone.now(),
+                customer=self.customer,
+                account=self.account,
+                amount=Money.objects.create(amount=Decimal('80.00'), currency=self.currency)
+            )
+            # A verificação de saldo do SaquePR lê o saldo em memória
+            with self.assertRaisesMessage(ValueError, 'Insufficient funds'):
+                withdrawal.process()
+            self.assertEqual(engine.flush(), 1)
+        self.assertEqual(self.account.balance(), Decimal('75.00'))
+        self.assertEqual(event.resulting_entries.get().amount.amount, Decimal('25.00'))
+        self.assertEqual(OutboxMessage.objects.filter(event_id=event.id).count(), 1)
+        engine.stop()
+
+    def test_valid_date_and_reverse_before_flush(self):
+        engine = LedgerEngine(self.journal)
+        occurred = timezone.now()
+        with mock.patch('accounts.memledger._engine', engine):
+            with self.captureOnCommitCallbacks(execute=True):
+                event = DepositoAE.objects.create(
+                    event_type=self.deposit_event_type,
+                    when_occurred=occurred,
+                    when_noticed=occurred + timezone.timedelta(hours=1),
+                    customer=self.customer,
+                    account=self.account,
+                    amount=Money.objects.create(amount=Decimal('25.00'), currency=self.currency)
+                )
+                event.process()
+            # O estorno antes do flush encontra a perna pendente no motor
+            with self.captureOnCommitCallbacks(execute=True):
+                event.reverse()
+            self.assertEqual(engine.balance(self.account.id), Decimal('50.00'))
+            self.assertEqual(engine.flush(), 2)
+        self.assertEqual(
+            sorted(event.resulting_entries.values_list('amount__amount', 'valid_date')),
+            [(Decimal('-25.00'), occurred), (Decimal('25.00'), occurred)],
+        )
+        self.assertEqual(event.resulting_entries.get(amount__amount=Decimal('25.00')).date, occurred + timezone.timedelta(hours=1))
+        engine.stop()
+
+    def test_posting_journaled_before_event_commits(self):
+        engine = LedgerEngine(self.journal, confirm_timeout=0)
+        with mock.patch('accounts.memledger._engine', engine):
+            event = self.deposit('25.00')
+            # Ainda dentro da transação: a postagem já está no journal e no saldo em memória
+            with open(self.journal) as f:
+                self.assertEqual(len(f.readlines()), 1)
+            self.assertEqual(engine.balance(self.account.id), Decimal('75.00'))
+            # Sem o on_commit, a postagem aberta é resolvida pelo banco: o evento consta como processado
+            self.assertEqual(engine.flush(), 1)
+        self.assertEqual(event.resulting_entries.count(), 1)
+        engine.stop()
+
+    def test_rolled_back_postings_cancelled(self):
+        engine = LedgerEngine(self.journal, confirm_timeout=0)
+        original = DepositoPR.process_plan
+
+        def second_leg_fails(rule, event):
+            original(rule, event)
+            raise RuntimeError('second leg failed')
+        with mock.patch('accounts.memledger._engine', engine):
+            with mock.patch.object(DepositoPR, 'process_plan', second_leg_fails), self.assertRaises(RuntimeError):
+                event = self.deposit('25.00', process=False)
+                event.process()
+            self.assertFalse(AccountingEvent.objects.get(id=event.id).is_processed)
+            self.assertEqual(engine.balance(self.account.id), Decimal('50.00'))
+            self.assertEqual(os.path.getsize(self.journal), 0)
+
+            # Transação externa desfeita sem exceção dentro do process(): resolvida pelo banco no flush
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.deposit('10.00')
+                raise RuntimeError('outer rollback')
+            self.assertEqual(engine.balance(self.account.id), Decimal('60.00'))
+            self.assertEqual(engine.flush(), 0)
+            self.assertEqual(engine.balance(self.account.id), Decimal('50.00'))
+        engine.stop()
+
+    def test_overdraft_checked_under_engine_lock(self):
+        engine = LedgerEngine(self.journal)
+        first, second = self.withdraw('40.00'), self.withdraw('40.00')
+        # As duas retiradas leram o saldo antes de qualquer uma postar
+        with mock.patch('accounts.memledger._engine', engine), mock.patch.object(Account, 'balance', return_value=Decimal('50.00')):
+            first.process()
+            with self.assertRaisesMessage(ValueError, 'Insufficient funds'):
+                second.process()
+        self.assertEqual(engine.balance(self.account.id), Decimal('10.00'))
+        self.assertFalse(AccountingEvent.objects.get(id=second.id).is_processed)
+        engine.stop()
+
+
+class ConditionalReadTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        self.deposit('50.00')
+        self.url = f'/accounts/{self.account.id}/balance/'
+
+    def test_not_modified_until_posting(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertEqual(response.json()['balance'], '50.00')
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Uma taxa nova pode mudar o saldo convertido: a versão muda
+        usd = Currency.objects.create(code='USD', name='Dólar')
+        ExchangeRate.objects.create(from_currency=usd, to_currency=self.currency, rate=Decimal('5.00'), effective_date=timezone.now())
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        self.deposit('10.00')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['balance'], '60.00')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_invalid_date_rejected(self):
+        statement = f'/accounts/{self.account.id}/statement/'
+        for url, params in ((self.url, {'date': 'garbage'}), (statement, {'start': 'garbage'}), (statement, {'end': '2026-02-30T00:00:00'})):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_unflushed_memory_ledger_posting_changes_version(self):
+        Account.objects.filter(id=self.account.id).update(memory_ledger='default')
+        with tempfile.TemporaryDirectory() as tmp:
+            ledger = LedgerEngine(os.path.join(tmp, 'ledger.journal'))
+            with mock.patch('accounts.memledger._engine', ledger):
+                etag = self.client.get(self.url)['ETag']
+                ledger.deposit(self.account.id, '5.00', self.deposit_entry_type)
+                response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            ledger.stop()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['balance'], '55.00')
+
+    def test_cached_payload(self):
+        statement = f'/accounts/{self.account.id}/statement/'
+        first = self.client.get(statement, {'page_size': 10})
+        with self.assertNumQueries(2):
+            second = self.client.get(statement, {'page_size': 10})
+        self.assertEqual(first.json(), second.json())
+        self.assertNotEqual(self.client.get(statement, {'page_size': 5})['ETag'], first['ETag'])
+
+    def test_query_count_header(self):
+        self.assertNotIn('X-DB-Queries', self.client.get(self.url))
+        etag = self.client.get(self.url)['ETag']
+        with self.settings(MIDDLEWARE=['bancoTest.bench.QueryCountMiddleware', *settings.MIDDLEWARE]):
+            client = self.client_class()
+            with self.assertNumQueries(2):
+                response = client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response['X-DB-Queries'], '2')
+        self.assertEqual(self.client.get('/accounts/999999/balance/').status_code, 404)
+
+
+class SnapshotTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.deposit('50.00')
+        self.deposit('12.34')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'ledger.snap')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fingerprint(self):
+        return {
+            model._meta.label: sorted(map(repr, model._base_manager.values_list()))
+            for model in snapshot_models()
+        }
+
+    def test_roundtrip(self):
+        before = self.fingerprint()
+        header = export_snapshot(self.path)
+        tables = {table['model']: table for table in header['tables']}
+        self.assertEqual(tables['accounts.Entry']['rows'], 2)
+        # Nomes de referência repetidos entram uma vez no dicionário da coluna
+        topic = next(c for c in tables['accounts.OutboxMessage']['columns'] if c['name'] == 'topic')
+        self.assertEqual((topic['kind'], topic['dict_size']), ('text', 1))
+
+        with self.assertRaisesMessage(ValueError, 'not empty'):
+            import_snapshot(self.path)
+        Entry.objects.all().delete()
+        loaded = import_snapshot(self.path, chunk_size=1, replace=True)
+        self.assertEqual(loaded['accounts.Money'], tables['accounts.Money']['rows'])
+        self.assertEqual(self.fingerprint(), before)
+        self.assertEqual(self.account.balance(), Decimal('62.34'))
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 64)
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+
+class LedgerReportTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.post('100.00', self.deposit_entry_type, 2026, 1)
+        self.post('-30.00', self.withdrawal_entry_type, 2026, 1)
+        self.post('40.00', self.deposit_entry_type, 2026, 2)
+        self.deposit('5.00')
+        self.current = period_key(timezone.now())
+
+    def post(self, value, entry_type, year, month):
+        when = timezone.make_aware(timezone.datetime(year, month, 10))
+        money = Money.objects.create(amount=Decimal(value), currency=self.currency)
+        return Entry.objects.create(account=self.account, entry_type=entry_type, amount=money, date=when, valid_date=when)
+
+    def test_general_ledger_by_period(self):
+        rows = LedgerReport().general_ledger('2026-01', '2026-02')
+        self.assertEqual(
+            [(r['period'], r['entry_type'], r['debit'], r['credit'], r['entries']) for r in rows],
+            [('2026-01', 'Depósito', Decimal('0.00'), Decimal('100.00'), 1),
+             ('2026-01', 'Saque', Decimal('-30.00'), Decimal('0.00'), 1),
+             ('2026-02', 'Depósito', Decimal('0.00'), Decimal('40.00'), 1)],
+        )
+        self.assertEqual({r['account_type'] for r in rows}, {'Conta Corrente'})
+
+    def test_trial_balance_caches_closed_periods(self):
+        balance = LedgerReport().trial_balance(self.current)
+        self.assertEqual(balance['totals']['BRL']['balance'], Decimal('115.00'))
+        self.assertEqual(balance['rows'][0]['debit'], Decimal('-30.00'))
+        cached = set(LedgerPeriodSummary.objects.values_list('period', flat=True))
+        self.assertIn('2026-01', cached)
+        self.assertNotIn(self.current, cached)
+
+        # Meses fechados vêm do cache: a marca d'água (duas contagens pelo índice de data) e a
+        # linha gravada, em vez das duas agregações por grupo
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(LedgerReport().trial_balance(self.current)['totals']['BRL']['balance'], Decimal('115.00'))
+        months = period_range('2026-01', self.current)
+        closed = sum(map(is_closed, months))
+        # 2 consultas do primeiro mês, 3 por mês fechado e 2 agregações por mês aberto
+        self.assertEqual(len(queries), 2 + 3 * closed + 2 * (len(months) - closed))
+
+        # Uma postagem retroativa num mês fechado muda a marca d'água e invalida o cache
+        self.post('1.00', self.deposit_entry_type, 2026, 1)
+        self.assertEqual(LedgerReport().trial_balance(self.current)['totals']['BRL']['balance'], Decimal('116.00'))
+        january = LedgerPeriodSummary.objects.get(period='2026-01')
+        self.assertEqual(sum(row['entries'] for row in january.rows), 3)
+        self.assertEqual(LedgerReport().trial_balance('2025-12')['rows'], [])
+
+    def test_command_rejects_invalid_months(self):
+        for options in ({'last': '2026-13'}, {'last': '2026-00'}, {'first': '2026-03', 'last': '2026-02'}):
+            with self.assertRaises(CommandError):
+                call_command('ledger_report', 'gl', stdout=io.StringIO(), **options)
+
+
+_warmed = {}
+
+
+class PreforkRunnerTestCase(SimpleTestCase):
+    def test_children_inherit_warm_state_and_recycle(self):
+        context = multiprocessing.get_context('fork')
+        remaining = context.Value('i', 7)
+
+        def warm():
+            _warmed['rules'] = 'loaded in parent'
+            return {'seconds': 0}
+
+        def work(index, max_jobs):
+            # Só processa se o estado aquecido pelo pai estiver presente no filho
+            taken = 0
+            while _warmed.get('rules') and taken < max_jobs:
+                with remaining.get_lock():
+                    if remaining.value == 0:
+                        break
+                    remaining.value -= 1
+                taken += 1
+            return taken, 0, time.time() if taken else None
+
+        report = PreforkRunner(work, workers=2, max_jobs=3, warm=warm).run()
+        self.assertEqual(report['processed'], 7)
+        # Dois filhos chegaram ao limite de 3 jobs e foram substituídos
+        self.assertEqual((report['children'], report['crashed']), (4, 0))
+        self.assertEqual(len(report['child_start_ms']), 4)
+
+    def test_children_sampled_under_parent_profiler(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with SamplingProfiler('parent', tmp, interval=0.001):
+                report = PreforkRunner(_busy_work, workers=2, warm=None).run()
+            self.assertEqual(report['processed'], 2)
+            names = sorted(os.listdir(tmp))
+            self.assertEqual([name.split('-')[0] for name in names], ['parent', 'parent.0', 'parent.1'])
+            for name in names[1:]:
+                with open(os.path.join(tmp, name)) as f:
+                    self.assertIn('_busy (accounts/tests.py:', f.read())
+
+
+class PostingRuleIndexTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        unload_rules()
+        self.addCleanup(unload_rules)
+
+    def test_requests_read_rules_from_database(self):
+        now = timezone.now()
+        agreement = self.service_agreement
+        with self.assertNumQueries(1):
+            self.assertEqual(agreement.get_posting_rule(self.deposit_event_type, now), self.depositoPR)
+        # update() não passa por save(); sem índice a mudança aparece na hora
+        DepositoPR.objects.filter(id=self.depositoPR.id).update(end_date=now - timezone.timedelta(days=1))
+        self.assertIsNone(agreement.get_posting_rule(self.deposit_event_type, now))
+
+    def test_warm_index_follows_rule_changes(self):
+        now = timezone.now()
+        agreement = self.service_agreement
+        with self.assertNumQueries(len(ServiceAgreement.lista_Posting_rules)):
+            self.assertEqual(len(get_rule_index()), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(agreement.get_posting_rule(self.deposit_event_type, now), self.depositoPR)
+        self.depositoPR.end_date = now - timezone.timedelta(days=1)
+        self.depositoPR.save()
+        self.assertIsNone(agreement.get_posting_rule(self.deposit_event_type, now))
+
+        # Mudanças que não passam pelo modelo (ou feitas em outro processo) esperam o TTL
+        DepositoPR.objects.filter(id=self.depositoPR.id).update(end_date=None)
+        self.assertIsNone(agreement.get_posting_rule(self.deposit_event_type, now))
+        with self.settings(RULE_INDEX_TTL=0), mock.patch('accounts.rules.time.monotonic', return_value=time.monotonic() + 1):
+            self.assertEqual(agreement.get_posting_rule(self.deposit_event_type, now), self.depositoPR)
+
+
+class CalculationPlanTestCase(BankFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.fee_rule = AmountAdd.objects.create(
+            service_agreement=self.service_agreement,
+            event_type=self.tax_event_type,
+            entry_type=self.withdrawal_entry_type,
+            start_date=timezone.now(),
+            multiplier=Decimal('0.00100'),
+            fixedFee=Money.objects.create(amount=Decimal('0.50'), currency=self.currency)
+        )
+
+    def event(self, amount, model=DepositoAE, event_type=None):
+        return model.objects.create(
+            event_type=event_type or self.deposit_event_type,
+            when_occurred=timezone.now(),
+            when_noticed=timezone.now(),
+            customer=self.customer,
+            account=self.account,
+            amount=Money.objects.create(amount=amount, currency=self.currency)
+        )
+
+    def outcome(self, call):
+        try:
+            return call()
+        except ValueError as e:
+            return str(e)
+
+    def test_plans_match_calculate_amount(self):
+        # Valores aleatórios (semente fixa): o plano dá o mesmo valor, ou o mesmo erro, que calculate_amount
+        rng = random.Random(50)
+        for _ in range(40):
+            amount = Decimal(rng.randint(0, 10 ** 7)) / 100
+            balance = Decimal(rng.randint(0, 10 ** 7)) / 100
+            self.fee_rule.multiplier = Decimal(rng.randint(0, 10 ** 6)) / 10 ** 5
+            self.fee_rule.save()
+            event = self.event(amount)
+            for rule in (self.depositoPR, self.saquePR, self.fee_rule):
+                with mock.patch.object(Account, 'balance', return_value=balance):
+                    expected = self.outcome(lambda: [(ACCOUNT, m.amount, m.currency.code) for m in [rule.calculate_amount(event)]])
+                plan = rule.plan
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.outcome(lambda: plan.apply(amount, 'BRL', balance=balance)), expected)
+
+    def test_process_uses_plan(self):
+        deposit = self.event(Decimal('1000.00'))
+        self.depositoPR.process(deposit)
+        entry = deposit.resulting_entries.get()
+        self.assertEqual(entry.amount_id, deposit.amount_id)
+
+        charge = self.event(Decimal('200.00'), event_type=self.tax_event_type)
+        self.fee_rule.process(charge)
+        self.assertEqual(charge.resulting_entries.get().amount.amount, Decimal('0.70'))
+        self.assertEqual(self.account.balance(), Decimal('1000.70'))
+
+        self.saquePR.process(self.event(Decimal('1000.70'), model=SaqueAE, event_type=self.withdrawal_event_type))
+        self.assertEqual(self.account.balance(), Decimal('0.00'))
+        with self.assertRaisesMessage(ValueError, 'Insufficient funds'):
+            self.saquePR.process(self.event(Decimal('0.01'), model=SaqueAE, event_type=self.withdrawal_event_type))
+
+    def test_fee_currency_must_match(self):
+        with self.assertRaisesMessage(ValueError, 'Currencies must match'):
+            self.fee_rule.plan.apply(Decimal('10.00'), 'USD')
@@ -0,0 +1,10 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path('positions/', views.positions, name='positions'),
+    path('customers/<int:customer_id>/positions/', views.customer_positions, name='customer-positions'),
+    path('<int:account_id>/balance/', views.account_balance, name='account-balance'),
+    path('<int:account_id>/statement/', views.account_statement, name='account-statement'),
+]
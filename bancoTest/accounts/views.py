@@ -0,0 +1,182 @@
+import functools
+import hashlib
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.http import Http404, HttpResponseNotModified, JsonResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
+
+from .memledger import running_engine
+from .models import Account, Customer, Entry, ExchangeRate, ShardMap
+from .sharding import is_sharded, shard_for_customer, use_shard
+
+ACCOUNT_READ_CACHE = getattr(settings, 'ACCOUNT_READ_CACHE', 'default')
+ACCOUNT_READ_CACHE_TIMEOUT = getattr(settings, 'ACCOUNT_READ_CACHE_TIMEOUT', 300)
+
+
+def _serialize(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, dict):
+        return {str(k): _serialize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_serialize(v) for v in value]
+    return value
+
+
+def _parse_date(request, name):
+    value = request.GET.get(name)
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'{name} must be an ISO 8601 datetime')
+    return parsed
+
+
+def _position_params(request):
+    return request.GET.get('currency') or None, _parse_date(request, 'date')
+
+
+def _customer_shard(customer_id):
+    try:
+        return shard_for_customer(customer_id)
+    except ShardMap.DoesNotExist:
+        raise Http404('Customer not found')
+
+
+def on_account_shard(view):
+    """Executa a view de conta no shard do cliente dono da conta.
+
+    Ids de conta só são únicos dentro de um shard: com o razão particionado o cliente vem
+    em ?customer= e o shard sai do ShardMap.
+    """
+    @functools.wraps(view)
+    def wrapper(request, account_id):
+        if not is_sharded():
+            return view(request, account_id)
+        try:
+            customer_id = int(request.GET['customer'])
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'customer is required when the ledger is sharded'}, status=400)
+        with use_shard(_customer_shard(customer_id)):
+            if not Account.objects.filter(id=account_id, customer=customer_id).exists():
+                raise Http404('Account not found')
+            return view(request, account_id)
+    return wrapper
+
+
+def customer_positions(request, customer_id):
+    with use_shard(_customer_shard(customer_id)):
+        if not Customer.objects.filter(id=customer_id).exists():
+            raise Http404('Customer not found')
+    try:
+        currency, date = _position_params(request)
+        positions = Customer.positions_for([customer_id], currency=currency, date=date)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(_serialize(positions[customer_id]))
+
+
+def positions(request):
+    # ?customer=1&customer=2&currency=BRL
+    try:
+        customer_ids = [int(c) for c in request.GET.getlist('customer')]
+    except ValueError:
+        return JsonResponse({'error': 'customer must be an integer id'}, status=400)
+    try:
+        currency, date = _position_params(request)
+        result = Customer.positions_for(customer_ids, currency=currency, date=date)
+    except ValueError as e:
+        # Data inválida (parse_datetime) ou moeda/câmbio inexistente no serviço de conversão
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(_serialize(result))
+
+
+def _account_version(account_id):
+    # Versão da conta = maior id de entrada (muda a cada postagem, estorno, reconstrução ou
+    # arquivamento) mais a versão das taxas de câmbio, que mudam o saldo convertido das
+    # entradas em outra moeda. Roda no shard ativo (views com on_account_shard).
+    latest = Entry.objects.filter(account_id=OuterRef('id')).order_by('-id').values('id')[:1]
+    row = Account.objects.filter(id=account_id).annotate(version=Subquery(latest)).values_list('version', 'memory_ledger').first()
+    if row is None:
+        raise Http404('Account not found')
+    version, memory_ledger = row
+    engine = running_engine(memory_ledger) if memory_ledger else None
+    if engine is not None:
+        # Postagens do razão em memória ainda não gravadas não mudam o maior id de entrada
+        version = f"{version or 0}m{engine.account_version(account_id)}"
+    # Ids de taxa não são reaproveitados: maior id e contagem mudam a cada inclusão ou exclusão
+    rates = ExchangeRate.objects.aggregate(latest=Max('id'), count=Count('id'))
+    return f"{version or 0}.{rates['latest'] or 0}.{rates['count']}"
+
+
+def _conditional_account_read(request, account_id, kind, render):
+    """Responde 304 se o If-None-Match bate com a versão atual; senão usa o cache versionado."""
+    version = _account_version(account_id)
+    digest = hashlib.md5(request.GET.urlencode().encode()).hexdigest()[:12]
+    etag = f'"{account_id}-{version}-{kind}-{digest}"'
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        key = f"account:{account_id}:{version}:{kind}:{digest}"
+        read_cache = caches[ACCOUNT_READ_CACHE]
+        payload = read_cache.get(key)
+        if payload is None:
+            payload = render()
+            read_cache.set(key, payload, ACCOUNT_READ_CACHE_TIMEOUT)
+        response = JsonResponse(payload)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@on_account_shard
+def account_balance(request, account_id):
+    try:
+        date = _parse_date(request, 'date')
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    def render():
+        account = Account.objects.select_related('currency').get(id=account_id)
+        return {
+            'account': account.id,
+            'currency': account.currency.code,
+            'date': date.isoformat() if date else None,
+            'balance': str(account.balance(date)),
+        }
+    return _conditional_account_read(request, account_id, 'balance', render)
+
+
+STATEMENT_PAGE_SIZE = 100
+
+
+@on_account_shard
+def account_statement(request, account_id):
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = min(1000, max(1, int(request.GET.get('page_size', STATEMENT_PAGE_SIZE))))
+    except ValueError:
+        return JsonResponse({'error': 'page and page_size must be integers'}, status=400)
+    try:
+        start, end = _parse_date(request, 'start'), _parse_date(request, 'end')
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    def render():
+        account = Account.objects.get(id=account_id)
+        rows = account.statement(
+            start=start,
+            end=end,
+            offset=(page - 1) * page_size,
+            limit=page_size,
+        )
+        for row in rows:
+            row['date'] = row['date'].isoformat()
+        return {'account': account.id, 'page': page, 'page_size': page_size, 'entries': _serialize(rows)}
+    return _conditional_account_read(request, account_id, 'statement', render)
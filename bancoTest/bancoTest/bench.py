@@ -0,0 +1,111 @@
+# Utilitários compartilhados pelos comandos de benchmark (bench_*)
+import os
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+from decimal import Decimal
+
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+
+@contextmanager
+def benchmark_database(verbosity=0, on_disk=False):
+    # Roda o benchmark num banco de teste descartável, nunca no banco configurado.
+    # on_disk força um arquivo SQLite (em vez de memória) para que vários processos o compartilhem.
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    previous = test_settings.get('NAME')
+    if on_disk and connection.vendor == 'sqlite' and not previous:
+        test_settings['NAME'] = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        test_settings['NAME'] = previous
+
+
+class Measurement:
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.queries = 0
+
+    def report(self, operations):
+        rate = operations / self.elapsed if self.elapsed else float('inf')
+        return f"{self.name}: {operations} ops in {self.elapsed:.3f}s ({rate:,.0f} ops/s, {self.queries} queries)"
+
+
+@contextmanager
+def measure(name):
+    measurement = Measurement(name)
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        yield measurement
+        measurement.elapsed = time.perf_counter() - start
+    measurement.queries = len(queries)
+
+
+QUERY_HEADER = 'X-DB-Queries'
+
+
+@contextmanager
+def count_queries():
+    # Conta as consultas de todos os bancos configurados (shards incluídos) feitas nesta thread
+    count = [0]
+
+    def counter(execute, sql, params, many, context):
+        count[0] += 1
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(counter))
+        yield count
+
+
+class QueryCountMiddleware:
+    """Devolve no cabeçalho X-DB-Queries o número de consultas da requisição.
+
+    Opcional (settings.QUERY_COUNT_HEADER): liga a contagem num servidor de verdade para o
+    loadtest --url; o servidor local do loadtest já conta sem ela.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with count_queries() as count:
+            response = self.get_response(request)
+        response[QUERY_HEADER] = str(count[0])
+        return response
+
+
+def seed_bank(customers=1, currency_code='USD'):
+    """Cria moeda, tipos, regras de depósito/saque/transferência e clientes com uma conta corrente cada."""
+    from accounts.models import Account, AccountType, Currency, Customer, EntryType, EventType, ServiceAgreement
+    from accounts.sharding import use_shard
+    from transaction.models import DepositPR, TransactionStatus, TransactionType, TransferPR, WithdrawalPR
+
+    currency, _ = Currency.objects.get_or_create(code=currency_code, defaults={'name': currency_code})
+    checking, _ = AccountType.objects.get_or_create(name='Checking')
+    agreement = ServiceAgreement.objects.create(rate=Decimal('0.01'))
+    start = timezone.now() - timezone.timedelta(days=1)
+    for name, rule_class in [('DEPOSIT', DepositPR), ('WITHDRAWAL', WithdrawalPR), ('TRANSFER', TransferPR)]:
+        event_type, _ = EventType.objects.get_or_create(name=name)
+        entry_type, _ = EntryType.objects.get_or_create(name=name, defaults={'account_type': checking})
+        TransactionType.objects.get_or_create(name=name)
+        rule_class.objects.create(service_agreement=agreement, event_type=event_type, entry_type=entry_type, start_date=start)
+    for status in ['PENDING', 'COMPLETED', 'CANCELLED']:
+        TransactionStatus.objects.get_or_create(name=status)
+
+    created = []
+    for i in range(customers):
+        customer = Customer.objects.create(name=f'Customer {i}', service_agreement=agreement)
+        # A conta fica no shard do cliente (o próprio 'default' sem particionamento)
+        with use_shard(customer._state.db):
+            account = Account.objects.create(name=f'Checking {i}', account_type=checking, currency=currency)
+            customer.accounts.add(account)
+        created.append((customer, account))
+    return created
@@ -0,0 +1,104 @@
+# Executor pré-fork para os comandos de workers (process_events).
+#
+# O processo pai importa as apps e carrega uma vez o estado que cada worker consultaria a frio
+# (taxas de câmbio, índice de regras de postagem e seus planos de cálculo, ids de status), fecha
+# as conexões, congela o GC (gc.freeze: as varreduras do coletor não tocam os objetos herdados,
+# que continuam em páginas compartilhadas) e cria N filhos com fork, que herdam esse estado por
+# copy-on-write.
+# Cada filho processa no máximo max_jobs e sai; o pai recria os que saíram por atingir o limite.
+import gc
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+from django.db import connections
+
+from bancoTest.profiling import profile_child
+
+
+def warm_caches():
+    """Carrega no processo atual os caches de referência; devolve o que foi carregado."""
+    from accounts.conversion import get_conversion_service
+    from accounts.rules import get_rule_index
+    from transaction.models import TransactionStatus
+
+    start = time.perf_counter()
+    rates = get_conversion_service()
+    rules = get_rule_index()
+    statuses = TransactionStatus.load_cache()
+    return {
+        'rate_pairs': len(rates._dates),
+        'posting_rules': len(rules),
+        'plans': rules.compile(),
+        'statuses': statuses,
+        'seconds': round(time.perf_counter() - start, 4),
+    }
+
+
+class PreforkRunner:
+    """Roda work(index, max_jobs) -> (processados, falhas, first_job_at) em `workers` filhos.
+
+    Um filho que chega a max_jobs é substituído por outro com o mesmo índice; os que
+    terminam antes (fila vazia) não são recriados. run() devolve o relatório agregado.
+    """
+
+    def __init__(self, work, workers=1, max_jobs=None, warm=warm_caches):
+        self.work = work
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.warm = warm
+        self._context = multiprocessing.get_context('fork')
+
+    def _child(self, index, spawned_at, results):
+        ready_at = time.time()
+        try:
+            # A thread de amostragem do pai não sobrevive ao fork
+            with profile_child(index):
+                processed, failed, first_job_at = self.work(index, self.max_jobs)
+        finally:
+            connections.close_all()
+        results.put((index, spawned_at, ready_at, first_job_at, processed, failed))
+
+    def _spawn(self, index, results, children):
+        process = self._context.Process(target=self._child, args=(index, time.time(), results))
+        process.start()
+        children[process.sentinel] = process
+
+    def run(self):
+        start = time.perf_counter()
+        report = {
+            'workers': self.workers, 'max_jobs': self.max_jobs, 'warm': self.warm() if self.warm else {},
+            'children': 0, 'crashed': 0, 'processed': 0, 'failed': 0, 'child_start_ms': [], 'first_event_ms': [],
+        }
+        # Conexões não podem ser compartilhadas entre processos; cada filho abre a sua
+        connections.close_all()
+        gc.freeze()
+        report['parent_startup_seconds'] = round(time.perf_counter() - start, 4)
+
+        results = self._context.SimpleQueue()
+        children = {}
+        try:
+            for index in range(self.workers):
+                self._spawn(index, results, children)
+                report['children'] += 1
+            while children:
+                for sentinel in wait(list(children)):
+                    process = children.pop(sentinel)
+                    process.join()
+                    if process.exitcode != 0:
+                        report['crashed'] += 1
+                while not results.empty():
+                    index, spawned_at, ready_at, first_job_at, processed, failed = results.get()
+                    report['processed'] += processed
+                    report['failed'] += failed
+                    report['child_start_ms'].append(round((ready_at - spawned_at) * 1000, 2))
+                    if first_job_at is not None:
+                        report['first_event_ms'].append(round((first_job_at - spawned_at) * 1000, 2))
+                    if self.max_jobs is not None and processed + failed >= self.max_jobs:
+                        self._spawn(index, results, children)
+                        report['children'] += 1
+        finally:
+            for process in children.values():
+                process.terminate()
+            gc.unfreeze()
+        return report
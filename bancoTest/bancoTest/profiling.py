@@ -0,0 +1,279 @@
+# Profiler de amostragem para postagens e jobs em lote.
+# Uma thread lê a pilha da thread perfilada (sys._current_frames) a cada intervalo e
+# agrega as pilhas; a saída é collapsed-stack (flamegraph.pl / speedscope) ou JSON do speedscope,
+# opcionalmente com as maiores alocações do tracemalloc. Desligado, custa um getattr por chamada.
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import ContextDecorator, contextmanager
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+FORMATS = ('collapsed', 'speedscope')
+
+_state = threading.local()
+# Profilers de settings.PROFILE_DIR: um por nome e processo, acumulando todas as chamadas
+_call_profilers = {}
+
+
+def _frame_label(code):
+    filename = code.co_filename
+    base = str(settings.BASE_DIR)
+    if filename.startswith(base):
+        filename = os.path.relpath(filename, base)
+    else:
+        filename = os.path.join(*filename.split(os.sep)[-2:])
+    return code.co_name, filename, code.co_firstlineno
+
+
+class SamplingProfiler(ContextDecorator):
+    def __init__(self, name='profile', output_dir='profiles', interval=0.005, fmt='collapsed', memory=False, top=25):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown profile format '{fmt}'")
+        self.name = name
+        self.output_dir = output_dir
+        self.interval = interval
+        self.fmt = fmt
+        self.memory = memory
+        self.top = top
+        self.stacks = Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+        self.paths = []
+        self.memory_stats = []
+        self.pid = os.getpid()
+        self._nested = False
+        self._targets = set()
+
+    def __enter__(self):
+        # Um profiler já ativo nesta thread cobre as chamadas internas
+        if getattr(_state, 'profiler', None) is not None:
+            self._nested = True
+            return self
+        _state.profiler = self
+        self._targets.add(threading.get_ident())
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._nested:
+            self._nested = False
+            return False
+        self.stop()
+        self._targets.clear()
+        _state.profiler = None
+        return False
+
+    @contextmanager
+    def track(self):
+        """Amostra a thread atual durante o bloco; a thread de amostragem já deve estar rodando."""
+        ident = threading.get_ident()
+        _state.profiler = self
+        self._targets.add(ident)
+        try:
+            yield self
+        finally:
+            self._targets.discard(ident)
+            _state.profiler = None
+
+    def spawn(self, name):
+        # Mesma configuração, amostras novas (filhos de fork, ver profile_child)
+        return SamplingProfiler(name, self.output_dir, self.interval, self.fmt, self.memory, self.top)
+
+    def start(self):
+        self._stop = threading.Event()
+        self._started_tracemalloc = self.memory and not tracemalloc.is_tracing()
+        if self._started_tracemalloc:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name=f'profiler-{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self._start
+        if self.memory:
+            self.memory_stats = tracemalloc.take_snapshot().statistics('lineno')[:self.top]
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        if self.output_dir:
+            self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self._targets:
+                continue
+            frames = sys._current_frames()
+            for ident in tuple(self._targets):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[tuple(reversed(stack))] += 1
+                    self.samples += 1
+
+    def collapsed(self):
+        return ''.join(
+            ';'.join(f"{name} ({filename}:{line})" for name, filename, line in stack) + f" {count}\n"
+            for stack, count in self.stacks.most_common()
+        )
+
+    def speedscope(self):
+        frames, index, samples, weights = [], {}, [], []
+        for stack, count in self.stacks.most_common():
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+            samples.append([index[frame] for frame in stack])
+            weights.append(count * self.interval)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': self.name,
+            'exporter': 'bancoTest.profiling',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled',
+                'name': self.name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights,
+            }],
+        }
+
+    def memory_report(self):
+        lines = [f"Top {len(self.memory_stats)} allocations for {self.name}"]
+        for stat in self.memory_stats:
+            frame = stat.traceback[0]
+            lines.append(f"{frame.filename}:{frame.lineno}: {stat.size / 1024:.1f} KiB in {stat.count} blocks")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"{self.name}-{os.getpid()}-{time.strftime('%Y%m%d%H%M%S')}")
+        if self.fmt == 'speedscope':
+            path = f"{prefix}.speedscope.json"
+            with open(path, 'w') as f:
+                json.dump(self.speedscope(), f)
+        else:
+            path = f"{prefix}.collapsed"
+            with open(path, 'w') as f:
+                f.write(self.collapsed())
+        self.paths.append(path)
+        if self.memory:
+            self.paths.append(f"{prefix}.tracemalloc.txt")
+            with open(self.paths[-1], 'w') as f:
+                f.write(self.memory_report())
+        return self.paths
+
+
+def _call_profiler(name, output_dir):
+    profiler = _call_profilers.get(name)
+    # Depois de um fork o dicionário herdado aponta para o profiler do pai, sem thread
+    if profiler is None or profiler.pid != os.getpid() or profiler.output_dir != output_dir:
+        profiler = SamplingProfiler(
+            name,
+            output_dir,
+            interval=getattr(settings, 'PROFILE_INTERVAL', 0.001),
+            fmt=getattr(settings, 'PROFILE_FORMAT', 'collapsed'),
+            memory=getattr(settings, 'PROFILE_MEMORY', False),
+        )
+        profiler.start()
+        _call_profilers[name] = profiler
+    return profiler
+
+
+def flush_profiles():
+    """Grava e descarta os profilers acumulados de settings.PROFILE_DIR deste processo."""
+    paths = []
+    for name, profiler in list(_call_profilers.items()):
+        if profiler.pid == os.getpid():
+            profiler.stop()
+            paths.extend(profiler.paths)
+        del _call_profilers[name]
+    return paths
+
+
+atexit.register(flush_profiles)
+
+
+def profiled(name):
+    """Perfila a função quando settings.PROFILE_DIR está definido e nenhum profiler está ativo.
+
+    As chamadas do processo somam amostras num único profiler, gravado por flush_profiles()
+    (fim do comando, saída do processo ou do filho de fork).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            output_dir = getattr(settings, 'PROFILE_DIR', None)
+            if not output_dir or getattr(_state, 'profiler', None) is not None:
+                return func(*args, **kwargs)
+            with _call_profiler(name, output_dir).track():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile_child(index):
+    """Perfila um filho criado com fork (PreforkRunner).
+
+    A thread de amostragem do pai não existe no filho, e o filho sai com os._exit sem rodar o
+    atexit: o profiler herdado vira um novo, gravado em arquivo próprio, e os acumulados são
+    gravados na saída.
+    """
+    parent = getattr(_state, 'profiler', None)
+    _state.profiler = None
+    try:
+        if parent is None:
+            yield None
+        else:
+            with parent.spawn(f"{parent.name}.{index}") as profiler:
+                yield profiler
+    finally:
+        flush_profiles()
+
+
+class ProfiledCommand(BaseCommand):
+    # Comandos em lote herdam daqui para ganhar --profile
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument('--profile', nargs='?', const='profiles', metavar='DIR', help='Sample stacks and write profiles to DIR')
+        parser.add_argument('--profile-interval', type=float, default=5.0, help='Sampling interval in milliseconds')
+        parser.add_argument('--profile-format', choices=FORMATS, default='collapsed')
+        parser.add_argument('--profile-memory', action='store_true', help='Also write a tracemalloc top-allocations report')
+        self._subcommand = subcommand
+        return parser
+
+    def execute(self, *args, **options):
+        output_dir = options.get('profile')
+        if not output_dir:
+            # Com settings.PROFILE_DIR, um arquivo por execução do comando, não por chamada
+            try:
+                return super().execute(*args, **options)
+            finally:
+                flush_profiles()
+        profiler = SamplingProfiler(
+            getattr(self, '_subcommand', self.__module__.rsplit('.', 1)[-1]),
+            output_dir,
+            interval=options.get('profile_interval', 5.0) / 1000,
+            fmt=options.get('profile_format', 'collapsed'),
+            memory=options.get('profile_memory', False),
+        )
+        with profiler:
+            result = super().execute(*args, **options)
+        self.stderr.write(f"{profiler.samples} samples in {profiler.elapsed:.3f}s written to {', '.join(profiler.paths)}")
+        return result
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -49,8 +50,14 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'transaction.logs.TransactionLogMiddleware',
 ]
 
+# Cabeçalho X-DB-Queries com o número de consultas de cada resposta, para o loadtest --url
+QUERY_COUNT_HEADER = bool(os.environ.get('QUERY_COUNT_HEADER'))
+if QUERY_COUNT_HEADER:
+    MIDDLEWARE.insert(0, 'bancoTest.bench.QueryCountMiddleware')
+
 ROOT_URLCONF = 'bancoTest.urls'
 
 TEMPLATES = [
@@ -79,9 +86,21 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
 }
 
+# Shards do razão por cliente (accounts/sharding.py), ex.: LEDGER_SHARDS=default,shard1.
+# Vazio: tudo no 'default' e nenhum banco extra é configurado. Cada shard novo precisa de
+# `migrate --database=<alias>` e `sync_shards`.
+LEDGER_SHARDS = [alias for alias in os.environ.get('LEDGER_SHARDS', '').split(',') if alias]
+# Os testes de particionamento usam bancoTest.test_settings, que acrescenta o alias 'shard1'
+for _alias in sorted(set(LEDGER_SHARDS) - {'default'}):
+    DATABASES[_alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'{_alias}.sqlite3',
+    }
+DATABASE_ROUTERS = ['accounts.sharding.CustomerShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -123,3 +142,43 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Profiling por chamada (AccountingEvent.process etc.); None desliga.
+# Comandos em lote usam --profile em vez disso.
+PROFILE_DIR = None
+PROFILE_INTERVAL = 0.001
+PROFILE_FORMAT = 'collapsed'
+PROFILE_MEMORY = False
+
+# Razão em memória (accounts/memledger.py) das contas com Account.memory_ledger = 'default';
+# o primeiro processo que postar nelas fica com o journal. None desliga.
+MEMORY_LEDGER_JOURNAL = None
+MEMORY_LEDGER_FLUSH_INTERVAL = 0.5
+
+# Cache dos saldos e extratos renderizados (accounts/views.py); as chaves levam a versão
+# da conta, então entradas antigas só expiram. Use FileBasedCache para compartilhar entre processos.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+ACCOUNT_READ_CACHE = 'default'
+ACCOUNT_READ_CACHE_TIMEOUT = 300
+
+# Limites de velocidade na submissão (transaction/velocity.py); lista vazia desliga.
+# Ex.: {'name': 'account-hourly', 'scope': 'account', 'types': ['WITHDRAWAL', 'TRANSFER'],
+#       'window': 3600, 'buckets': 12, 'max_count': 20, 'max_amount': '5000.00', 'currency': 'BRL'}
+VELOCITY_LIMITS = []
+# Fração do limite a partir da qual a chave aparece nas métricas
+VELOCITY_NEAR_LIMIT = 0.8
+# Processos que atendem /transactions/: as janelas são por processo, então cada um aplica
+# 1/VELOCITY_PROCESSES de cada limite
+VELOCITY_PROCESSES = 1
+
+# Segundos até os workers pré-fork recarregarem o índice de regras de postagem (accounts/rules.py)
+RULE_INDEX_TTL = 60
+
+# Um mês do GL é considerado fechado (e cacheado em LedgerPeriodSummary) esse número de dias
+# depois de terminar (accounts/reports.py)
+REPORT_CLOSE_AFTER_DAYS = 5
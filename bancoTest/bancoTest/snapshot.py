@@ -0,0 +1,299 @@
+# Snapshot binário colunar das apps accounts e transaction (clonagem de ambientes e cópias
+# pontuais sem passar por dumpdata/loaddata).
+#
+# Cada tabela é gravada coluna a coluna, em blocos alinhados a 8 bytes:
+#   - inteiros e FKs: int64
+#   - decimais: int64 escalado por 10**decimal_places
+#   - datetime: int64 de microssegundos desde 1970-01-01 UTC; date: int64 de dias desde 1970-01-01
+#   - booleanos: int8 (-1 = NULL)
+#   - texto e JSON: códigos int32 de um dicionário da coluna (offsets int64 + bytes UTF-8)
+# NULL nos int64 é INT64_MIN e nos códigos é -1. O cabeçalho JSON fica no fim do arquivo,
+# apontado pelo rodapé (offset + MAGIC), então a exportação grava as colunas à medida que fecha
+# cada tabela. A restauração mapeia o arquivo com mmap e insere em lotes com executemany.
+import datetime
+import json
+import mmap
+import struct
+import sys
+from array import array
+from decimal import Decimal
+
+from django.apps import apps
+from django.core.management.color import no_style
+from django.core.serializers import sort_dependencies
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+
+MAGIC = b'BNKSNAP1'
+FOOTER = struct.Struct('<Q8s')
+VERSION = 1
+APPS = ('accounts', 'transaction')
+NULL = -2 ** 63
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+EPOCH_DAY = datetime.date(1970, 1, 1).toordinal()
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+INT_TYPES = {
+    'AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveBigIntegerField', 'PositiveSmallIntegerField',
+}
+TEXT_TYPES = {'CharField', 'TextField', 'SlugField', 'EmailField', 'URLField'}
+
+
+def snapshot_models(using=DEFAULT_DB_ALIAS):
+    """Modelos das APPS presentes em `using`, em ordem de dependência, seguidos das tabelas de M2M."""
+    models = sort_dependencies([(apps.get_app_config(label), None) for label in APPS], allow_cycles=True)
+    through = [
+        field.remote_field.through
+        for model in models for field in model._meta.local_many_to_many
+        if field.remote_field.through._meta.auto_created
+    ]
+    return [
+        model for model in models + through
+        if model._meta.managed and not model._meta.proxy and router.allow_migrate_model(using, model)
+    ]
+
+
+def _storage_field(field):
+    # FKs (inclusive ponteiros de herança em cadeia) são gravadas como a pk de destino
+    while field.is_relation:
+        field = field.target_field
+    return field
+
+
+def column_kind(field):
+    field = _storage_field(field)
+    kind = field.get_internal_type()
+    if kind in INT_TYPES:
+        return 'int'
+    if kind == 'DecimalField':
+        if field.max_digits > 18:
+            raise ValueError(f"{field} does not fit a scaled int64")
+        return 'decimal'
+    if kind == 'DateTimeField':
+        return 'datetime'
+    if kind == 'DateField':
+        return 'date'
+    if kind == 'BooleanField':
+        return 'bool'
+    if kind in TEXT_TYPES:
+        return 'text'
+    if kind == 'JSONField':
+        return 'json'
+    raise ValueError(f"Unsupported field type {kind} ({field})")
+
+
+class _ColumnWriter:
+    def __init__(self, field):
+        self.field = field
+        self.kind = column_kind(field)
+        self.scale = getattr(_storage_field(field), 'decimal_places', None)
+        if self.kind == 'bool':
+            self.values = array('b')
+        elif self.kind in ('text', 'json'):
+            self.values = array('i')
+            self.dictionary = {}
+        else:
+            self.values = array('q')
+
+    def append(self, value):
+        if value is None:
+            self.values.append(-1 if self.kind in ('bool', 'text', 'json') else NULL)
+        elif self.kind == 'int':
+            self.values.append(value)
+        elif self.kind == 'decimal':
+            self.values.append(int(Decimal(value).scaleb(self.scale)))
+        elif self.kind == 'datetime':
+            self.values.append((value - EPOCH) // ONE_MICROSECOND)
+        elif self.kind == 'date':
+            self.values.append(value.toordinal() - EPOCH_DAY)
+        elif self.kind == 'bool':
+            self.values.append(1 if value else 0)
+        else:
+            if self.kind == 'json':
+                value = json.dumps(value, separators=(',', ':'))
+            code = self.dictionary.get(value)
+            if code is None:
+                code = self.dictionary[value] = len(self.dictionary)
+            self.values.append(code)
+
+
+class SnapshotWriter:
+    def __init__(self, f):
+        self.f = f
+        self.f.write(MAGIC)
+
+    def _block(self, data):
+        # Blocos alinhados a 8 bytes para que o memoryview do mmap possa ser lido como int64
+        padding = -self.f.tell() % 8
+        if padding:
+            self.f.write(b'\0' * padding)
+        offset = self.f.tell()
+        self.f.write(data)
+        return offset, len(data)
+
+    def write_table(self, model, using, chunk_size):
+        fields = model._meta.local_concrete_fields
+        writers = [_ColumnWriter(field) for field in fields]
+        rows = 0
+        queryset = model._base_manager.using(using).order_by('pk').values_list(*[f.attname for f in fields])
+        for row in queryset.iterator(chunk_size=chunk_size):
+            for writer, value in zip(writers, row):
+                writer.append(value)
+            rows += 1
+        columns = []
+        for writer in writers:
+            column = {'name': writer.field.attname, 'kind': writer.kind}
+            if writer.kind == 'decimal':
+                column['scale'] = writer.scale
+            column['offset'], column['length'] = self._block(writer.values.tobytes())
+            if writer.kind in ('text', 'json'):
+                encoded = [value.encode() for value in writer.dictionary]
+                offsets = array('q', [0])
+                for value in encoded:
+                    offsets.append(offsets[-1] + len(value))
+                column['dict_size'] = len(encoded)
+                column['dict_offsets'], _ = self._block(offsets.tobytes())
+                column['dict_data'], _ = self._block(b''.join(encoded))
+            columns.append(column)
+        return {'model': model._meta.label, 'table': model._meta.db_table, 'rows': rows, 'columns': columns}
+
+    def finish(self, header):
+        offset = self.f.tell()
+        self.f.write(json.dumps(header).encode())
+        self.f.write(FOOTER.pack(offset, MAGIC))
+
+
+def export_snapshot(path, using=DEFAULT_DB_ALIAS, chunk_size=10000):
+    """Grava um snapshot consistente (uma transação de leitura) do banco `using`; devolve o cabeçalho."""
+    with open(path, 'wb') as f, transaction.atomic(using=using):
+        writer = SnapshotWriter(f)
+        header = {
+            'version': VERSION,
+            'byteorder': sys.byteorder,
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'tables': [writer.write_table(model, using, chunk_size) for model in snapshot_models(using)],
+        }
+        writer.finish(header)
+    return header
+
+
+class Snapshot:
+    """Snapshot aberto com mmap; as colunas são lidas direto do mapeamento, sem cópia."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        offset, magic = FOOTER.unpack(self._map[-FOOTER.size:])
+        if self._map[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise ValueError(f"{path} is not a ledger snapshot")
+        self.header = json.loads(bytes(self._map[offset:len(self._map) - FOOTER.size]))
+        if self.header['version'] != VERSION:
+            raise ValueError(f"Unsupported snapshot version {self.header['version']}")
+        self._swap = self.header['byteorder'] != sys.byteorder
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _array(self, offset, length, typecode):
+        block = self._view[offset:offset + length]
+        if not self._swap:
+            return block.cast(typecode)
+        values = array(typecode, block)
+        values.byteswap()
+        return values
+
+    def column(self, column, start, stop):
+        """Valores Python das linhas [start, stop) da coluna."""
+        kind = column['kind']
+        if kind in ('text', 'json'):
+            codes = self._array(column['offset'], column['length'], 'i')[start:stop]
+            offsets = self._array(column['dict_offsets'], 8 * (column['dict_size'] + 1), 'q')
+            data, decoded = column['dict_data'], {}
+            values = []
+            for code in codes:
+                if code < 0:
+                    values.append(None)
+                    continue
+                value = decoded.get(code)
+                if value is None:
+                    value = decoded[code] = str(self._view[data + offsets[code]:data + offsets[code + 1]], 'utf-8')
+                    if kind == 'json':
+                        value = decoded[code] = json.loads(value)
+                values.append(value)
+            return values
+        if kind == 'bool':
+            return [None if v < 0 else bool(v) for v in self._array(column['offset'], column['length'], 'b')[start:stop]]
+        raw = self._array(column['offset'], column['length'], 'q')[start:stop]
+        if kind == 'int':
+            return [None if v == NULL else v for v in raw]
+        if kind == 'decimal':
+            scale = -column['scale']
+            return [None if v == NULL else Decimal(v).scaleb(scale) for v in raw]
+        if kind == 'datetime':
+            return [None if v == NULL else EPOCH + datetime.timedelta(microseconds=v) for v in raw]
+        return [None if v == NULL else datetime.date.fromordinal(v + EPOCH_DAY) for v in raw]
+
+
+def _check_schema(model, table):
+    expected = [f.attname for f in model._meta.local_concrete_fields]
+    found = [c['name'] for c in table['columns']]
+    if expected != found:
+        raise ValueError(f"Snapshot columns of {table['model']} {found} do not match the current schema {expected}")
+
+
+def import_snapshot(path, using=DEFAULT_DB_ALIAS, chunk_size=5000, replace=False):
+    """Restaura um snapshot no banco `using` numa única transação; devolve {modelo: linhas}.
+
+    Sem replace as tabelas de destino precisam estar vazias; com replace o conteúdo atual é apagado.
+    """
+    connection = connections[using]
+    loaded = {}
+    with Snapshot(path) as snapshot, transaction.atomic(using=using):
+        tables = [(apps.get_model(table['model']), table) for table in snapshot.header['tables']]
+        for model, table in tables:
+            _check_schema(model, table)
+        with connection.cursor() as cursor:
+            if replace:
+                # As FKs do Django são DEFERRABLE INITIALLY DEFERRED: a ordem só importa no commit
+                for model, _ in reversed(tables):
+                    cursor.execute(f"DELETE FROM {connection.ops.quote_name(model._meta.db_table)}")
+            else:
+                occupied = [model._meta.label for model, _ in tables if model._base_manager.using(using).exists()]
+                if occupied:
+                    raise ValueError(f"Target tables are not empty: {', '.join(occupied)}")
+            for model, table in tables:
+                fields = model._meta.local_concrete_fields
+                sql = "INSERT INTO {} ({}) VALUES ({})".format(
+                    connection.ops.quote_name(model._meta.db_table),
+                    ', '.join(connection.ops.quote_name(f.column) for f in fields),
+                    ', '.join(['%s'] * len(fields)),
+                )
+                # Inteiros, booleanos e texto vão direto; o resto passa pela preparação do campo
+                preps = [
+                    None if column['kind'] in ('int', 'bool', 'text') else field.get_db_prep_save
+                    for field, column in zip(fields, table['columns'])
+                ]
+                for start in range(0, table['rows'], chunk_size):
+                    stop = min(start + chunk_size, table['rows'])
+                    columns = []
+                    for prep, column in zip(preps, table['columns']):
+                        values = snapshot.column(column, start, stop)
+                        if prep is not None:
+                            values = [None if v is None else prep(v, connection) for v in values]
+                        columns.append(values)
+                    cursor.executemany(sql, list(zip(*columns)))
+                loaded[table['model']] = table['rows']
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model for model, _ in tables]):
+                cursor.execute(sql)
+    # Inserções diretas não disparam sinais: descarta caches de ids de referência
+    apps.get_model('transaction', 'TransactionStatus').clear_cache()
+    return loaded
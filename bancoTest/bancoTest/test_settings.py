@@ -0,0 +1,13 @@
+"""Settings da suíte de testes: `python manage.py test --settings=bancoTest.test_settings`.
+
+Os testes de particionamento ativam os shards com override_settings, mas o alias precisa
+existir em DATABASES quando os bancos de teste (em memória) são criados.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+DATABASES['shard1'] = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': BASE_DIR / 'shard1.sqlite3',
+}
@@ -1,3 +1,33 @@
 from django.contrib import admin
 
-# Register your models here.
+from accounts.admin import LargeTableAdmin
+from .models import Transaction, TransactionLog, TransactionStatus, TransactionType
+
+
+@admin.register(TransactionType)
+class TransactionTypeAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name',)
+
+
+@admin.register(TransactionStatus)
+class TransactionStatusAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name',)
+
+
+@admin.register(Transaction)
+class TransactionAdmin(LargeTableAdmin):
+    list_display = ('id', 'transaction_type', 'transaction_status', 'amount', 'customer', 'from_account', 'to_account', 'timestamp')
+    list_select_related = ('transaction_type', 'transaction_status', 'amount__currency', 'customer', 'from_account', 'to_account')
+    list_filter = ('transaction_type', 'transaction_status')
+    date_hierarchy = 'timestamp'
+    raw_id_fields = ('amount',)
+    autocomplete_fields = ('customer', 'from_account', 'to_account', 'transaction_type', 'transaction_status')
+    search_fields = ('idempotency_key',)
+
+
+@admin.register(TransactionLog)
+class TransactionLogAdmin(LargeTableAdmin):
+    list_display = ('transaction_id', 'timestamp', 'message')
+    raw_id_fields = ('transaction',)
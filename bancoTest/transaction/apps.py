@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class TransactionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'transaction'
+
+    def ready(self):
+        from accounts.jobs import job_finished
+        from .models import Transaction, TransactionStatus
+        # Ids de status mudaram: descarta o cache de TransactionStatus.id_for
+        post_save.connect(TransactionStatus.clear_cache, sender=TransactionStatus, dispatch_uid='transaction.status_cache.save')
+        post_delete.connect(TransactionStatus.clear_cache, sender=TransactionStatus, dispatch_uid='transaction.status_cache.delete')
+        # Evento adiado saiu da fila: a transação de origem vai para COMPLETED ou CANCELLED
+        job_finished.connect(Transaction.finish_deferred, dispatch_uid='transaction.finish_deferred')
@@ -0,0 +1,110 @@
+import functools
+import threading
+import time
+
+from django.db import connections, transaction as db_transaction
+from django.db.models import Q
+
+from accounts.sharding import current_shard
+from .models import TransactionLog
+
+
+class TransactionLogWriter:
+    """Acumula mensagens de TransactionLog e grava em lote com bulk_create.
+
+    O lote é gravado quando atinge `max_buffer` mensagens, quando a mensagem
+    mais antiga passa de `max_age` segundos ou ao sair do bloco `with`.
+    Dentro de um transaction.atomic() a gravação é registrada com on_commit:
+    se a postagem falhar e a transação for desfeita, o lote é descartado e
+    nenhum log órfão é gravado.
+
+        with TransactionLogWriter() as logs:
+            logs.log(transaction, 'Submitted')
+    """
+
+    def __init__(self, max_buffer=500, max_age=5.0, batch_size=500):
+        self.max_buffer = max_buffer
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self._buffer = []
+        self._first_at = None
+        self._lock = threading.Lock()
+
+    def log(self, transaction, message):
+        with self._lock:
+            if not self._buffer:
+                self._first_at = time.monotonic()
+            self._buffer.append(TransactionLog(transaction=transaction, message=message))
+            due = len(self._buffer) >= self.max_buffer or time.monotonic() - self._first_at >= self.max_age
+        if due:
+            self.flush()
+
+    def _take(self):
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+            self._first_at = None
+        return batch
+
+    def _write(self, alias, batch):
+        TransactionLog.objects.using(alias).bulk_create(batch, batch_size=self.batch_size)
+
+    def flush(self):
+        # Cada log vai para o shard da sua transação (o middleware grava fora de use_shard)
+        by_alias = {}
+        for log in self._take():
+            by_alias.setdefault(log.transaction._state.db or current_shard(), []).append(log)
+        for alias, batch in by_alias.items():
+            if connections[alias].in_atomic_block:
+                db_transaction.on_commit(functools.partial(self._write, alias, batch), using=alias)
+            else:
+                self._write(alias, batch)
+
+    def discard(self):
+        self._take()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+
+def read_logs(transaction, after=None, limit=100):
+    """Página do histórico de logs de uma transação, em ordem de timestamp.
+
+    Paginação por cursor sobre o índice (transaction, timestamp, id): `after` é o
+    cursor (timestamp, id) devolvido pela página anterior. Retorna (logs, cursor),
+    com cursor None na última página.
+    """
+    logs = TransactionLog.objects.filter(transaction=transaction)
+    if after is not None:
+        timestamp, log_id = after
+        logs = logs.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=log_id))
+    page = list(logs.order_by('timestamp', 'id')[:limit + 1])
+    if len(page) > limit:
+        page = page[:limit]
+        return page, (page[-1].timestamp, page[-1].id)
+    return page, None
+
+
+class TransactionLogMiddleware:
+    # Disponibiliza request.transaction_logs, gravado ao fim da requisição
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        writer = request.transaction_logs = TransactionLogWriter()
+        try:
+            response = self.get_response(request)
+        except Exception:
+            writer.discard()
+            raise
+        writer.flush()
+        return response
@@ -0,0 +1,54 @@
+import random
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from accounts.models import Money
+from bancoTest.bench import benchmark_database, measure, seed_bank
+from transaction.models import Transaction, TransactionStatus, TransactionType
+
+
+class Command(BaseCommand):
+    help = 'Replay benchmark for idempotent transaction submission with a high duplicate ratio'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--submissions', type=int, default=5000)
+        parser.add_argument('--duplicate-ratio', type=float, default=0.8)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        total = options['submissions']
+        ratio = options['duplicate_ratio']
+        rng = random.Random(options['seed'])
+
+        # Sequência de chaves em que `ratio` dos envios repetem uma chave já vista
+        keys = []
+        for i in range(total):
+            if keys and rng.random() < ratio:
+                keys.append(rng.choice(keys))
+            else:
+                keys.append(f'key-{i}')
+        unique = len(set(keys))
+
+        with benchmark_database():
+            ((customer, account),) = seed_bank(customers=1)
+            deposit = TransactionType.objects.get(name='DEPOSIT')
+            completed = TransactionStatus.objects.get(name='COMPLETED')
+            amount = Money.objects.create(amount=Decimal('10.00'), currency=account.currency)
+            fields = dict(customer=customer, from_account=account, amount=amount,
+                          transaction_type=deposit, transaction_status=completed)
+
+            with measure('submit (one by one)') as single:
+                created = sum(Transaction.submit(idempotency_key=f's-{key}', **fields)[1] for key in keys)
+            self.stdout.write(single.report(total))
+            self.stdout.write(f"  created {created} / unique {unique}")
+
+            with measure('submit_many (batched)') as batched:
+                created = 0
+                size = options['batch_size']
+                for start in range(0, total, size):
+                    batch = [dict(fields, idempotency_key=f'b-{key}') for key in keys[start:start + size]]
+                    created += sum(c for _, c in Transaction.submit_many(batch))
+            self.stdout.write(batched.report(total))
+            self.stdout.write(f"  created {created} / unique {unique}")
@@ -0,0 +1,215 @@
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+
+from accounts.models import Customer
+from bancoTest.bench import QUERY_HEADER, benchmark_database, count_queries, seed_bank
+
+# Peso de cada operação no mix de carga
+MIX = [('deposit', 30), ('withdrawal', 15), ('transfer', 15), ('balance', 25), ('statement', 15)]
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class QueryCountingApp:
+    # Envolve a aplicação WSGI do servidor local e devolve o número de consultas em um cabeçalho
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        with count_queries() as count:
+            def counted_start_response(status, headers, exc_info=None):
+                return start_response(status, headers + [(QUERY_HEADER, str(count[0]))], exc_info)
+
+            return self.app(environ, counted_start_response)
+
+
+@contextmanager
+def local_server():
+    server = ThreadedWSGIServer(('127.0.0.1', 0), _QuietHandler, allow_reuse_address=True)
+    server.set_app(QueryCountingApp(get_wsgi_application()))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class LoadGenerator:
+    def __init__(self, base_url, accounts, seed=42):
+        # accounts: [(customer_id, account_id)]
+        self.base_url = base_url.rstrip('/')
+        self.accounts = accounts
+        self.rng = random.Random(seed)
+        names, weights = zip(*MIX)
+        self.names, self.weights = names, weights
+
+    def plan(self, requests):
+        plan = []
+        for _ in range(requests):
+            kind = self.rng.choices(self.names, self.weights)[0]
+            (customer_id, account_id), (_, other_id) = self.rng.sample(self.accounts, 2) if len(self.accounts) > 1 else self.accounts * 2
+            plan.append((kind, customer_id, account_id, other_id, f"{self.rng.randint(1, 100)}.00"))
+        return plan
+
+    def request(self, kind, customer_id, account_id, other_id, amount):
+        if kind in ('balance', 'statement'):
+            # ?customer= escolhe o shard da conta quando o razão é particionado
+            suffix = f'?customer={customer_id}' + ('&page_size=50' if kind == 'statement' else '')
+            return urllib.request.Request(f"{self.base_url}/accounts/{account_id}/{kind}/{suffix}")
+        body = {'customer': customer_id, 'from_account': account_id, 'transaction_type': kind.upper(), 'amount': amount}
+        if kind == 'transfer':
+            body['to_account'] = other_id
+        return urllib.request.Request(
+            f"{self.base_url}/transactions/", data=json.dumps(body).encode(),
+            headers={'Content-Type': 'application/json'}, method='POST',
+        )
+
+    def send(self, item, scheduled):
+        kind = item[0]
+        if scheduled:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        start = scheduled or time.perf_counter()
+        try:
+            with urllib.request.urlopen(self.request(*item), timeout=30) as response:
+                response.read()
+                status, queries = response.status, response.headers.get(QUERY_HEADER)
+        except urllib.error.HTTPError as e:
+            status, queries = e.code, e.headers.get(QUERY_HEADER)
+        except OSError:
+            status, queries = None, None
+        # Com taxa fixa a latência conta desde o horário agendado (evita omissão coordenada)
+        return kind, time.perf_counter() - start, status, int(queries) if queries is not None else None
+
+    def run(self, requests, concurrency, rate=0):
+        plan = self.plan(requests)
+        start = time.perf_counter()
+        schedule = [start + i / rate if rate else None for i in range(len(plan))]
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(self.send, plan, schedule))
+        return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    report = {'elapsed': round(elapsed, 3), 'endpoints': {}}
+    kinds = [name for name, _ in MIX] + ['all']
+    for kind in kinds:
+        rows = [r for r in results if kind == 'all' or r[0] == kind]
+        if not rows:
+            continue
+        latencies = [r[1] * 1000 for r in rows]
+        errors = sum(1 for r in rows if r[2] is None or r[2] >= 400)
+        queries = [r[3] for r in rows if r[3] is not None]
+        report['endpoints'][kind] = {
+            'requests': len(rows),
+            'throughput': round(len(rows) / elapsed, 1),
+            'error_rate': round(errors / len(rows), 4),
+            'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'queries_avg': round(sum(queries) / len(queries), 1) if queries else None,
+        }
+    return report
+
+
+def compare(report, baseline):
+    # {endpoint: {métrica: variação relativa}}; positivo = pior para latência, melhor para throughput
+    deltas = {}
+    for kind, current in report['endpoints'].items():
+        previous = baseline['endpoints'].get(kind)
+        if not previous:
+            continue
+        deltas[kind] = {
+            metric: round((current[metric] - previous[metric]) / previous[metric], 4)
+            for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput')
+            if previous.get(metric)
+        }
+    return deltas
+
+
+class Command(BaseCommand):
+    help = 'HTTP load test: transaction submissions and balance/statement reads with a latency report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server; by default a local server on a throwaway database')
+        parser.add_argument(
+            '--seed', action=argparse.BooleanOptionalAction,
+            help='With --url: create --customers new customers in the configured database (--seed) or use '
+                 'its existing customers (--no-seed). Required with --url; the database must be the server\'s',
+        )
+        parser.add_argument('--customers', type=int, default=20)
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--rate', type=float, default=0, help='Target requests per second (0 = as fast as possible)')
+        parser.add_argument('--random-seed', type=int, default=42)
+        parser.add_argument('--save-baseline', help='Write the report to this JSON file')
+        parser.add_argument('--baseline', help='Compare against a report saved with --save-baseline')
+        parser.add_argument('--max-regression', type=float, help='Fail if any p95 is this fraction worse than the baseline')
+
+    def accounts(self, options):
+        if not options['url'] or options['seed']:
+            return [(customer.id, account.id) for customer, account in seed_bank(customers=options['customers'])]
+        accounts = list(
+            Customer.objects.filter(accounts__isnull=False).order_by('id')
+            .values_list('id', 'accounts')[:options['customers']]
+        )
+        if not accounts:
+            raise CommandError('The configured database has no customers with accounts; use --seed')
+        return accounts
+
+    def handle(self, *args, **options):
+        if options['url'] and options['seed'] is None:
+            # Com --url os clientes são lidos ou criados no banco configurado: a escolha é explícita
+            raise CommandError('--url requires --seed or --no-seed')
+        database = nullcontext() if options['url'] else benchmark_database(on_disk=True)
+        with database:
+            accounts = self.accounts(options)
+            server = nullcontext(options['url']) if options['url'] else local_server()
+            with server as base_url:
+                generator = LoadGenerator(base_url, accounts, seed=options['random_seed'])
+                results, elapsed = generator.run(options['requests'], options['concurrency'], options['rate'])
+        report = summarize(results, elapsed)
+
+        self.stdout.write(f"{'endpoint':<11}{'reqs':>7}{'req/s':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}")
+        for kind, row in report['endpoints'].items():
+            queries = '-' if row['queries_avg'] is None else row['queries_avg']
+            self.stdout.write(
+                f"{kind:<11}{row['requests']:>7}{row['throughput']:>9}{row['error_rate']:>8.1%}"
+                f"{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}{queries:>9}"
+            )
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                deltas = compare(report, json.load(f))
+            self.stdout.write(json.dumps(deltas, indent=2))
+            limit = options['max_regression']
+            regressed = [kind for kind, delta in deltas.items() if limit is not None and delta.get('p95_ms', 0) > limit]
+            if regressed:
+                raise CommandError(f"p95 regressed more than {limit:.0%} on: {', '.join(regressed)}")
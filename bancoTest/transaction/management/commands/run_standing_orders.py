@@ -0,0 +1,32 @@
+from collections import Counter
+
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from accounts.sharding import each_shard
+from bancoTest.profiling import ProfiledCommand
+from transaction.standing_orders import StandingOrderExecutor
+
+
+class Command(ProfiledCommand):
+    help = 'Execute the standing orders due on a date in batches grouped by source account'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Run date (YYYY-MM-DD); defaults to today')
+        parser.add_argument('--batch-size', type=int, default=500, help='Source accounts per transaction')
+        parser.add_argument('--allow-overdraft', action='store_true')
+
+    def handle(self, *args, **options):
+        run_date = parse_date(options['date']) if options['date'] else timezone.localdate()
+        if run_date is None:
+            raise CommandError(f"Invalid date: {options['date']}")
+        report = {}
+        for _ in each_shard():
+            executor = StandingOrderExecutor(run_date, batch_size=options['batch_size'], allow_overdraft=options['allow_overdraft'])
+            report.update(executor.run())
+        for order_id, result in sorted(report.items()):
+            if result != 'OK':
+                self.stdout.write(f"Order {order_id}: {result}")
+        counts = Counter('OK' if result == 'OK' else 'FAILED' for result in report.values())
+        self.stdout.write(f"{counts['OK']} standing orders executed, {counts['FAILED']} failed for {run_date}")
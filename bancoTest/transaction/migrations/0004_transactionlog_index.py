@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transaction', '0003_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transactionlog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='transactionlog',
+            index=models.Index(fields=['transaction', 'timestamp', 'id'], name='transaction_transac_72acc0_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_shardmap'),
+        ('transaction', '0004_transactionlog_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrossShardTransfer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('PREPARED', 'Prepared'), ('COMMITTED', 'Committed'), ('DONE', 'Done'), ('ABORTED', 'Aborted')], default='PREPARED', max_length=10)),
+                ('source_shard', models.CharField(max_length=50)),
+                ('source_account_id', models.BigIntegerField()),
+                ('target_shard', models.CharField(max_length=50)),
+                ('target_account_id', models.BigIntegerField()),
+                ('entry_type_id', models.BigIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('currency', models.CharField(max_length=3)),
+                ('when', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='transaction_status_a0b433_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='CrossShardLeg',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transfer_id', models.BigIntegerField()),
+                ('leg', models.CharField(choices=[('DEBIT', 'Debit'), ('CREDIT', 'Credit')], max_length=6)),
+                ('entry', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, to='accounts.entry')),
+            ],
+            options={
+                'unique_together': {('transfer_id', 'leg')},
+            },
+        ),
+    ]
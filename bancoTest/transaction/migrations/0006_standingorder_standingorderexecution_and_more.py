@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_ledgerjournal'),
+        ('transaction', '0005_crossshardtransfer_crossshardleg'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StandingOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('frequency', models.CharField(choices=[('DAILY', 'Daily'), ('WEEKLY', 'Weekly'), ('MONTHLY', 'Monthly')], default='MONTHLY', max_length=10)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField(blank=True, null=True)),
+                ('next_run_date', models.DateField()),
+                ('last_run_date', models.DateField(blank=True, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.currency')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='standing_orders', to='accounts.customer')),
+                ('from_account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='standing_orders_from', to='accounts.account')),
+                ('to_account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='standing_orders_to', to='accounts.account')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StandingOrderExecution',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_date', models.DateField()),
+                ('due_date', models.DateField()),
+                ('status', models.CharField(max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('credit_entry', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='accounts.entry')),
+                ('debit_entry', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='accounts.entry')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='executions', to='transaction.standingorder')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='standingorder',
+            index=models.Index(fields=['is_active', 'next_run_date'], name='transaction_is_acti_84a338_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='standingorderexecution',
+            index=models.Index(fields=['run_date', 'status'], name='transaction_run_dat_f6efa0_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:29
+
+from django.db import migrations, models
+
+
+def fill_is_pending(apps, schema_editor):
+    Transaction = apps.get_model('transaction', 'Transaction')
+    Transaction.objects.using(schema_editor.connection.alias).filter(transaction_status__name='PENDING').update(is_pending=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_ledgerjournal'),
+        ('transaction', '0006_standingorder_standingorderexecution_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='is_pending',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(fill_is_pending, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('is_pending', True)), fields=['timestamp'], name='transaction_pending_idx'),
+        ),
+    ]
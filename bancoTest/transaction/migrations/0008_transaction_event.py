@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def link_events(apps, schema_editor):
+    # Os eventos criados por create_accounting_event usam o mesmo Money da transação
+    alias = schema_editor.connection.alias
+    Transaction = apps.get_model('transaction', 'Transaction')
+    for name in ('DepositEvent', 'WithdrawalEvent', 'TransferEvent'):
+        model = apps.get_model('transaction', name)
+        events = dict(model.objects.using(alias).values_list('amount_id', 'accountingevent_ptr_id'))
+        for transaction in Transaction.objects.using(alias).filter(event__isnull=True, amount_id__in=list(events)):
+            transaction.event_id = events[transaction.amount_id]
+            transaction.save(update_fields=['event'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_archivedentry_events'),
+        ('transaction', '0007_transaction_is_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='event',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='source_transaction', to='accounts.accountingevent'),
+        ),
+        migrations.RunPython(link_events, migrations.RunPython.noop),
+    ]
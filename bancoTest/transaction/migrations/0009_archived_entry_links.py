@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0018_period_summary_watermark'),
+        ('transaction', '0008_transaction_event'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='crossshardleg',
+            name='entry',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='accounts.entry'),
+        ),
+        migrations.AlterField(
+            model_name='standingorderexecution',
+            name='credit_entry',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='accounts.entry'),
+        ),
+        migrations.AlterField(
+            model_name='standingorderexecution',
+            name='debit_entry',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='accounts.entry'),
+        ),
+    ]
@@ -1,5 +1,8 @@
 # transactions/models.py
-from django.db import models
+import calendar
+
+from django.db import IntegrityError, models
+from django.utils import timezone
 
 from accounts.models import (
     AccountingEvent,
@@ -11,7 +14,12 @@ from accounts.models import (
     Entry,
     Account,
     Customer,
+    Currency,
+    OutboxMessage,
+    post_to_memory_ledger,
     )
+from accounts.plans import ACCOUNT, FROM_ACCOUNT, TO_ACCOUNT, CalculationPlan
+from accounts.sharding import current_shard, on_instance_shard, shard_atomic, use_shard
 
 class TransactionType(models.Model):
     name = models.CharField(max_length=50, unique=True)
@@ -20,11 +28,54 @@ class TransactionType(models.Model):
         return self.name
     
 class TransactionStatus(models.Model):
+    PENDING = 'PENDING'
+    COMPLETED = 'COMPLETED'
+    CANCELLED = 'CANCELLED'
+    # Transições permitidas; COMPLETED e CANCELLED são finais
+    TRANSITIONS = {PENDING: {COMPLETED, CANCELLED}}
+
     name = models.CharField(max_length=50, unique=True)
 
+    # nome <-> id cacheados no processo; os ids são os mesmos em todos os shards
+    _ids = {}
+    _names = {}
+
     def __str__(self):
         return self.name
 
+    @classmethod
+    def id_for(cls, name):
+        status_id = cls._ids.get(name)
+        if status_id is None:
+            status_id = cls.objects.get_or_create(name=name)[0].id
+            cls._ids[name], cls._names[status_id] = status_id, name
+        return status_id
+
+    @classmethod
+    def name_for(cls, status_id):
+        name = cls._names.get(status_id)
+        if name is None:
+            name = cls.objects.values_list('name', flat=True).get(id=status_id)
+            cls._ids[name], cls._names[status_id] = status_id, name
+        return name
+
+    @classmethod
+    def clear_cache(cls, **kwargs):
+        cls._ids.clear()
+        cls._names.clear()
+
+    @classmethod
+    def load_cache(cls):
+        # Preenche o cache com todos os status numa consulta (aquecimento de workers)
+        for status_id, name in cls.objects.values_list('id', 'name'):
+            cls._ids[name], cls._names[status_id] = status_id, name
+        return len(cls._ids)
+
+    @classmethod
+    def check_transition(cls, source, target):
+        if target not in cls.TRANSITIONS.get(source, ()):
+            raise ValueError(f"Invalid transaction status transition {source} -> {target}")
+
 class Transaction(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
     from_account = models.ForeignKey(Account, on_delete=models.PROTECT, related_name='transactions_from')
@@ -33,41 +84,161 @@ class Transaction(models.Model):
     transaction_type = models.ForeignKey(TransactionType, on_delete=models.PROTECT)
     transaction_status = models.ForeignKey(TransactionStatus, on_delete=models.PROTECT)
     description = models.TextField(null=True, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    idempotency_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    # Espelho de transaction_status == PENDING mantido por save() e pelas transições
+    is_pending = models.BooleanField(default=False)
+    # Evento contábil criado por create_accounting_event (encerra a transação quando um job adiado termina)
+    event = models.OneToOneField(AccountingEvent, on_delete=models.SET_NULL, null=True, blank=True, related_name='source_transaction')
+
+    class Meta:
+        indexes = [
+            # Só as pendentes entram no índice: as varreduras de liquidação não leem o histórico concluído
+            models.Index(fields=['timestamp'], name='transaction_pending_idx', condition=models.Q(is_pending=True)),
+        ]
 
     def __str__(self):
-        return f"{self.transaction_type} - {self.amount} - {self.status}"
+        return f"{self.transaction_type} - {self.amount} - {self.transaction_status}"
+
+    def save(self, *args, **kwargs):
+        self.is_pending = self.transaction_status_id == TransactionStatus.id_for(TransactionStatus.PENDING)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'transaction_status' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'is_pending'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def pending(cls):
+        return cls.objects.filter(is_pending=True)
+
+    @on_instance_shard
+    def transition(self, target):
+        """Muda para o status target com um UPDATE condicional; ValueError se a transição for inválida
+        ou se outra execução já tiver mudado o status."""
+        source = TransactionStatus.name_for(self.transaction_status_id)
+        TransactionStatus.check_transition(source, target)
+        target_id = TransactionStatus.id_for(target)
+        is_pending = target == TransactionStatus.PENDING
+        updated = Transaction.objects.filter(id=self.id, transaction_status_id=self.transaction_status_id).update(
+            transaction_status_id=target_id, is_pending=is_pending
+        )
+        if not updated:
+            raise ValueError(f"Transaction {self.id} is no longer {source}")
+        self.transaction_status_id, self.is_pending = target_id, is_pending
+
+    @classmethod
+    def transition_many(cls, transactions, source, target, batch_size=1000):
+        """Move de source para target as transações (ids ou queryset) que ainda estão em source.
+
+        Um UPDATE condicional por lote; as que já saíram de source ficam como estão. Devolve quantas mudaram.
+        """
+        TransactionStatus.check_transition(source, target)
+        source_id, target_id = TransactionStatus.id_for(source), TransactionStatus.id_for(target)
+        if isinstance(transactions, models.QuerySet):
+            if source == TransactionStatus.PENDING:
+                transactions = transactions.filter(is_pending=True)
+            transactions = transactions.filter(transaction_status_id=source_id).order_by().values_list('id', flat=True)
+        ids = list(transactions)
+        moved = 0
+        for start in range(0, len(ids), batch_size):
+            moved += cls.objects.filter(id__in=ids[start:start + batch_size], transaction_status_id=source_id).update(
+                transaction_status_id=target_id, is_pending=target == TransactionStatus.PENDING
+            )
+        return moved
+
+    @classmethod
+    def finish_deferred(cls, sender, event, succeeded, error=None, **kwargs):
+        # Receptor de accounts.jobs.job_finished; só muda transações ainda PENDING
+        target = TransactionStatus.COMPLETED if succeeded else TransactionStatus.CANCELLED
+        with use_shard(event._state.db or current_shard()):
+            ids = list(cls.objects.filter(event_id=event.id).values_list('id', flat=True))
+            if ids:
+                cls.transition_many(ids, TransactionStatus.PENDING, target)
+
+    @classmethod
+    def submit(cls, idempotency_key=None, **fields):
+        # Retorna (transaction, created). Um reenvio com a mesma chave devolve a transação original
+        # com uma única busca pelo índice único de idempotency_key.
+        if idempotency_key:
+            existing = cls.objects.filter(idempotency_key=idempotency_key).first()
+            if existing is not None:
+                return existing, False
+        amount = fields.get('amount')
+        unsaved_amount = amount is not None and amount.pk is None
+        try:
+            with shard_atomic():
+                # Um Money ainda não gravado só é criado junto com a transação: se a chave perder
+                # a corrida, ele é desfeito com ela e não fica órfão
+                if unsaved_amount:
+                    amount.save()
+                return cls.objects.create(idempotency_key=idempotency_key, **fields), True
+        except IntegrityError:
+            if unsaved_amount:
+                amount.pk = amount.id = None
+            # Corrida entre dois envios simultâneos com a mesma chave
+            if not idempotency_key:
+                raise
+            return cls.objects.get(idempotency_key=idempotency_key), False
+
+    @classmethod
+    def submit_many(cls, submissions):
+        # submissions: lista de dicts com os campos da transação e, opcionalmente, 'idempotency_key'.
+        # As chaves já existentes são resolvidas numa única consulta; as novas são criadas em bloco.
+        keys = [s.get('idempotency_key') for s in submissions if s.get('idempotency_key')]
+        existing = {t.idempotency_key: t for t in cls.objects.filter(idempotency_key__in=keys)} if keys else {}
+        results = []
+        to_create = []
+        for submission in submissions:
+            key = submission.get('idempotency_key')
+            if key and key in existing:
+                results.append((existing[key], False))
+                continue
+            transaction = cls(**submission)
+            # bulk_create não passa por save()
+            transaction.is_pending = transaction.transaction_status_id == TransactionStatus.id_for(TransactionStatus.PENDING)
+            if key:
+                existing[key] = transaction  # duplicata dentro do próprio lote
+            to_create.append(transaction)
+            results.append((transaction, True))
+        try:
+            with shard_atomic():
+                cls.objects.bulk_create(to_create)
+        except IntegrityError:
+            # Outro envio gravou uma das chaves entre a consulta e o INSERT: o lote inteiro foi
+            # desfeito, então cada envio é resolvido individualmente por submit()
+            return [cls.submit(**submission) for submission in submissions]
+        return results
 
+    @on_instance_shard
     def create_accounting_event(self):
         event_type = EventType.objects.get(name=self.transaction_type.name)
         if self.transaction_type.name == 'DEPOSIT':
-            return DepositEvent.objects.create(
-                event_type=event_type,
-                when_occurred=self.timestamp,
-                when_noticed=self.timestamp, # Rever quando o evento é executado, atualmente é quando ele é criado
-                customer=self.customer,
-                account=self.from_account,
-                amount=self.amount
-            )
+            event_class = DepositEvent
+            fields = {'account': self.from_account, 'amount': self.amount}
         elif self.transaction_type.name == 'WITHDRAWAL':
-            return WithdrawalEvent.objects.create(
-                event_type=event_type,
-                when_occurred=self.timestamp,
-                when_noticed=self.timestamp,
-                customer=self.customer,
-                account=self.from_account,
-                amount=self.amount,
-            )
+            event_class = WithdrawalEvent
+            fields = {'account': self.from_account, 'amount': self.amount}
         elif self.transaction_type.name == 'TRANSFER':
-            return TransferEvent.objects.create(
+            event_class = TransferEvent
+            fields = {'from_account': self.from_account, 'to_account': self.to_account, 'amount': self.amount}
+        else:
+            return None
+
+        event_key = f"transaction:{self.idempotency_key}" if self.idempotency_key else None
+        event = event_class.objects.filter(idempotency_key=event_key).first() if event_key else None
+        if event is None:
+            event = event_class.objects.create(
                 event_type=event_type,
                 when_occurred=self.timestamp,
-                when_noticed=self.timestamp,
+                when_noticed=self.timestamp, # Rever quando o evento é executado, atualmente é quando ele é criado
                 customer=self.customer,
-                from_account=self.from_account,
-                to_account=self.to_account,
-                amount=self.amount,
+                idempotency_key=event_key,
+                **fields
             )
+        if self.pk and self.event_id != event.id:
+            self.event_id = event.id
+            Transaction.objects.filter(id=self.id).update(event=event)
+        return event
 
 class DepositEvent(AccountingEvent):
     account = models.ForeignKey(Account, on_delete=models.PROTECT)
@@ -83,18 +254,29 @@ class TransferEvent(AccountingEvent):
     amount = models.ForeignKey(Money, on_delete=models.PROTECT)
 
 class DepositPR(PostingRule):
+    def compile_plan(self):
+        return CalculationPlan([(ACCOUNT, 1)])
+
     def calculate_amount(self, event):
         return event.amount
 
 class WithdrawalPR(PostingRule):
+    def compile_plan(self):
+        return CalculationPlan([(ACCOUNT, -1)])
+
     def calculate_amount(self, event):
         return event.amount.negate()
 
 class TransferPR(PostingRule):
+    def compile_plan(self):
+        # Perna negativa na conta de origem e positiva na de destino, cada uma na moeda da sua conta
+        return CalculationPlan([(FROM_ACCOUNT, -1), (TO_ACCOUNT, 1)])
+
     def calculate_amount(self, event):
         # Cria duas entradas: uma negativa para a conta de origem e uma positiva para a conta de destino
-        from_acount_amount = event.amount.negate()
-        to_account_amount = event.amount
+        # Se as contas tiverem moedas diferentes, cada perna é convertida para a moeda da sua conta
+        from_acount_amount = event.amount.convert_to(event.from_account.currency, event.when_occurred).negate()
+        to_account_amount = event.amount.convert_to(event.to_account.currency, event.when_occurred)
 
         self.make_entry_with_account(event, from_acount_amount, event.from_account)
         self.make_entry_with_account(event, to_account_amount, event.to_account)
@@ -102,20 +284,137 @@ class TransferPR(PostingRule):
         return None
     
     def make_entry_with_account(self, event, amount, account):
-        entry = Entry.objects.create(
-            account=account,
-            entry_type=self.entry_type,
-            amount=amount,
-            date=event.when_noticed
-        )
-        print(f"Entrada: {self.entry_type} Valor: {amount} Evento: {event.event_type}")
-        #event.customer.add_entry(entry)
-        event.resulting_entries.add(entry)
+        if account.memory_ledger:
+            return post_to_memory_ledger(account, self.entry_type, amount, event.when_noticed, event, valid_date=event.when_occurred)
+        with shard_atomic():
+            entry = Entry.objects.create(
+                account=account,
+                entry_type=self.entry_type,
+                amount=amount,
+                date=event.when_noticed,
+                valid_date=event.when_occurred,
+            )
+            print(f"Entrada: {self.entry_type} Valor: {amount} Evento: {event.event_type}")
+            #event.customer.add_entry(entry)
+            event.resulting_entries.add(entry)
+            account.apply_posting(amount, entry.date)
+            OutboxMessage.record_entry(entry, event, OutboxMessage.ENTRY_POSTED)
        
+class CrossShardTransfer(models.Model):
+    # Registro do coordenador (banco 'default') de uma transferência entre clientes em shards
+    # diferentes; ver transaction/transfers.py. COMMITTED é a decisão: a partir dela as pernas
+    # que faltarem são reaplicadas pelo recover_transfers.
+    PREPARED = 'PREPARED'
+    COMMITTED = 'COMMITTED'
+    DONE = 'DONE'
+    ABORTED = 'ABORTED'
+    STATUS_CHOICES = [(PREPARED, 'Prepared'), (COMMITTED, 'Committed'), (DONE, 'Done'), (ABORTED, 'Aborted')]
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PREPARED)
+    source_shard = models.CharField(max_length=50)
+    source_account_id = models.BigIntegerField()
+    target_shard = models.CharField(max_length=50)
+    target_account_id = models.BigIntegerField()
+    entry_type_id = models.BigIntegerField()
+    amount = models.DecimalField(max_digits=15, decimal_places=2)
+    currency = models.CharField(max_length=3)
+    when = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    def __str__(self):
+        return f"Transfer {self.id} {self.source_shard}->{self.target_shard} {self.status}"
+
+class CrossShardLeg(models.Model):
+    # Perna aplicada num shard; a unicidade torna a reaplicação idempotente
+    DEBIT = 'DEBIT'
+    CREDIT = 'CREDIT'
+
+    transfer_id = models.BigIntegerField()
+    leg = models.CharField(max_length=6, choices=[(DEBIT, 'Debit'), (CREDIT, 'Credit')])
+    # Nulo depois que accounts/archive.py arquiva a entrada (ArchivedEntry.original_id guarda o id)
+    entry = models.OneToOneField(Entry, null=True, blank=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        unique_together = ('transfer_id', 'leg')
+
+    def __str__(self):
+        return f"Transfer {self.transfer_id} {self.leg}"
+
+class StandingOrder(models.Model):
+    # Transferência recorrente executada em lote pelo run_standing_orders (transaction/standing_orders.py)
+    DAILY = 'DAILY'
+    WEEKLY = 'WEEKLY'
+    MONTHLY = 'MONTHLY'
+    FREQUENCY_CHOICES = [(DAILY, 'Daily'), (WEEKLY, 'Weekly'), (MONTHLY, 'Monthly')]
+
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='standing_orders')
+    from_account = models.ForeignKey(Account, on_delete=models.PROTECT, related_name='standing_orders_from')
+    to_account = models.ForeignKey(Account, on_delete=models.PROTECT, related_name='standing_orders_to')
+    amount = models.DecimalField(max_digits=15, decimal_places=2)
+    currency = models.ForeignKey(Currency, on_delete=models.PROTECT)
+    frequency = models.CharField(max_length=10, choices=FREQUENCY_CHOICES, default=MONTHLY)
+    start_date = models.DateField()
+    end_date = models.DateField(null=True, blank=True)
+    next_run_date = models.DateField()
+    last_run_date = models.DateField(null=True, blank=True)
+    is_active = models.BooleanField(default=True)
+    description = models.TextField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['is_active', 'next_run_date'])]
+
+    def save(self, *args, **kwargs):
+        if self.next_run_date is None:
+            self.next_run_date = self.start_date
+        super().save(*args, **kwargs)
+
+    def following_date(self, date):
+        if self.frequency == self.DAILY:
+            return date + timezone.timedelta(days=1)
+        if self.frequency == self.WEEKLY:
+            return date + timezone.timedelta(days=7)
+        # Mensal: mesmo dia do start_date, limitado ao último dia do mês
+        year, month = (date.year + 1, 1) if date.month == 12 else (date.year, date.month + 1)
+        return date.replace(year=year, month=month, day=min(self.start_date.day, calendar.monthrange(year, month)[1]))
+
+    def __str__(self):
+        return f"{self.frequency} {self.amount} {self.currency_id} {self.from_account_id}->{self.to_account_id}"
+
+class StandingOrderExecution(models.Model):
+    # Resultado de cada ordem em cada execução; falhas ficam registradas e a ordem segue devida
+    OK = 'OK'
+    FAILED = 'FAILED'
+
+    order = models.ForeignKey(StandingOrder, on_delete=models.CASCADE, related_name='executions')
+    run_date = models.DateField()
+    due_date = models.DateField()
+    status = models.CharField(max_length=10)
+    error = models.TextField(blank=True)
+    # Ficam nulas quando as entradas são arquivadas (accounts/archive.py)
+    debit_entry = models.ForeignKey(Entry, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    credit_entry = models.ForeignKey(Entry, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['run_date', 'status'])]
+
+    def __str__(self):
+        return f"Order {self.order_id} {self.due_date} {self.status}"
+
 class TransactionLog(models.Model):
     transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='logs')
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Preenchido quando a mensagem é registrada, não quando o lote é gravado (ver transaction/logs.py)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['transaction', 'timestamp', 'id']),
+        ]
 
     def __str__(self):
         return f"Log for {self.transaction} at {self.timestamp}"
@@ -0,0 +1,168 @@
+import datetime
+from decimal import Decimal
+
+from django.db.models import BooleanField, Case, DateField, F, Sum, Value, When
+from django.utils import timezone
+
+from accounts.models import AccountBalanceShard, Entry, EventType, Money, OutboxMessage, conversion_service
+from accounts.sharding import shard_atomic
+from .models import StandingOrder, StandingOrderExecution
+
+
+class StandingOrderExecutor:
+    """Executa as ordens permanentes devidas numa data.
+
+    As ordens devidas (índice is_active + next_run_date) são agrupadas por conta de origem
+    e processadas em lotes de contas. Em cada lote, dentro de uma transação: os saldos das
+    contas de origem vêm de uma consulta agregada, os fundos são conferidos em memória na
+    ordem dos ids, as pernas são gravadas com bulk_create e as próximas datas avançam num
+    único UPDATE. Cada ordem recebe um StandingOrderExecution com OK ou o motivo da falha;
+    as que falham continuam devidas e são tentadas de novo na próxima execução.
+    """
+
+    def __init__(self, run_date, batch_size=500, allow_overdraft=False):
+        self.run_date = run_date
+        self.batch_size = batch_size
+        self.allow_overdraft = allow_overdraft
+        self._rules = {}
+
+    def due_account_ids(self):
+        return list(
+            StandingOrder.objects.filter(is_active=True, next_run_date__lte=self.run_date)
+            .order_by('from_account').values_list('from_account', flat=True).distinct()
+        )
+
+    def balances(self, account_ids):
+        # {account_id: saldo na moeda da conta}. Entradas em outra moeda são agrupadas também
+        # pela data, para serem convertidas na taxa da data de cada entrada, como em Account.balance
+        balances = {account_id: Decimal('0.00') for account_id in account_ids}
+        converted_at = Case(When(amount__currency=F('account__currency'), then=Value(None)), default=F('date'))
+        rows = (
+            Entry.objects.filter(account__in=account_ids)
+            .annotate(converted_at=converted_at)
+            .values('account', 'account__currency__code', 'amount__currency__code', 'converted_at')
+            .annotate(total=Sum('amount__amount'))
+            .order_by()
+        )
+        for row in rows:
+            amount = row['total']
+            if row['converted_at'] is not None:
+                amount = conversion_service().convert(amount, row['amount__currency__code'], row['account__currency__code'], row['converted_at'])
+            balances[row['account']] += amount
+        return balances
+
+    def entry_type(self, agreement, when):
+        # Tipo de entrada da regra de transferência do acordo, uma busca por acordo
+        if agreement.id not in self._rules:
+            rule = agreement.get_posting_rule(EventType.objects.get(name='TRANSFER'), when)
+            self._rules[agreement.id] = rule.entry_type if rule else None
+        return self._rules[agreement.id]
+
+    def plan(self, orders, balances, when):
+        # Retorna ([(ordem, débito, crédito, entry_type)], {order_id: erro}) sem gravar nada
+        accepted, failed = [], {}
+        available = dict(balances)
+        for order in orders:
+            entry_type = self.entry_type(order.customer.service_agreement, when)
+            if order.from_account.memory_ledger or order.to_account.memory_ledger:
+                # O lote grava direto nas tabelas; contas do razão em memória só recebem postagens pelo motor
+                failed[order.id] = 'Account is owned by the memory ledger'
+                continue
+            if entry_type is None:
+                failed[order.id] = 'No transfer posting rule for this customer'
+                continue
+            try:
+                debit = conversion_service().convert(order.amount, order.currency.code, order.from_account.currency.code, when)
+                credit = conversion_service().convert(order.amount, order.currency.code, order.to_account.currency.code, when)
+            except ValueError as e:
+                failed[order.id] = str(e)
+                continue
+            if not self.allow_overdraft and available[order.from_account_id] < debit:
+                failed[order.id] = f'Insufficient funds: {available[order.from_account_id]} available, {debit} required'
+                continue
+            available[order.from_account_id] -= debit
+            available[order.to_account_id] = available.get(order.to_account_id, Decimal('0.00')) + credit
+            accepted.append((order, debit, credit, entry_type))
+        return accepted, failed
+
+    def post(self, accepted, when, valid_date):
+        # Duas pernas por ordem; devolve {order_id: (entrada de débito, entrada de crédito)}
+        legs = []
+        for order, debit, credit, entry_type in accepted:
+            legs.append((order, order.from_account, -debit, entry_type))
+            legs.append((order, order.to_account, credit, entry_type))
+        monies = Money.objects.bulk_create([Money(amount=amount, currency_id=account.currency_id) for _, account, amount, _ in legs])
+        entries = Entry.objects.bulk_create([
+            Entry(account=account, entry_type=entry_type, amount=money, date=when, valid_date=valid_date)
+            for (_, account, _, entry_type), money in zip(legs, monies)
+        ])
+        # Mesmo tópico e formato das demais postagens (sem evento); standing_order_id identifica a origem
+        OutboxMessage.objects.bulk_create([
+            OutboxMessage(topic=OutboxMessage.ENTRY_POSTED, entry_id=entry.id, payload={
+                'entry_id': entry.id,
+                'event_id': None,
+                'customer_id': order.customer_id,
+                'standing_order_id': order.id,
+                'account_id': account.id,
+                'entry_type': entry_type.name,
+                'amount': str(amount),
+                'currency': account.currency.code,
+                'date': when.isoformat(),
+            })
+            for entry, (order, account, amount, entry_type) in zip(entries, legs)
+        ])
+        deltas = {}
+        for _, account, amount, _ in legs:
+            deltas[account.id] = deltas.get(account.id, Decimal('0.00')) + amount
+        AccountBalanceShard.apply_many(deltas)
+        return {order.id: (entries[2 * i], entries[2 * i + 1]) for i, (order, _, _, _) in enumerate(accepted)}
+
+    def advance(self, orders):
+        # Próxima data (e fim da ordem) de todas as ordens executadas num único UPDATE
+        if not orders:
+            return
+        next_dates = {order.id: order.following_date(order.next_run_date) for order in orders}
+        StandingOrder.objects.filter(id__in=list(next_dates)).update(
+            next_run_date=Case(*[When(id=i, then=Value(d)) for i, d in next_dates.items()], output_field=DateField()),
+            is_active=Case(
+                *[When(id=order.id, then=Value(False)) for order in orders if order.end_date and next_dates[order.id] > order.end_date],
+                default=Value(True), output_field=BooleanField(),
+            ),
+            last_run_date=self.run_date,
+        )
+
+    def run_batch(self, account_ids):
+        when = timezone.now()
+        valid_date = timezone.make_aware(datetime.datetime.combine(self.run_date, datetime.time.min))
+        with shard_atomic():
+            # Relê as ordens dentro da transação: outra execução pode já ter avançado alguma
+            orders = list(
+                StandingOrder.objects.select_for_update()
+                .filter(is_active=True, next_run_date__lte=self.run_date, from_account__in=account_ids)
+                .select_related('customer__service_agreement', 'currency', 'from_account__currency', 'to_account__currency')
+                .order_by('from_account', 'id')
+            )
+            accepted, failed = self.plan(orders, self.balances(account_ids), when)
+            entries = self.post(accepted, when, valid_date)
+            StandingOrderExecution.objects.bulk_create([
+                StandingOrderExecution(
+                    order=order,
+                    run_date=self.run_date,
+                    due_date=order.next_run_date,
+                    status=StandingOrderExecution.FAILED if order.id in failed else StandingOrderExecution.OK,
+                    error=failed.get(order.id, ''),
+                    debit_entry=entries.get(order.id, (None, None))[0],
+                    credit_entry=entries.get(order.id, (None, None))[1],
+                )
+                for order in orders
+            ])
+            self.advance([order for order, _, _, _ in accepted])
+        return {order.id: failed.get(order.id, StandingOrderExecution.OK) for order in orders}
+
+    def run(self):
+        """Executa todas as ordens devidas; devolve {order_id: 'OK' ou motivo da falha}."""
+        account_ids = self.due_account_ids()
+        report = {}
+        for start in range(0, len(account_ids), self.batch_size):
+            report.update(self.run_batch(account_ids[start:start + self.batch_size]))
+        return report
@@ -1,12 +1,35 @@
 # transactions/tests.py
-from django.test import TestCase
+import datetime
+import random
+
+from django.db import transaction as db_transaction
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.utils import timezone
 from decimal import Decimal
 from accounts.models import Account, Currency, Customer, ServiceAgreement, AccountType
 from .models import Transaction, DepositEvent, WithdrawalEvent, TransferEvent, TransactionType, TransactionStatus, DepositPR, WithdrawalPR, TransferPR
-from accounts.models import EventType, EntryType, Money
+from accounts.models import EventType, EntryType, Money, ExchangeRate
+from .logs import TransactionLogWriter, read_logs
+from accounts.archive import archive_entries
+from accounts.reconcile import account_digests, diff_trees, reconcile
+from accounts.conversion import get_conversion_service
+from accounts.jobs import EventQueue
+from accounts.replay import ReplayEngine
+from accounts.models import AccountDayDigest, Entry, OutboxMessage
+from accounts.sharding import shard_for_customer, use_shard
+from bancoTest.bench import seed_bank
+from unittest import mock
+from .models import CrossShardLeg, CrossShardTransfer, StandingOrder, StandingOrderExecution, TransactionLog
+from .standing_orders import StandingOrderExecutor
+from .transfers import recover_transfers, transfer
+from .velocity import SlidingWindow, VelocityChecker, VelocityLimitExceeded, get_checker, reset_checker
+from .management.commands.loadtest import compare, summarize
+
+class TransactionFixture:
+    """Tipos, status, regras, clientes e contas das transações e um atalho para postar uma transação."""
 
-class TransactionTestCase(TestCase):
     def setUp(self):
         # Criar moedas
         self.currency = Currency.objects.create(code='USD', name='US Dollar')
@@ -76,6 +99,21 @@ class TransactionTestCase(TestCase):
         self.customer.save()
         self.customer1.save()
 
+    def submit(self, transaction_type, value, to_account=None):
+        transaction = Transaction.objects.create(
+            customer=self.customer,
+            from_account=self.account1,
+            to_account=to_account,
+            amount=Money.objects.create(amount=Decimal(value), currency=self.currency),
+            transaction_type=transaction_type,
+            transaction_status=self.completed_status
+        )
+        event = transaction.create_accounting_event()
+        event.process()
+        return event
+
+
+class TransactionTestCase(TransactionFixture, TestCase):
     def test_deposit_transaction(self):
         print("\nDeposit transaction\n")
         transaction = Transaction.objects.create(
@@ -205,3 +243,640 @@ class TransactionTestCase(TestCase):
 
         self.account1.refresh_from_db()
         self.assertEqual(self.account1.balance(), Decimal('150.00'))
+
+    def test_cross_currency_transfer(self):
+        brl = Currency.objects.create(code='BRL', name='Real Brasileiro')
+        ExchangeRate.objects.create(from_currency=self.currency, to_currency=brl, rate=Decimal('5.00'), effective_date=timezone.now() - timezone.timedelta(days=1))
+        brl_account = Account.objects.create(name='John BRL', account_type=self.savings_type, currency=brl)
+        self.customer.accounts.add(brl_account)
+
+        deposit = Transaction.objects.create(
+            customer=self.customer,
+            from_account=self.account1,
+            amount=Money.objects.create(amount=Decimal('100.00'), currency=self.currency),
+            transaction_type=self.deposit_trasaction_type,
+            transaction_status=self.completed_status
+        )
+        deposit.create_accounting_event().process()
+
+        transfer = Transaction.objects.create(
+            customer=self.customer,
+            from_account=self.account1,
+            to_account=brl_account,
+            amount=Money.objects.create(amount=Decimal('10.00'), currency=self.currency),
+            transaction_type=self.transfer_trasaction_type,
+            transaction_status=self.completed_status
+        )
+        transfer.create_accounting_event().process()
+
+        self.assertEqual(self.account1.balance(), Decimal('90.00'))
+        self.assertEqual(brl_account.balance(), Decimal('50.00'))
+
+    def test_idempotent_submit(self):
+        fields = dict(
+            customer=self.customer,
+            from_account=self.account1,
+            amount=Money.objects.create(amount=Decimal('100.00'), currency=self.currency),
+            transaction_type=self.deposit_trasaction_type,
+            transaction_status=self.completed_status
+        )
+        transaction, created = Transaction.submit(idempotency_key='abc', **fields)
+        self.assertTrue(created)
+        with self.assertNumQueries(1):
+            retry, created = Transaction.submit(idempotency_key='abc', **fields)
+        self.assertFalse(created)
+        self.assertEqual(retry.id, transaction.id)
+
+        event = transaction.create_accounting_event()
+        event.process()
+        self.assertEqual(retry.create_accounting_event().id, event.id)
+        with self.assertRaises(ValueError):
+            DepositEvent.objects.get(id=event.id).process()
+        self.assertEqual(self.account1.balance(), Decimal('100.00'))
+
+    def test_idempotent_submit_many(self):
+        Transaction.submit(idempotency_key='k1', customer=self.customer, from_account=self.account1,
+                           amount=Money.objects.create(amount=Decimal('1.00'), currency=self.currency),
+                           transaction_type=self.deposit_trasaction_type, transaction_status=self.completed_status)
+        amount = Money.objects.create(amount=Decimal('2.00'), currency=self.currency)
+        fields = dict(customer=self.customer, from_account=self.account1, amount=amount,
+                      transaction_type=self.deposit_trasaction_type, transaction_status=self.completed_status)
+        results = Transaction.submit_many([dict(fields, idempotency_key=k) for k in ['k1', 'k2', 'k2', 'k3']])
+        self.assertEqual([created for _, created in results], [False, True, False, True])
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_submit_many_falls_back_on_concurrent_insert(self):
+        fields = dict(customer=self.customer, from_account=self.account1,
+                      amount=Money.objects.create(amount=Decimal('2.00'), currency=self.currency),
+                      transaction_type=self.deposit_trasaction_type, transaction_status=self.completed_status)
+        real_filter = Transaction.objects.filter
+        calls = []
+
+        def stale_lookup(*args, **kwargs):
+            # A consulta das chaves não vê 'k2', gravada por outro envio logo depois
+            if calls:
+                return real_filter(*args, **kwargs)
+            calls.append(1)
+            seen = list(real_filter(*args, **kwargs))
+            Transaction.objects.create(idempotency_key='k2', **fields)
+            return seen
+
+        with mock.patch.object(Transaction.objects, 'filter', side_effect=stale_lookup):
+            results = Transaction.submit_many([dict(fields, idempotency_key=k) for k in ['k1', 'k2']])
+        self.assertEqual([created for _, created in results], [True, False])
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_submit_endpoint_replay(self):
+        payload = {'customer': self.customer.id, 'from_account': self.account1.id, 'amount': '30.00', 'transaction_type': 'DEPOSIT'}
+        response = self.client.post('/transactions/', payload, content_type='application/json', HTTP_IDEMPOTENCY_KEY='req-1')
+        self.assertEqual(response.status_code, 201)
+        monies = Money.objects.count()
+        retry = self.client.post('/transactions/', payload, content_type='application/json', HTTP_IDEMPOTENCY_KEY='req-1')
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.json()['id'], response.json()['id'])
+        self.assertEqual(Money.objects.count(), monies)
+        self.assertEqual(self.account1.balance(), Decimal('30.00'))
+
+    def test_submit_rejects_other_customers_account(self):
+        payload = {'customer': self.customer.id, 'from_account': self.account3.id, 'amount': '30.00', 'transaction_type': 'WITHDRAWAL'}
+        response = self.client.post('/transactions/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_deferred_submission_is_finished_by_worker(self):
+        payload = {'customer': self.customer.id, 'from_account': self.account1.id, 'amount': '30.00', 'transaction_type': 'DEPOSIT', 'defer': True}
+        deposit = self.client.post('/transactions/', payload, content_type='application/json')
+        payload['transaction_type'] = 'WITHDRAWAL'
+        withdrawal = self.client.post('/transactions/', payload, content_type='application/json')
+        self.assertEqual((deposit.status_code, withdrawal.status_code), (202, 202))
+        # Sem regra de saque o job vai direto para DEAD (max_attempts=1)
+        self.saquePR.delete()
+        self.assertEqual(EventQueue(max_attempts=1).work(), (1, 1))
+        statuses = dict(Transaction.objects.values_list('id', 'transaction_status__name'))
+        self.assertEqual(statuses, {deposit.json()['id']: 'COMPLETED', withdrawal.json()['id']: 'CANCELLED'})
+        self.assertFalse(Transaction.pending().exists())
+
+    def test_submit_endpoint_cancels_on_unexpected_error(self):
+        payload = {'customer': self.customer.id, 'from_account': self.account1.id, 'amount': '30.00', 'transaction_type': 'DEPOSIT'}
+        with mock.patch('accounts.models.AccountingEvent.process', side_effect=RuntimeError('database gone')):
+            response = self.client.post('/transactions/', payload, content_type='application/json', HTTP_IDEMPOTENCY_KEY='req-2')
+        self.assertEqual((response.status_code, response.json()['status']), (500, 'CANCELLED'))
+        retry = self.client.post('/transactions/', payload, content_type='application/json', HTTP_IDEMPOTENCY_KEY='req-2')
+        self.assertEqual((retry.status_code, retry.json()['status']), (200, 'CANCELLED'))
+        self.assertEqual(self.account1.balance(), Decimal('0.00'))
+
+    def test_log_writer_batches_and_respects_rollback(self):
+        transaction = Transaction.objects.create(
+            customer=self.customer,
+            from_account=self.account1,
+            amount=Money.objects.create(amount=Decimal('1.00'), currency=self.currency),
+            transaction_type=self.deposit_trasaction_type,
+            transaction_status=self.completed_status
+        )
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True):
+            with TransactionLogWriter() as logs:
+                for i in range(10):
+                    logs.log(transaction, f'message {i}')
+        self.assertEqual(transaction.logs.count(), 10)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with db_transaction.atomic():
+                    with TransactionLogWriter() as logs:
+                        logs.log(transaction, 'orphan')
+                    raise ValueError('posting failed')
+            except ValueError:
+                pass
+        self.assertFalse(transaction.logs.filter(message='orphan').exists())
+
+        writer = TransactionLogWriter(max_buffer=3)
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(4):
+                writer.log(transaction, f'sized {i}')
+        self.assertEqual(len(writer), 1)
+        self.assertEqual(transaction.logs.filter(message__startswith='sized').count(), 3)
+
+    def test_read_logs_pages(self):
+        transaction = Transaction.objects.create(
+            customer=self.customer,
+            from_account=self.account1,
+            amount=Money.objects.create(amount=Decimal('1.00'), currency=self.currency),
+            transaction_type=self.deposit_trasaction_type,
+            transaction_status=self.completed_status
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            with TransactionLogWriter() as logs:
+                for i in range(5):
+                    logs.log(transaction, f'message {i}')
+        page, cursor = read_logs(transaction, limit=2)
+        messages = [log.message for log in page]
+        while cursor:
+            page, cursor = read_logs(transaction, after=cursor, limit=2)
+            messages += [log.message for log in page]
+        self.assertEqual(messages, [f'message {i}' for i in range(5)])
+
+    def test_reconcile_checks(self):
+        deposit = Transaction.objects.create(
+            customer=self.customer,
+            from_account=self.account1,
+            amount=Money.objects.create(amount=Decimal('100.00'), currency=self.currency),
+            transaction_type=self.deposit_trasaction_type,
+            transaction_status=self.completed_status
+        )
+        deposit.create_accounting_event().process()
+        transfer = Transaction.objects.create(
+            customer=self.customer,
+            from_account=self.account1,
+            to_account=self.account2,
+            amount=Money.objects.create(amount=Decimal('40.00'), currency=self.currency),
+            transaction_type=self.transfer_trasaction_type,
+            transaction_status=self.completed_status
+        )
+        event = transfer.create_accounting_event()
+        event.process()
+        self.assertEqual(reconcile(), {'processed_events_without_entries': [], 'unbalanced_transfers': [], 'archive_mismatches': [], 'divergent_accounts': {}})
+
+        event.resulting_entries.remove(event.resulting_entries.filter(account=self.account2).get())
+        self.assertEqual(reconcile()['unbalanced_transfers'], [event.id])
+
+    def test_reconcile_archived_ledger(self):
+        brl = Currency.objects.create(code='BRL', name='Real Brasileiro')
+        ExchangeRate.objects.create(from_currency=brl, to_currency=self.currency, rate=Decimal('0.20'), effective_date=timezone.now() - timezone.timedelta(days=1))
+        self.submit(self.deposit_trasaction_type, '100.00')
+        self.account1.add_entry(Entry(entry_type=self.deposit_entry_type, amount=Money.objects.create(amount=Decimal('10.00'), currency=brl), date=timezone.now()))
+        archive_entries(timezone.now() + timezone.timedelta(seconds=1))
+        self.assertEqual(self.account1.balance(), Decimal('102.00'))
+        self.assertEqual(reconcile(), {'processed_events_without_entries': [], 'unbalanced_transfers': [], 'archive_mismatches': [], 'divergent_accounts': {}})
+
+    def test_stored_digests_follow_postings(self):
+        self.submit(self.deposit_trasaction_type, '100.00')
+        self.submit(self.transfer_trasaction_type, '40.00', to_account=self.account2).reverse()
+        self.submit(self.withdrawal_trasaction_type, '10.00')
+        archive_entries(timezone.now() + timezone.timedelta(seconds=1))
+        ids = [self.account1.id, self.account2.id]
+        with self.assertNumQueries(1):
+            stored = account_digests(ids)
+        AccountDayDigest.rebuild()
+        self.assertEqual(account_digests(ids), stored)
+
+    def test_digest_diff_walks_mismatched_days(self):
+        deposit = Transaction.objects.create(
+            customer=self.customer,
+            from_account=self.account1,
+            amount=Money.objects.create(amount=Decimal('100.00'), currency=self.currency),
+            transaction_type=self.deposit_trasaction_type,
+            transaction_status=self.completed_status
+        )
+        deposit.create_accounting_event().process()
+        ids = [self.account1.id, self.account2.id]
+        primary = account_digests(ids)
+        self.assertEqual(diff_trees(primary, account_digests(ids)), {})
+        self.assertEqual(reconcile(replica='default')['divergent_accounts'], {})
+
+        entry = self.account1.entries.get()
+        entry.amount = Money.objects.create(amount=Decimal('999.00'), currency=self.currency)
+        entry.save()
+        self.assertEqual(diff_trees(primary, account_digests(ids)), {self.account1.id: [entry.date.date().isoformat()]})
+
+    def test_replay_rebuilds_entries(self):
+        start = timezone.now()
+        self.submit(self.deposit_trasaction_type, '100.00')
+        withdrawal = self.submit(self.withdrawal_trasaction_type, '30.00')
+        self.submit(self.transfer_trasaction_type, '20.00', to_account=self.account2)
+        reversed_deposit = self.submit(self.deposit_trasaction_type, '5.00')
+        reversed_deposit.reverse()
+
+        # Simula uma postagem errada que precisa ser reconstruída
+        entry = withdrawal.resulting_entries.get()
+        entry.amount = Money.objects.create(amount=Decimal('-3.00'), currency=self.currency)
+        entry.save()
+        self.assertEqual(self.account1.balance(), Decimal('77.00'))
+
+        engine = ReplayEngine(start, timezone.now() + timezone.timedelta(seconds=1), customer_ids=[self.customer.id])
+        rebuild = engine.run(swap=False)
+        self.assertEqual(rebuild.report['replayed'], 3)
+        self.assertEqual(rebuild.report['skipped'], [reversed_deposit.id])
+        self.assertEqual(rebuild.report['accounts'], {str(self.account1.id): {'before': '77.00', 'after': '50.00', 'delta': '-27.00'}})
+        self.assertEqual(self.account1.balance(), Decimal('77.00'))
+
+        engine.swap(rebuild)
+        self.assertEqual(self.account1.balance(), Decimal('50.00'))
+        self.assertEqual(self.account1.bitemporal_balance(), Decimal('50.00'))
+        self.assertEqual(self.account2.balance(), Decimal('20.00'))
+        # A entrada errada continua no histórico, estornada, ao lado da nova
+        self.assertEqual(
+            sorted(withdrawal.resulting_entries.values_list('amount__amount', flat=True)),
+            [Decimal('-30.00'), Decimal('-3.00'), Decimal('3.00')],
+        )
+        self.assertEqual(reconcile()['unbalanced_transfers'], [])
+
+
+@override_settings(LEDGER_SHARDS=['default', 'shard1'])
+class ShardingTestCase(TestCase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self):
+        (self.customer1, self.account1), (self.customer2, self.account2), (self.customer3, self.account3) = seed_bank(customers=3)
+
+    def deposit(self, account, value):
+        with use_shard(account._state.db):
+            customer = account.customer_set.get()
+            event = DepositEvent.objects.create(
+                event_type=EventType.objects.get(name='DEPOSIT'),
+                when_occurred=timezone.now(),
+                when_noticed=timezone.now(),
+                customer=customer,
+                account=account,
+                amount=Money.objects.create(amount=Decimal(value), currency=account.currency),
+            )
+        event.process()
+        return event
+
+    def test_customers_spread_over_shards(self):
+        self.assertEqual(self.customer1._state.db, 'shard1')
+        self.assertEqual(self.customer2._state.db, 'default')
+        self.assertEqual(shard_for_customer(self.customer3.id), 'shard1')
+        self.assertEqual(self.account1._state.db, 'shard1')
+        # Dados de referência replicados com os mesmos ids
+        self.assertEqual(
+            list(TransferPR.objects.using('shard1').values_list('id', 'entry_type_id')),
+            list(TransferPR.objects.values_list('id', 'entry_type_id')),
+        )
+        self.assertFalse(Customer.objects.using('shard1').filter(id=self.customer2.id).exists())
+
+    def test_posting_and_balance_route_to_customer_shard(self):
+        with self.assertNumQueries(0, using='default'):
+            self.deposit(self.account1, '100.00')
+        self.assertEqual(self.account1.balance(), Decimal('100.00'))
+        self.assertEqual(Entry.objects.using('shard1').count(), 1)
+        self.assertEqual(Entry.objects.using('default').count(), 0)
+        positions = Customer.positions_for([self.customer1, self.customer2])
+        self.assertEqual(positions[self.customer1.id]['accounts'][0]['balance'], Decimal('100.00'))
+        self.assertEqual(positions[self.customer2.id]['accounts'][0]['balance'], Decimal('0.00'))
+
+    def test_transfers(self):
+        self.deposit(self.account1, '100.00')
+        record = transfer(self.account1, self.account2, Decimal('30.00'))
+        self.assertEqual(record.status, CrossShardTransfer.DONE)
+        event = transfer(self.account1, self.account3, Decimal('20.00'))
+        self.assertIsInstance(event, TransferEvent)
+        self.assertEqual(self.account1.balance(), Decimal('50.00'))
+        self.assertEqual(self.account2.balance(), Decimal('30.00'))
+        self.assertEqual(self.account3.balance(), Decimal('20.00'))
+
+    def test_failed_transfer_rolls_back_both_shards(self):
+        self.deposit(self.account1, '100.00')
+        with mock.patch.object(OutboxMessage, 'record_entry', side_effect=[None, RuntimeError('boom')]):
+            with self.assertRaises(RuntimeError):
+                transfer(self.account1, self.account2, Decimal('30.00'))
+        self.assertEqual(CrossShardTransfer.objects.get().status, CrossShardTransfer.ABORTED)
+        self.assertEqual(Entry.objects.using('shard1').count() + Entry.objects.using('default').count(), 1)
+
+    def test_transfer_checks_funds(self):
+        self.deposit(self.account1, '25.00')
+        for target in (self.account2, self.account3):
+            with self.assertRaisesMessage(ValueError, 'Insufficient funds'):
+                transfer(self.account1, target, Decimal('30.00'))
+        self.assertEqual(CrossShardTransfer.objects.get().status, CrossShardTransfer.ABORTED)
+        self.assertEqual(self.account1.balance(), Decimal('25.00'))
+        self.assertEqual(self.account2.balance(), Decimal('0.00'))
+
+    def test_views_route_to_customer_shard(self):
+        self.deposit(self.account1, '100.00')
+        # Sem o cliente o shard da conta não pode ser escolhido
+        self.assertEqual(self.client.get(f'/accounts/{self.account1.id}/balance/').status_code, 400)
+        response = self.client.get(f'/accounts/{self.account1.id}/balance/', {'customer': self.customer1.id})
+        self.assertEqual(response.json()['balance'], '100.00')
+        response = self.client.get(f'/accounts/{self.account1.id}/statement/', {'customer': self.customer1.id})
+        self.assertEqual(len(response.json()['entries']), 1)
+        self.assertEqual(self.client.get(f'/accounts/customers/{self.customer1.id}/positions/').status_code, 200)
+        self.assertEqual(self.client.get('/accounts/customers/999/positions/').status_code, 404)
+
+        with self.captureOnCommitCallbacks(using='shard1', execute=True):
+            response = self.client.post('/transactions/', {
+                'customer': self.customer1.id, 'from_account': self.account1.id,
+                'transaction_type': 'WITHDRAWAL', 'amount': '40.00',
+            }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.account1.balance(), Decimal('60.00'))
+        self.assertEqual(Transaction.objects.using('shard1').count(), 1)
+        self.assertEqual(TransactionLog.objects.using('shard1').count(), 2)
+
+    def test_recover_committed_transfer(self):
+        record = CrossShardTransfer.objects.create(
+            status=CrossShardTransfer.COMMITTED,
+            source_shard='shard1', source_account_id=self.account1.id,
+            target_shard='default', target_account_id=self.account2.id,
+            entry_type_id=TransferPR.objects.get().entry_type_id,
+            amount=Decimal('10.00'), currency='USD', when=timezone.now(),
+        )
+        self.assertEqual(recover_transfers(), {CrossShardTransfer.DONE: 1, CrossShardTransfer.ABORTED: 0})
+        self.assertEqual(recover_transfers(), {CrossShardTransfer.DONE: 0, CrossShardTransfer.ABORTED: 0})
+        self.assertEqual(self.account1.balance(), Decimal('-10.00'))
+        self.assertEqual(self.account2.balance(), Decimal('10.00'))
+        self.assertEqual(CrossShardLeg.objects.using('shard1').get().transfer_id, record.id)
+
+
+class LoadTestReportTestCase(SimpleTestCase):
+    def test_summarize_and_compare(self):
+        results = [('deposit', i / 1000, 201, 30) for i in range(1, 101)] + [('balance', 0.005, 404, None)]
+        report = summarize(results, elapsed=2.0)
+        deposit = report['endpoints']['deposit']
+        self.assertEqual((deposit['p50_ms'], deposit['p95_ms'], deposit['p99_ms']), (51.0, 95.0, 99.0))
+        self.assertEqual(deposit['throughput'], 50.0)
+        self.assertEqual(deposit['queries_avg'], 30.0)
+        self.assertEqual(report['endpoints']['balance']['error_rate'], 1.0)
+        self.assertEqual(report['endpoints']['all']['requests'], 101)
+
+        slower = summarize([(k, t * 2, s, q) for k, t, s, q in results], elapsed=2.0)
+        self.assertEqual(compare(slower, report)['deposit']['p95_ms'], 1.0)
+
+    def test_url_requires_explicit_seed_choice(self):
+        with self.assertRaisesMessage(CommandError, '--url requires --seed or --no-seed'):
+            call_command('loadtest', url='http://127.0.0.1:1')
+
+
+class StandingOrderTestCase(TransactionFixture, TestCase):
+    def order(self, from_account, to_account, value, frequency=StandingOrder.MONTHLY, **fields):
+        return StandingOrder.objects.create(
+            customer=self.customer, from_account=from_account, to_account=to_account, amount=Decimal(value),
+            currency=self.currency, frequency=frequency, start_date=timezone.localdate(), **fields
+        )
+
+    def test_batch_execution(self):
+        self.submit(self.deposit_trasaction_type, '100.00')
+        today = timezone.localdate()
+        first = self.order(self.account1, self.account2, '60.00')
+        short = self.order(self.account1, self.account3, '50.00')
+        weekly = self.order(self.account2, self.account1, '10.00', StandingOrder.WEEKLY)
+        last = self.order(self.account2, self.account3, '5.00', StandingOrder.DAILY, end_date=today)
+
+        report = StandingOrderExecutor(today).run()
+        self.assertEqual(report[first.id], 'OK')
+        self.assertTrue(report[short.id].startswith('Insufficient funds'))
+        self.assertEqual((report[weekly.id], report[last.id]), ('OK', 'OK'))
+        self.assertEqual(self.account1.balance(), Decimal('50.00'))
+        self.assertEqual(self.account2.balance(), Decimal('45.00'))
+        self.assertEqual(self.account3.balance(), Decimal('5.00'))
+
+        first.refresh_from_db(); short.refresh_from_db(); weekly.refresh_from_db(); last.refresh_from_db()
+        self.assertEqual(first.next_run_date, first.following_date(today))
+        self.assertEqual(short.next_run_date, today)
+        self.assertEqual(weekly.next_run_date, today + timezone.timedelta(days=7))
+        self.assertFalse(last.is_active)
+        self.assertEqual(StandingOrderExecution.objects.filter(status=StandingOrderExecution.FAILED).get().order, short)
+
+        # Só a ordem que falhou continua devida
+        self.assertEqual(list(StandingOrderExecutor(today).run()), [short.id])
+
+    def test_archive_account_with_executions(self):
+        self.submit(self.deposit_trasaction_type, '100.00')
+        order = self.order(self.account1, self.account2, '60.00')
+        StandingOrderExecutor(timezone.localdate()).run()
+        execution = StandingOrderExecution.objects.get(order=order)
+        self.assertIsNotNone(execution.debit_entry_id)
+
+        results = archive_entries(timezone.now() + timezone.timedelta(seconds=1))
+        self.assertEqual(results[self.account1.id], 2)
+        execution.refresh_from_db()
+        self.assertEqual((execution.debit_entry_id, execution.credit_entry_id), (None, None))
+        self.assertEqual(self.account1.balance(), Decimal('40.00'))
+
+    def test_balances_convert_at_entry_date(self):
+        eur = Currency.objects.create(code='EUR', name='Euro')
+        now = timezone.now()
+        ExchangeRate.objects.create(from_currency=eur, to_currency=self.currency, rate=Decimal('5.00'), effective_date=now - timezone.timedelta(days=10))
+        ExchangeRate.objects.create(from_currency=eur, to_currency=self.currency, rate=Decimal('6.00'), effective_date=now - timezone.timedelta(days=1))
+        entry_type = EntryType.objects.first()
+        for days, value in ((5, '10.00'), (0, '1.00')):
+            date = now - timezone.timedelta(days=days)
+            Entry.objects.create(
+                account=self.account1, entry_type=entry_type, date=date, valid_date=date,
+                amount=Money.objects.create(amount=Decimal(value), currency=eur),
+            )
+        self.assertEqual(StandingOrderExecutor(timezone.localdate()).balances([self.account1.id]), {self.account1.id: Decimal('56.00')})
+        self.assertEqual(self.account1.balance(), Decimal('56.00'))
+
+    def test_postings_use_entry_posted_topic(self):
+        self.submit(self.deposit_trasaction_type, '100.00')
+        order = self.order(self.account1, self.account2, '60.00')
+        StandingOrderExecutor(timezone.localdate()).run()
+        topics = OutboxMessage.objects.filter(payload__standing_order_id=order.id).values_list('topic', flat=True)
+        self.assertEqual(list(topics), [OutboxMessage.ENTRY_POSTED] * 2)
+
+    def test_monthly_keeps_day_of_month(self):
+        order = StandingOrder(frequency=StandingOrder.MONTHLY, start_date=datetime.date(2026, 1, 31))
+        self.assertEqual(order.following_date(datetime.date(2026, 1, 31)), datetime.date(2026, 2, 28))
+        self.assertEqual(order.following_date(datetime.date(2026, 2, 28)), datetime.date(2026, 3, 31))
+        self.assertEqual(order.following_date(datetime.date(2026, 12, 31)), datetime.date(2027, 1, 31))
+
+
+class SlidingWindowTestCase(SimpleTestCase):
+    def test_ring_expires_old_buckets(self):
+        window = SlidingWindow(4)
+        window.add(10, 100)
+        window.add(11, 50)
+        window.add(11, 25)
+        self.assertEqual((window.count, window.amount), (3, 175))
+        window.add(8, 1000)  # Fora da janela relativa ao balde mais novo: ignorado
+        window.advance(14)
+        self.assertEqual((window.count, window.amount), (2, 75))
+        window.advance(100)
+        self.assertEqual((window.count, window.amount), (0, 0))
+
+
+class VelocityTestCase(TransactionFixture, TestCase):
+    limits = [
+        {'name': 'account-count', 'scope': 'account', 'types': ['WITHDRAWAL'], 'window': 60, 'max_count': 2},
+        {'name': 'customer-amount', 'scope': 'customer', 'window': 3600, 'max_amount': '500.00'},
+    ]
+
+    def setUp(self):
+        super().setUp()
+        reset_checker()
+        self.addCleanup(reset_checker)
+
+    def post(self, transaction_type, amount):
+        return self.client.post('/transactions/', {
+            'customer': self.customer.id, 'from_account': self.account1.id,
+            'transaction_type': transaction_type, 'amount': amount,
+        }, content_type='application/json')
+
+    def test_limits_checked_in_memory(self):
+        checker = VelocityChecker(self.limits)
+        now = timezone.now()
+        checker.admit('WITHDRAWAL', 1, 10, Decimal('10.00'), 'USD', now)
+        checker.admit('WITHDRAWAL', 1, 10, Decimal('10.00'), 'USD', now)
+        checker.admit('WITHDRAWAL', 1, 11, Decimal('10.00'), 'USD', now)
+        with self.assertRaises(VelocityLimitExceeded) as raised:
+            checker.admit('WITHDRAWAL', 1, 10, Decimal('10.00'), 'USD', now)
+        self.assertEqual(raised.exception.limit.name, 'account-count')
+        # Depois da janela de 60s a conta volta a poder sacar
+        checker.admit('WITHDRAWAL', 1, 10, Decimal('10.00'), 'USD', now + datetime.timedelta(seconds=70))
+        with self.assertRaises(VelocityLimitExceeded):
+            checker.admit('DEPOSIT', 1, 12, Decimal('461.00'), 'USD', now + datetime.timedelta(seconds=70))
+
+        metrics = checker.metrics(now + datetime.timedelta(seconds=70))
+        self.assertEqual(metrics['rejections'], {'account-count': 1, 'customer-amount': 1})
+        self.assertEqual(metrics['near_limit'], [])
+        self.assertEqual(metrics['tracked_keys']['account-count'], 1)
+
+    def test_submission_rejected_and_rebuilt_from_history(self):
+        with override_settings(VELOCITY_LIMITS=self.limits):
+            self.assertEqual(self.post('DEPOSIT', '450.00').status_code, 201)
+            self.assertEqual(self.post('WITHDRAWAL', '10.00').status_code, 201)
+            response = self.post('WITHDRAWAL', '50.00')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.json()['status'], 'CANCELLED')
+            self.assertEqual(self.account1.balance(), Decimal('440.00'))
+
+            # Um processo novo reconstrói as janelas a partir das transações não canceladas
+            reset_checker()
+            checker = get_checker()
+            window = checker.limits[1].windows[self.customer.id]
+            self.assertEqual((window.count, window.amount), (2, 46000))
+            metrics = self.client.get('/transactions/velocity/').json()
+            self.assertEqual(metrics['near_limit'][0]['limit'], 'customer-amount')
+            self.assertEqual(metrics['near_limit'][0]['usage'], 0.92)
+
+    def test_cancelled_submission_not_counted(self):
+        with override_settings(VELOCITY_LIMITS=self.limits):
+            with mock.patch('accounts.models.AccountingEvent.process', side_effect=ValueError('Insufficient funds')):
+                self.assertEqual(self.post('WITHDRAWAL', '400.00').status_code, 422)
+            window = get_checker().limits[0].windows[self.account1.id]
+            self.assertEqual((window.count, window.amount), (0, 0))
+            self.assertEqual(self.post('WITHDRAWAL', '10.00').status_code, 201)
+            self.assertEqual(self.post('WITHDRAWAL', '10.00').status_code, 201)
+            self.assertEqual(self.post('WITHDRAWAL', '10.00').status_code, 429)
+
+    def test_limits_split_between_processes(self):
+        checker = VelocityChecker(self.limits, processes=2)
+        self.assertEqual((checker.limits[0].max_count, checker.limits[1].max_cents), (1, 25000))
+        now = timezone.now()
+        checker.admit('WITHDRAWAL', 1, 10, Decimal('10.00'), 'USD', now)
+        with self.assertRaises(VelocityLimitExceeded):
+            checker.admit('WITHDRAWAL', 1, 10, Decimal('10.00'), 'USD', now)
+
+
+class TransactionStatusTestCase(TransactionFixture, TestCase):
+    def create(self, status, value='1.00'):
+        return Transaction.objects.create(
+            customer=self.customer, from_account=self.account1, transaction_type=self.deposit_trasaction_type,
+            amount=Money.objects.create(amount=Decimal(value), currency=self.currency), transaction_status=status,
+        )
+
+    def test_single_transition(self):
+        transaction = self.create(self.pending_status)
+        self.assertTrue(transaction.is_pending)
+        self.assertEqual(str(transaction), f"DEPOSIT - {transaction.amount} - PENDING")
+
+        stale = Transaction.objects.get(id=transaction.id)
+        transaction.transition(TransactionStatus.COMPLETED)
+        transaction.refresh_from_db()
+        self.assertEqual((transaction.transaction_status, transaction.is_pending), (self.completed_status, False))
+        # Transição a partir de um status final e corrida com quem leu PENDING
+        with self.assertRaises(ValueError):
+            transaction.transition(TransactionStatus.CANCELLED)
+        with self.assertRaisesMessage(ValueError, 'no longer PENDING'):
+            stale.transition(TransactionStatus.CANCELLED)
+
+    def test_bulk_transition_only_moves_pending(self):
+        pending = [self.create(self.pending_status) for _ in range(5)]
+        done = self.create(self.completed_status)
+        self.assertEqual(set(Transaction.pending().values_list('id', flat=True)), {t.id for t in pending})
+
+        with self.assertNumQueries(3):
+            moved = Transaction.transition_many([t.id for t in pending[:3]] + [done.id], TransactionStatus.PENDING,
+                                                TransactionStatus.CANCELLED, batch_size=2)
+        self.assertEqual(moved, 3)
+        self.assertEqual(Transaction.transition_many(Transaction.objects.all(), TransactionStatus.PENDING,
+                                                     TransactionStatus.COMPLETED), 2)
+        self.assertFalse(Transaction.pending().exists())
+        self.assertEqual(Transaction.objects.filter(transaction_status=self.cancelled_status).count(), 3)
+        with self.assertRaises(ValueError):
+            Transaction.transition_many([done.id], TransactionStatus.COMPLETED, TransactionStatus.PENDING)
+
+
+class CalculationPlanTestCase(TransactionFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        brl = Currency.objects.create(code='BRL', name='Real Brasileiro')
+        ExchangeRate.objects.create(from_currency=self.currency, to_currency=brl, rate=Decimal('5.37'), effective_date=timezone.now() - timezone.timedelta(days=1))
+        self.brl_account = Account.objects.create(name='Cleber BRL', account_type=self.savings_type, currency=brl)
+        self.customer1.accounts.add(self.brl_account)
+
+    def test_transfer_plan_matches_calculate_amount(self):
+        # Valores aleatórios (semente fixa): as pernas do plano são as entradas que calculate_amount cria
+        rng = random.Random(50)
+        plan = self.transferPR.plan
+        get_conversion_service()
+        for _ in range(25):
+            amount = Decimal(rng.randint(1, 10 ** 7)) / 100
+            to_account = rng.choice([self.account3, self.brl_account])
+            event = TransferEvent.objects.create(
+                event_type=self.transfer_event_type, when_occurred=timezone.now(), when_noticed=timezone.now(),
+                customer=self.customer, from_account=self.account1, to_account=to_account,
+                amount=Money.objects.create(amount=amount, currency=self.currency),
+            )
+            with self.assertNumQueries(0):
+                legs = plan.apply(amount, 'USD', event.when_occurred,
+                                  currencies={'from_account': 'USD', 'to_account': to_account.currency.code})
+            self.transferPR.calculate_amount(event)
+            entries = event.resulting_entries.order_by('id').select_related('amount__currency')
+            self.assertEqual(
+                [(value, code) for _, value, code in legs],
+                [(entry.amount.amount, entry.amount.currency.code) for entry in entries],
+            )
+
+    def test_deposit_and_withdrawal_plans(self):
+        rng = random.Random(50)
+        for _ in range(25):
+            amount = Decimal(rng.randint(0, 10 ** 7)) / 100
+            event = DepositEvent.objects.create(
+                event_type=self.deposit_event_type, when_occurred=timezone.now(), when_noticed=timezone.now(),
+                customer=self.customer, account=self.account1,
+                amount=Money.objects.create(amount=amount, currency=self.currency),
+            )
+            for rule in (self.depositoPR, self.saquePR):
+                expected = rule.calculate_amount(event)
+                self.assertEqual(rule.plan.apply(amount, 'USD'), [('account', expected.amount, 'USD')])
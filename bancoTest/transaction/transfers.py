@@ -0,0 +1,152 @@
+# Transferências entre clientes. No mesmo shard viram um TransferEvent processado pelo TransferPR;
+# entre shards usam um protocolo em duas fases coordenado pelo CrossShardTransfer no diretório:
+#
+#   1. preparação: o coordenador registra PREPARED e abre uma transação em cada shard, onde as
+#      pernas (entrada + CrossShardLeg) são escritas e mantidas sem confirmar;
+#   2. decisão: o coordenador marca COMMITTED e só então os dois shards confirmam.
+#
+# Se algo falha antes da decisão as duas transações são desfeitas (ABORTED). Se o processo cai
+# depois dela, recover_transfers reaplica a perna que faltar; CrossShardLeg torna isso idempotente.
+from contextlib import ExitStack
+
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import Account, Currency, Entry, EventType, Money, OutboxMessage, conversion_service
+from accounts.sharding import shard_atomic, use_shard
+from .models import CrossShardLeg, CrossShardTransfer, TransferEvent
+
+
+def _leg_value(record, account):
+    if account.currency.code == record.currency:
+        return record.amount
+    return conversion_service().convert(record.amount, record.currency, account.currency.code, record.when)
+
+
+def _check_funds(account_id, value, currency, when):
+    # Executa no shard ativo, dentro da transação que vai gravar o débito; a linha da conta
+    # fica travada até o fim dela (select_for_update) para dois débitos não verem o mesmo saldo
+    account = Account.objects.select_for_update().select_related('currency').get(id=account_id)
+    if account.currency.code != currency:
+        value = conversion_service().convert(value, currency, account.currency.code, when)
+    if value > account.balance():
+        raise ValueError('Insufficient funds')
+
+
+def _apply_leg(record, leg):
+    # Executa no shard ativo; devolve False se a perna já estava aplicada
+    if CrossShardLeg.objects.filter(transfer_id=record.id, leg=leg).exists():
+        return False
+    account_id = record.source_account_id if leg == CrossShardLeg.DEBIT else record.target_account_id
+    account = Account.objects.select_related('currency').get(id=account_id)
+    value = _leg_value(record, account)
+    money = Money.objects.create(amount=-value if leg == CrossShardLeg.DEBIT else value, currency=account.currency)
+    entry = Entry.objects.create(
+        account=account,
+        entry_type_id=record.entry_type_id,
+        amount=money,
+        date=record.when,
+        valid_date=record.when,
+    )
+    CrossShardLeg.objects.create(transfer_id=record.id, leg=leg, entry=entry)
+    account.apply_posting(money, record.when)
+    OutboxMessage.record_entry(entry, None, OutboxMessage.ENTRY_POSTED, transfer_id=record.id, leg=leg)
+    return True
+
+
+def _legs(record):
+    return [(record.source_shard, CrossShardLeg.DEBIT), (record.target_shard, CrossShardLeg.CREDIT)]
+
+
+def transfer(from_account, to_account, value, currency=None, when=None):
+    """Transfere `value` (na moeda `currency`, padrão a da conta de origem) entre contas de clientes.
+
+    Levanta ValueError('Insufficient funds') se o saldo da conta de origem não cobre o valor.
+    """
+    when = when or timezone.now()
+    source, target = from_account._state.db, to_account._state.db
+    if source != target and (from_account.memory_ledger or to_account.memory_ledger):
+        # As pernas entre shards são gravadas direto nas tabelas, fora do razão em memória
+        raise ValueError('Accounts owned by the memory ledger only take same-shard transfers')
+    with use_shard(source):
+        currency = Currency.objects.get(code=currency) if currency else from_account.currency
+        customer = from_account.customer_set.get()
+        event_type = EventType.objects.get(name='TRANSFER')
+        if source == target:
+            with shard_atomic():
+                _check_funds(from_account.id, value, currency.code, when)
+                event = TransferEvent.objects.create(
+                    event_type=event_type,
+                    when_occurred=when,
+                    when_noticed=when,
+                    customer=customer,
+                    from_account=from_account,
+                    to_account=to_account,
+                    amount=Money.objects.create(amount=value, currency=currency),
+                )
+                event.process()
+            return event
+        rule = customer.service_agreement.get_posting_rule(event_type, when)
+        if rule is None:
+            raise ValueError('No posting rule found for this transfer')
+
+    record = CrossShardTransfer.objects.create(
+        source_shard=source,
+        source_account_id=from_account.id,
+        target_shard=target,
+        target_account_id=to_account.id,
+        entry_type_id=rule.entry_type_id,
+        amount=value,
+        currency=currency.code,
+        when=when,
+    )
+    try:
+        with ExitStack() as stack:
+            # Fase 1: as duas pernas escritas e mantidas abertas nos dois shards
+            for alias, leg in _legs(record):
+                stack.enter_context(transaction.atomic(using=alias))
+                with use_shard(alias):
+                    if leg == CrossShardLeg.DEBIT:
+                        _check_funds(record.source_account_id, record.amount, record.currency, record.when)
+                    _apply_leg(record, leg)
+            # Decisão gravada no diretório antes de qualquer shard confirmar
+            CrossShardTransfer.objects.filter(id=record.id, status=CrossShardTransfer.PREPARED).update(status=CrossShardTransfer.COMMITTED)
+        # Fase 2: ao sair do ExitStack os shards confirmam
+    except Exception as e:
+        CrossShardTransfer.objects.filter(id=record.id, status=CrossShardTransfer.PREPARED).update(
+            status=CrossShardTransfer.ABORTED, last_error=str(e)
+        )
+        raise
+    CrossShardTransfer.objects.filter(id=record.id).update(status=CrossShardTransfer.DONE)
+    record.status = CrossShardTransfer.DONE
+    return record
+
+
+def recover_transfers(older_than=60):
+    """Conclui transferências interrompidas: reaplica pernas das COMMITTED e resolve PREPARED antigas.
+
+    Uma PREPARED com alguma perna já confirmada também é levada adiante (o diretório pode ter
+    sido desfeito junto com o shard que o hospeda); sem nenhuma perna ela é abortada.
+    """
+    cutoff = timezone.now() - timezone.timedelta(seconds=older_than)
+    pending = CrossShardTransfer.objects.filter(status=CrossShardTransfer.COMMITTED) | CrossShardTransfer.objects.filter(
+        status=CrossShardTransfer.PREPARED, created_at__lt=cutoff
+    )
+    results = {CrossShardTransfer.DONE: 0, CrossShardTransfer.ABORTED: 0}
+    for record in pending.order_by('id'):
+        applied = {
+            leg: CrossShardLeg.objects.using(alias).filter(transfer_id=record.id, leg=leg).exists()
+            for alias, leg in _legs(record)
+        }
+        if record.status == CrossShardTransfer.PREPARED and not any(applied.values()):
+            record.status = CrossShardTransfer.ABORTED
+            record.last_error = 'Abandoned before the commit decision'
+        else:
+            for alias, leg in _legs(record):
+                if not applied[leg]:
+                    with use_shard(alias), transaction.atomic(using=alias):
+                        _apply_leg(record, leg)
+            record.status = CrossShardTransfer.DONE
+        record.save(update_fields=['status', 'last_error'])
+        results[record.status] += 1
+    return results
@@ -0,0 +1,8 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path('', views.submit_transaction, name='submit-transaction'),
+    path('velocity/', views.velocity_metrics, name='velocity-metrics'),
+]
@@ -0,0 +1,276 @@
+# Limites de velocidade (quantidade e valor por janela deslizante) avaliados em memória
+# antes de create_accounting_event.
+#
+# Cada limite de settings.VELOCITY_LIMITS mantém, por conta ou por cliente, um anel de
+# `buckets` baldes de window/buckets segundos com a quantidade e a soma (em centavos) das
+# transações. Os totais da janela são mantidos incrementalmente: conferir e registrar uma
+# transação é O(1) amortizado, sem COUNT no banco. Na partida os anéis são reconstruídos com
+# uma consulta sobre Transaction.timestamp da maior janela configurada.
+#
+# admit() reserva a transação nas janelas; se a postagem falhar, release() desfaz a reserva,
+# para que transações canceladas não contem (como na reconstrução, que as ignora).
+#
+# As janelas são por processo: com N processos atendendo requisições cada um vê só o próprio
+# tráfego. settings.VELOCITY_PROCESSES divide cada limite pelo número de processos, de modo
+# que a soma entre eles não passe do configurado (com tráfego desigual um processo pode
+# recusar antes do limite global).
+#
+#   VELOCITY_LIMITS = [
+#       {'name': 'account-hourly', 'scope': 'account', 'types': ['WITHDRAWAL', 'TRANSFER'],
+#        'window': 3600, 'buckets': 12, 'max_count': 20, 'max_amount': '5000.00', 'currency': 'BRL'},
+#   ]
+import datetime
+import threading
+from array import array
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import timezone
+
+from accounts.models import conversion_service
+from accounts.sharding import each_shard
+
+CENTS = Decimal('0.01')
+SCOPES = ('account', 'customer')
+
+
+class VelocityLimitExceeded(ValueError):
+    def __init__(self, limit, key, count, amount):
+        self.limit, self.key = limit, key
+        super().__init__(
+            f"Velocity limit '{limit.name}' exceeded for {limit.scope} {key}: "
+            f"{count} transactions / {amount} in the last {limit.window}s"
+        )
+
+
+class SlidingWindow:
+    __slots__ = ('buckets', 'counts', 'amounts', 'head', 'count', 'amount')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = array('q', bytes(8 * buckets))
+        self.amounts = array('q', bytes(8 * buckets))
+        self.head = None
+        self.count = 0
+        self.amount = 0
+
+    def advance(self, epoch):
+        # Zera os baldes que saíram da janela; no máximo `buckets` passos por chamada
+        if self.head is None:
+            self.head = epoch
+            return
+        if epoch <= self.head:
+            return
+        for step in range(self.head + 1, min(epoch, self.head + self.buckets) + 1):
+            slot = step % self.buckets
+            self.count -= self.counts[slot]
+            self.amount -= self.amounts[slot]
+            self.counts[slot] = self.amounts[slot] = 0
+        self.head = epoch
+
+    def add(self, epoch, cents, count=1):
+        self.advance(epoch)
+        if epoch <= self.head - self.buckets:
+            return
+        slot = epoch % self.buckets
+        self.counts[slot] += count
+        self.amounts[slot] += cents
+        self.count += count
+        self.amount += cents
+
+    def remove(self, epoch, cents):
+        # Desfaz um add(epoch, cents); não faz nada se o balde já saiu da janela
+        if self.head is not None and self.head - self.buckets < epoch <= self.head:
+            self.add(epoch, -cents, count=-1)
+
+
+class VelocityLimit:
+    def __init__(self, name, scope, window, types=None, buckets=12, max_count=None, max_amount=None, currency=None, processes=1):
+        if scope not in SCOPES:
+            raise ValueError(f"Unknown velocity scope '{scope}'")
+        if max_count is None and max_amount is None:
+            raise ValueError(f"Velocity limit '{name}' needs max_count or max_amount")
+        self.name = name
+        self.scope = scope
+        self.window = window
+        self.types = set(types) if types else None
+        self.buckets = buckets
+        self.bucket_seconds = window / buckets
+        # Parte do limite que cabe a este processo (ver VELOCITY_PROCESSES)
+        self.max_count = max(1, max_count // processes) if max_count is not None else None
+        self.max_cents = max(1, int(Decimal(max_amount) * 100) // processes) if max_amount is not None else None
+        self.currency = currency
+        self.windows = {}
+
+    def applies(self, transaction_type):
+        return self.types is None or transaction_type in self.types
+
+    def epoch(self, when):
+        return int(when.timestamp() // self.bucket_seconds)
+
+    def window_for(self, key):
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = SlidingWindow(self.buckets)
+        return window
+
+    def usage(self, window, extra_count=0, extra_cents=0):
+        # Fração usada do limite mais apertado (1.0 = no limite)
+        usages = []
+        if self.max_count:
+            usages.append((window.count + extra_count) / self.max_count)
+        if self.max_cents:
+            usages.append((window.amount + extra_cents) / self.max_cents)
+        return max(usages) if usages else 0.0
+
+
+class VelocityChecker:
+    def __init__(self, limits, near_limit=0.8, processes=1):
+        self.limits = [
+            limit if isinstance(limit, VelocityLimit) else VelocityLimit(**limit, processes=processes)
+            for limit in limits
+        ]
+        self.near_limit = near_limit
+        self.checks = 0
+        self.rejections = {limit.name: 0 for limit in self.limits}
+        self._lock = threading.Lock()
+
+    def _cents(self, limit, amount, currency, when):
+        if limit.currency and currency != limit.currency:
+            amount = conversion_service().convert(amount, currency, limit.currency, when)
+        return int(Decimal(amount).quantize(CENTS) * 100)
+
+    def _targets(self, transaction_type, customer_id, account_id):
+        for limit in self.limits:
+            if limit.applies(transaction_type):
+                yield limit, customer_id if limit.scope == 'customer' else account_id
+
+    def admit(self, transaction_type, customer_id, account_id, amount, currency, when=None):
+        """Confere todos os limites e, se nenhum estoura, reserva a transação; senão VelocityLimitExceeded.
+
+        A reserva já conta para as transações seguintes; release() com os mesmos argumentos a
+        desfaz quando a postagem não acontece.
+        """
+        when = when or timezone.now()
+        targets = [
+            (limit, key, limit.window_for(key), limit.epoch(when), self._cents(limit, amount, currency, when))
+            for limit, key in self._targets(transaction_type, customer_id, account_id)
+        ]
+        with self._lock:
+            self.checks += 1
+            for limit, key, window, epoch, cents in targets:
+                window.advance(epoch)
+                if (limit.max_count is not None and window.count + 1 > limit.max_count) or (
+                    limit.max_cents is not None and window.amount + cents > limit.max_cents
+                ):
+                    self.rejections[limit.name] += 1
+                    raise VelocityLimitExceeded(limit, key, window.count, (Decimal(window.amount) / 100).quantize(CENTS))
+            for limit, key, window, epoch, cents in targets:
+                window.add(epoch, cents)
+
+    def release(self, transaction_type, customer_id, account_id, amount, currency, when):
+        with self._lock:
+            for limit, key in self._targets(transaction_type, customer_id, account_id):
+                window = limit.windows.get(key)
+                if window is not None:
+                    window.remove(limit.epoch(when), self._cents(limit, amount, currency, when))
+
+    def record(self, transaction_type, customer_id, account_id, amount, currency, when):
+        for limit, key in self._targets(transaction_type, customer_id, account_id):
+            limit.window_for(key).add(limit.epoch(when), self._cents(limit, amount, currency, when))
+
+    def rebuild(self, now=None):
+        """Recarrega as janelas com as transações recentes (uma consulta por shard); devolve quantas leu."""
+        from .models import Transaction, TransactionStatus
+        now = now or timezone.now()
+        for limit in self.limits:
+            limit.windows.clear()
+        if not self.limits:
+            return 0
+        types = set()
+        for limit in self.limits:
+            if limit.types is None:
+                types = None
+                break
+            types |= limit.types
+        since = now - datetime.timedelta(seconds=max(limit.window for limit in self.limits))
+        loaded = 0
+        with self._lock:
+            for _ in each_shard():
+                # Canceladas não movimentaram dinheiro e não contam para o limite
+                rows = Transaction.objects.filter(timestamp__gte=since).exclude(
+                    transaction_status_id=TransactionStatus.id_for(TransactionStatus.CANCELLED)
+                )
+                if types is not None:
+                    rows = rows.filter(transaction_type__name__in=types)
+                rows = rows.order_by('timestamp').values_list(
+                    'transaction_type__name', 'customer_id', 'from_account_id',
+                    'amount__amount', 'amount__currency__code', 'timestamp',
+                )
+                for row in rows.iterator():
+                    self.record(*row)
+                    loaded += 1
+            # Descarta o que já saiu da janela em relação a agora
+            for limit in self.limits:
+                epoch = limit.epoch(now)
+                for window in limit.windows.values():
+                    window.advance(epoch)
+        return loaded
+
+    def metrics(self, now=None, top=50):
+        now = now or timezone.now()
+        near = []
+        with self._lock:
+            for limit in self.limits:
+                epoch = limit.epoch(now)
+                for key, window in list(limit.windows.items()):
+                    window.advance(epoch)
+                    if not window.count:
+                        # Janela vazia: libera a memória da chave
+                        del limit.windows[key]
+                        continue
+                    usage = limit.usage(window)
+                    if usage >= self.near_limit:
+                        near.append({
+                            'limit': limit.name,
+                            'scope': limit.scope,
+                            'key': key,
+                            'count': window.count,
+                            'amount': str((Decimal(window.amount) / 100).quantize(CENTS)),
+                            'usage': round(usage, 3),
+                        })
+            near.sort(key=lambda row: row['usage'], reverse=True)
+            return {
+                'checks': self.checks,
+                'rejections': dict(self.rejections),
+                'tracked_keys': {limit.name: len(limit.windows) for limit in self.limits},
+                'near_limit': near[:top],
+            }
+
+
+_checker = None
+_checker_lock = threading.Lock()
+
+
+def get_checker():
+    """Verificador do processo, reconstruído do histórico na primeira chamada; None sem limites configurados."""
+    global _checker
+    limits = getattr(settings, 'VELOCITY_LIMITS', None)
+    if not limits:
+        return None
+    if _checker is None:
+        with _checker_lock:
+            if _checker is None:
+                checker = VelocityChecker(
+                    limits,
+                    near_limit=getattr(settings, 'VELOCITY_NEAR_LIMIT', 0.8),
+                    processes=getattr(settings, 'VELOCITY_PROCESSES', 1),
+                )
+                checker.rebuild()
+                _checker = checker
+    return _checker
+
+
+def reset_checker():
+    global _checker
+    _checker = None
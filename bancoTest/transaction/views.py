@@ -1,3 +1,136 @@
-from django.shortcuts import render
+import json
+from decimal import Decimal, InvalidOperation
 
-# Create your views here.
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from accounts.models import Account, Currency, Customer, Money, ShardMap
+from accounts.sharding import shard_for_customer, use_shard
+from .models import Transaction, TransactionStatus, TransactionType
+from .velocity import VelocityLimitExceeded, get_checker
+
+
+def _transaction_payload(transaction):
+    return {
+        'id': transaction.id,
+        'idempotency_key': transaction.idempotency_key,
+        'transaction_type': transaction.transaction_type.name,
+        'status': TransactionStatus.name_for(transaction.transaction_status_id),
+        'amount': str(transaction.amount.amount),
+        'currency': transaction.amount.currency.code,
+        'from_account': transaction.from_account_id,
+        'to_account': transaction.to_account_id,
+    }
+
+
+def _replay_response(transaction):
+    # Reenvio com uma chave conhecida: 200 com o resultado final, 202 se ainda estiver pendente (adiada)
+    status = 202 if transaction.is_pending else 200
+    return JsonResponse(_transaction_payload(transaction), status=status)
+
+
+@csrf_exempt
+@require_POST
+def submit_transaction(request):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+
+    # Tudo do cliente (contas, transações, chaves de idempotência) fica no shard dele
+    try:
+        shard = shard_for_customer(int(data['customer']))
+    except (KeyError, TypeError, ValueError, ShardMap.DoesNotExist) as e:
+        return JsonResponse({'error': f'Invalid submission: {e!r}'}, status=400)
+    with use_shard(shard):
+        return _submit(request, data)
+
+
+def _submit(request, data):
+    key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    if key:
+        # Reenvio: devolve o resultado original com uma busca pelo índice
+        existing = Transaction.objects.filter(idempotency_key=key).select_related(
+            'transaction_type', 'transaction_status', 'amount__currency'
+        ).first()
+        if existing is not None:
+            return _replay_response(existing)
+
+    try:
+        customer = Customer.objects.get(id=data['customer'])
+        # Só contas do próprio cliente podem ser debitadas
+        from_account = customer.accounts.filter(id=data['from_account']).first()
+        if from_account is None:
+            return JsonResponse({'error': 'from_account does not belong to customer'}, status=403)
+        to_account = Account.objects.get(id=data['to_account']) if data.get('to_account') else None
+        transaction_type = TransactionType.objects.get(name=data['transaction_type'])
+        currency = Currency.objects.get(code=data['currency']) if data.get('currency') else from_account.currency
+        amount = Decimal(str(data['amount']))
+    except (KeyError, InvalidOperation, Customer.DoesNotExist, Account.DoesNotExist,
+            TransactionType.DoesNotExist, Currency.DoesNotExist) as e:
+        return JsonResponse({'error': f'Invalid submission: {e!r}'}, status=400)
+
+    # Obtido antes de gravar a transação: na primeira chamada as janelas são reconstruídas do histórico
+    checker = get_checker()
+    transaction, created = Transaction.submit(
+        idempotency_key=key,
+        customer=customer,
+        from_account=from_account,
+        to_account=to_account,
+        # Gravado por submit() na mesma transação do INSERT, só se a chave for nova
+        amount=Money(amount=amount, currency=currency),
+        transaction_type=transaction_type,
+        transaction_status_id=TransactionStatus.id_for(TransactionStatus.PENDING),
+        description=data.get('description'),
+    )
+    if not created:
+        return _replay_response(transaction)
+
+    # Gravado em lote ao fim da requisição pelo TransactionLogMiddleware
+    logs = request.transaction_logs
+    logs.log(transaction, f"Submitted {transaction_type.name} of {amount} {currency.code}")
+    if checker is not None:
+        try:
+            checker.admit(transaction_type.name, customer.id, from_account.id, amount, currency.code, transaction.timestamp)
+        except VelocityLimitExceeded as e:
+            logs.log(transaction, f"Cancelled: {e}")
+            transaction.transition(TransactionStatus.CANCELLED)
+            payload = _transaction_payload(transaction)
+            payload['error'] = str(e)
+            return JsonResponse(payload, status=429)
+    event = transaction.create_accounting_event()
+    if data.get('defer'):
+        # Postagem adiada: a transação segue PENDING até o worker do process_events encerrá-la
+        event.defer()
+        logs.log(transaction, f"Deferred event {event.id}")
+        return JsonResponse(_transaction_payload(transaction), status=202)
+
+    error = None
+    try:
+        event.process()
+        status_name, status_code = TransactionStatus.COMPLETED, 201
+        logs.log(transaction, f"Posted event {event.id}")
+    except Exception as e:
+        # process() desfaz as entradas; qualquer falha encerra a transação, para que um reenvio
+        # não encontre para sempre uma transação PENDING
+        status_name, status_code = TransactionStatus.CANCELLED, 422 if isinstance(e, ValueError) else 500
+        error = str(e) if isinstance(e, ValueError) else f'Posting failed: {e!r}'
+        logs.log(transaction, f"Cancelled: {error}")
+        if checker is not None:
+            # Só transações postadas contam nas janelas de velocidade
+            checker.release(transaction_type.name, customer.id, from_account.id, amount, currency.code, transaction.timestamp)
+    transaction.transition(status_name)
+
+    payload = _transaction_payload(transaction)
+    if error is not None:
+        payload['error'] = error
+    return JsonResponse(payload, status=status_code)
+
+
+@require_GET
+def velocity_metrics(request):
+    checker = get_checker()
+    if checker is None:
+        return JsonResponse({'enabled': False})
+    return JsonResponse({'enabled': True, **checker.metrics()})